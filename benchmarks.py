@@ -0,0 +1,376 @@
+import argparse
+from dataclasses import dataclass
+import gc
+import json
+import numpy as np
+from pathlib import Path
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Callable, Dict, List, Tuple
+
+from experiment_analyzer import analyze_convergence, analyze_trajectory, analyze_window_prices, extract_window_prices
+from experiment_config import ExperimentConfig
+from json_prompt_setup import generate_prompt_for_json, output_json_parser
+from legacy_prompt_setup import generate_prompt, output_parser
+from llm_pricing_agent import LLMPricingAgent
+from logger import get_logger, init_logger
+from logit_demand import logit_demand, monopoly_price, monopoly_prices
+from market_history import MarketHistory
+from market_simulation import LogitPriceMarketSimulation
+from pricing_agent import PricingAgent
+from prompt_commons import MarketHistoryRenderer
+from simple_llm_context import LLMContext
+
+HISTORY_SIZES = [100, 1000, 10000]
+BENCHMARK_REPEATS = 5
+REGRESSION_THRESHOLD = 0.2
+# Entry points timed from a fresh interpreter, none of them may load the lazily imported modules
+IMPORT_ENTRY_POINTS = ['main', 'sweep', 'experiment_analyzer', 'llm_backends']
+LAZY_MODULES = ['together', 'scipy', 'regex', 'http.server']
+IMPORT_BUDGET_SECONDS = 1.0
+IMPORT_PROBE = '''import json, sys, time
+start = time.perf_counter()
+import %s
+print(json.dumps({'seconds': time.perf_counter() - start, 'eager': [name for name in %r if name in sys.modules]}))'''
+
+# Fixtures mimic the experiments in main.py, a single firm priced around its monopoly price
+PRICE_SCALE = 3.2
+PRODUCT_QUALITY = 2
+COST_TO_MAKE = 1
+HORZ_DIFFEREN = 0.25
+OUTSIDE_GOOD = 0
+QUANTITY_SCALE = 100
+FIRM_ID = 1
+MODEL = 'meta-llama/Meta-Llama-3-8B-Instruct-Turbo'
+
+def build_history(round_count: int, seed: int = 0) -> MarketHistory:
+    rng = np.random.default_rng(seed)
+    center = monopoly_price(PRODUCT_QUALITY, COST_TO_MAKE, PRICE_SCALE, HORZ_DIFFEREN, OUTSIDE_GOOD)
+    prices = center * np.exp(np.cumsum(rng.normal(0, 0.02, round_count)))
+    quantities, profits = logit_demand(prices[:, np.newaxis], PRODUCT_QUALITY, COST_TO_MAKE, PRICE_SCALE,
+                                       HORZ_DIFFEREN, OUTSIDE_GOOD, QUANTITY_SCALE)
+    history = MarketHistory()
+    for price, quantity, profit in zip(prices.tolist(), quantities[:, 0].tolist(), profits[:, 0].tolist()):
+        history.append_round([FIRM_ID], [price], [quantity], [profit])
+    return history
+
+def build_context() -> LLMContext:
+    return LLMContext(cost_per_unit=COST_TO_MAKE,
+                      max_client_price=2 * PRICE_SCALE * COST_TO_MAKE,
+                      plans='Test prices a little above the last one and keep the best performing price. ' * 4,
+                      insights='Profit peaked around 4.1, prices above 4.6 lose most of the customers. ' * 4)
+
+def build_agent(promt_generator, output_parser) -> LLMPricingAgent:
+    return LLMPricingAgent(FIRM_ID, COST_TO_MAKE, lambda promt, **kwargs: '', promt_generator, output_parser,
+                           config=ExperimentConfig(model=MODEL), initial_context=build_context())
+
+LEGACY_OUTPUT = """My observations and thoughts:
+Prices around 4.1 gave the best profit so far, I will keep testing close to it.
+New content for PLANS.txt:
+Test 4.15 next, then move back toward 4.1 if profit drops.
+New content for INSIGHTS.txt:
+Profit peaks close to 4.1, demand drops quickly above 4.6.
+My chosen price:
+$4.15"""
+
+JSON_OUTPUT = """My observations and thoughts:
+Prices around 4.1 gave the best profit so far, I will keep testing close to it.
+My final answer:
+{
+    "plans.txt": "Test 4.15 next, then move back toward 4.1 if profit drops.",
+    "insights.txt": "Profit peaks close to 4.1, demand drops quickly above 4.6.",
+    "my_price": 4.15
+}"""
+
+# Models often echo the template, quote earlier rounds and write half finished objects before the real answer
+MESSY_JSON_OUTPUT = ("My observations and thoughts:\n" +
+                     "Round {n}: I priced at {p} and got {q} sales, the template wants {\"my_price\": <fill in here>}. " * 40 +
+                     "\nDraft: {\"plans.txt\": \"try {higher} prices\", \"insights.txt\": {\"nested\": {\"deep\": [1, 2, {\"x\": 3}]}}}\n" +
+                     "My final answer:\n" + JSON_OUTPUT.split('My final answer:\n')[1])
+
+# Truncated or looping answers can leave thousands of braces open
+UNBALANCED_JSON_OUTPUT = '{"step": ' * 2000 + JSON_OUTPUT
+
+MESSY_LEGACY_OUTPUT = ("My observations and thoughts:\n" +
+                       "Looking at the market data, the price went from 4.0 to 4.2 and profit moved with it. " * 60 +
+                       LEGACY_OUTPUT.split('My observations and thoughts:\n')[1])
+
+class ConstantPricer(PricingAgent):
+    def generate_price(self, market_history: MarketHistory) -> float:
+        return 4.1
+
+@dataclass
+class BenchmarkResult:
+    name: str
+    ops_per_sec: float
+    peak_bytes: int
+    allocated_blocks: int
+
+    def to_dict(self) -> dict:
+        return {'ops_per_sec': self.ops_per_sec,
+                'peak_bytes': self.peak_bytes,
+                'allocated_blocks': self.allocated_blocks}
+
+# A benchmark factory builds its fixtures and returns the operation to time
+BenchmarkFactory = Callable[[], Callable[[], object]]
+
+def render_history_cold(round_count: int) -> BenchmarkFactory:
+    def factory():
+        history = build_history(round_count)
+        return lambda: MarketHistoryRenderer(100).render(history)
+    return factory
+
+def render_history_round(round_count: int) -> BenchmarkFactory:
+    # What every simulated round pays, one new round then a render
+    def factory():
+        history = build_history(round_count)
+        renderer = MarketHistoryRenderer(100)
+        renderer.render(history)
+
+        def run():
+            history.append_round([FIRM_ID], [4.1], [40.0], [120.0])
+            return renderer.render(history)
+        return run
+    return factory
+
+def prompt_round(promt_generator, round_count: int) -> BenchmarkFactory:
+    def factory():
+        history = build_history(round_count)
+        agent = build_agent(promt_generator, None)
+        context = build_context()
+        promt_generator(agent, history, context)
+
+        def run():
+            history.append_round([FIRM_ID], [4.1], [40.0], [120.0])
+            return promt_generator(agent, history, context)
+        return run
+    return factory
+
+def parse_output(output_parser, llm_output: str) -> BenchmarkFactory:
+    def factory():
+        context = build_context()
+        return lambda: output_parser(context, llm_output)
+    return factory
+
+def simulate_round(round_count: int) -> BenchmarkFactory:
+    def factory():
+        simulation = LogitPriceMarketSimulation(QUANTITY_SCALE, PRICE_SCALE, HORZ_DIFFEREN, OUTSIDE_GOOD)
+        simulation.add_firm(ConstantPricer(FIRM_ID, COST_TO_MAKE), PRODUCT_QUALITY)
+        simulation.market_history = build_history(round_count)
+        return simulation._simulate_market
+    return factory
+
+def monopoly_price_uncached() -> BenchmarkFactory:
+    def factory():
+        return lambda: monopoly_price.__wrapped__(PRODUCT_QUALITY, COST_TO_MAKE, PRICE_SCALE,
+                                                  HORZ_DIFFEREN, OUTSIDE_GOOD)
+    return factory
+
+def monopoly_price_batch(count: int) -> BenchmarkFactory:
+    def factory():
+        qualities = np.random.default_rng(0).uniform(1, 3, count)
+        return lambda: monopoly_prices(qualities, COST_TO_MAKE, PRICE_SCALE, HORZ_DIFFEREN, OUTSIDE_GOOD)
+    return factory
+
+def analyze_result(round_count: int) -> BenchmarkFactory:
+    def factory():
+        raw_history = build_history(round_count).to_dict()['past_iteration']
+        addit_data = {'monopoly_price': 4.1, 'failed': False}
+        return lambda: analyze_window_prices(addit_data, extract_window_prices(raw_history, 100), 'bench.json')
+    return factory
+
+def analyze_convergence_batch(run_count: int) -> BenchmarkFactory:
+    def factory():
+        price_matrix = np.random.default_rng(0).uniform(3.9, 4.3, (run_count, 100))
+        return lambda: analyze_convergence(price_matrix)
+    return factory
+
+def analyze_trajectory_run(round_count: int) -> BenchmarkFactory:
+    def factory():
+        prices = np.random.default_rng(0).uniform(3.9, 4.3, round_count).tolist()
+        return lambda: analyze_trajectory(prices, 4.1)
+    return factory
+
+def get_benchmarks() -> Dict[str, BenchmarkFactory]:
+    benchmarks: Dict[str, BenchmarkFactory] = {}
+    for round_count in HISTORY_SIZES:
+        benchmarks['render_history_cold[%d]' % round_count] = render_history_cold(round_count)
+        benchmarks['render_history_round[%d]' % round_count] = render_history_round(round_count)
+        benchmarks['generate_prompt_round[%d]' % round_count] = prompt_round(generate_prompt, round_count)
+        benchmarks['generate_prompt_for_json_round[%d]' % round_count] = prompt_round(generate_prompt_for_json,
+                                                                                     round_count)
+        benchmarks['simulate_market_round[%d]' % round_count] = simulate_round(round_count)
+        benchmarks['analyze_result[%d]' % round_count] = analyze_result(round_count)
+        benchmarks['analyze_trajectory[%d]' % round_count] = analyze_trajectory_run(round_count)
+    benchmarks['output_parser[clean]'] = parse_output(output_parser, LEGACY_OUTPUT)
+    benchmarks['output_parser[messy]'] = parse_output(output_parser, MESSY_LEGACY_OUTPUT)
+    benchmarks['output_json_parser[clean]'] = parse_output(output_json_parser, JSON_OUTPUT)
+    benchmarks['output_json_parser[messy]'] = parse_output(output_json_parser, MESSY_JSON_OUTPUT)
+    benchmarks['output_json_parser[unbalanced]'] = parse_output(output_json_parser, UNBALANCED_JSON_OUTPUT)
+    benchmarks['find_monopoly_price[uncached]'] = monopoly_price_uncached()
+    benchmarks['monopoly_prices[1000]'] = monopoly_price_batch(1000)
+    benchmarks['analyze_convergence[1000 runs]'] = analyze_convergence_batch(1000)
+    return benchmarks
+
+def time_operation(operation: Callable[[], object], min_time: float) -> float:
+    # Calibrates the loop count like timeit's autorange, then keeps the best of a few repeats
+    loops = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(loops):
+            operation()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time / BENCHMARK_REPEATS:
+            break
+        loops *= 2
+    best = elapsed / loops
+    for _ in range(BENCHMARK_REPEATS - 1):
+        start = time.perf_counter()
+        for _ in range(loops):
+            operation()
+        best = min(best, (time.perf_counter() - start) / loops)
+    return 1 / best if best > 0 else float('inf')
+
+def measure_allocations(operation: Callable[[], object]) -> Tuple[int, int]:
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        tracemalloc.reset_peak()
+        base_memory, _ = tracemalloc.get_traced_memory()
+        operation()
+        _, peak_memory = tracemalloc.get_traced_memory()
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    allocated_blocks = sum(max(stat.count_diff, 0) for stat in after.compare_to(before, 'lineno'))
+    return peak_memory - base_memory, allocated_blocks
+
+def run_benchmark(name: str, factory: BenchmarkFactory, min_time: float) -> BenchmarkResult:
+    # Fresh fixtures for timing and allocations, benchmarks that append rounds mutate them
+    ops_per_sec = time_operation(factory(), min_time)
+    peak_bytes, allocated_blocks = measure_allocations(factory())
+    return BenchmarkResult(name=name, ops_per_sec=ops_per_sec, peak_bytes=peak_bytes,
+                           allocated_blocks=allocated_blocks)
+
+def measure_import(module: str) -> Tuple[float, List[str]]:
+    best = float('inf')
+    for _ in range(BENCHMARK_REPEATS):
+        output = subprocess.run([sys.executable, '-c', IMPORT_PROBE % (module, LAZY_MODULES)],
+                                cwd=Path(__file__).resolve().parent, capture_output=True, text=True, check=True)
+        probe = json.loads(output.stdout)
+        best = min(best, probe['seconds'])
+    return best, probe['eager']
+
+def check_import_budget(name_filter: str, budget: float) -> List[str]:
+    failures = []
+    for module in IMPORT_ENTRY_POINTS:
+        name = 'import[%s]' % module
+        if name_filter not in name:
+            continue
+        seconds, eager = measure_import(module)
+        print('%-45s %12.1f ms %s' % (name, seconds * 1000, 'eagerly imports %s' % ', '.join(eager) if eager else ''))
+        if seconds > budget or len(eager) > 0:
+            failures.append(name)
+    return failures
+
+def environment_info() -> dict:
+    return {'python': sys.version.split()[0],
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'machine': platform.machine()}
+
+def save_baseline(path: Path, results: List[BenchmarkResult]):
+    with open(path, 'w') as f:
+        json.dump({'environment': environment_info(),
+                   'results': {result.name: result.to_dict() for result in results}}, f, indent=2)
+
+def compare_to_baseline(path: Path, results: List[BenchmarkResult], threshold: float) -> List[str]:
+    with open(path, 'r') as f:
+        baseline = json.load(f)
+    if baseline['environment'] != environment_info():
+        print('Warning: baseline was recorded on %s' % baseline['environment'])
+    regressions = []
+    for result in results:
+        previous = baseline['results'].get(result.name)
+        if previous is None:
+            continue
+        speedup = result.ops_per_sec / previous['ops_per_sec']
+        line = '%-45s %8.2fx ops/sec  %+.0f%% peak memory' % (
+            result.name, speedup,
+            100 * (result.peak_bytes - previous['peak_bytes']) / max(previous['peak_bytes'], 1))
+        print(line)
+        if speedup < 1 - threshold:
+            regressions.append(result.name)
+    return regressions
+
+def get_args():
+    parser = argparse.ArgumentParser(
+                prog='benchmarks',
+                description='Micro benchmarks of the non LLM hot paths')
+    parser.add_argument('--filter',
+            help='Only run benchmarks whose name contains this text',
+            default='',
+            required=False)
+    parser.add_argument('--min-time',
+            help='Seconds spent timing each benchmark',
+            type=float,
+            default=0.5,
+            required=False)
+    parser.add_argument('--save-baseline',
+            help='Save the results as a baseline JSON',
+            default=None,
+            required=False)
+    parser.add_argument('--compare',
+            help='Baseline JSON to compare against, exits with 1 on regressions',
+            default=None,
+            required=False)
+    parser.add_argument('--threshold',
+            help='Relative ops/sec drop reported as a regression',
+            type=float,
+            default=REGRESSION_THRESHOLD,
+            required=False)
+    parser.add_argument('--import-budget',
+            help='Seconds an entry point may take to import, exits with 1 when one is slower',
+            type=float,
+            default=IMPORT_BUDGET_SECONDS,
+            required=False)
+    parser.add_argument('--log-level',
+            help='Level of the pipeline logger while benchmarking, DEBUG includes the prompt dumps',
+            default='WARNING',
+            required=False)
+    return parser.parse_args()
+
+def main():
+    args = get_args()
+    log_dir = tempfile.TemporaryDirectory()
+    init_logger(Path(log_dir.name))
+    get_logger().setLevel(args.log_level)
+
+    results = []
+    print('%-45s %14s %12s %10s' % ('benchmark', 'ops/sec', 'peak KiB', 'blocks'))
+    for name, factory in get_benchmarks().items():
+        if args.filter not in name:
+            continue
+        result = run_benchmark(name, factory, args.min_time)
+        results.append(result)
+        print('%-45s %14.1f %12.1f %10d' % (name, result.ops_per_sec, result.peak_bytes / 1024,
+                                             result.allocated_blocks))
+
+    import_failures = check_import_budget(args.filter, args.import_budget)
+
+    if args.save_baseline is not None:
+        save_baseline(Path(args.save_baseline), results)
+    regressions = []
+    if args.compare is not None:
+        regressions = compare_to_baseline(Path(args.compare), results, args.threshold)
+    if len(regressions) + len(import_failures) > 0:
+        print('Regressions: %s' % ', '.join(regressions + import_failures))
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+from bisect import bisect_left, insort
+from collections import deque
+from dataclasses import asdict, dataclass
+from typing import Deque, List, Optional, Tuple
+
+# The analyzer's convergence criterion lives here so runs and the analyzer share it
+CONVERGENCE_WINDOW = 100
+CONVERGENCE_DISTANCE = 0.05
+DEFAULT_PATIENCE = 20
+
+class SortedWindow:
+    # The last size values, kept both in arrival order and sorted. Order statistics are O(1), an update is an
+    # O(log size) search plus an O(size) list shift, so a run of n rounds costs O(n * size), not O(n log size).
+    # That is deliberate: the shift is a single memmove, an update takes about 1.5us at 100 values and 4us at
+    # 10000, while a balanced tree or skip list in pure Python pays microseconds per level on every update.
+    def __init__(self, size: int):
+        assert size > 0, 'Window must hold at least one value'
+        self.size = size
+        self.sorted: List[float] = []
+        self.total = 0.0
+        self._arrivals: Deque[float] = deque()
+
+    def __len__(self) -> int:
+        return len(self._arrivals)
+
+    @property
+    def full(self) -> bool:
+        return len(self._arrivals) == self.size
+
+    @property
+    def min(self) -> float:
+        return self.sorted[0]
+
+    @property
+    def max(self) -> float:
+        return self.sorted[-1]
+
+    @property
+    def mean(self) -> float:
+        return self.total / len(self._arrivals)
+
+    def push(self, value: float):
+        self._arrivals.append(value)
+        insort(self.sorted, value)
+        self.total += value
+        if len(self._arrivals) > self.size:
+            evicted = self._arrivals.popleft()
+            del self.sorted[bisect_left(self.sorted, evicted)]
+            self.total -= evicted
+
+    def any_between(self, low: float, high: float) -> bool:
+        index = bisect_left(self.sorted, low)
+        return index < len(self.sorted) and self.sorted[index] <= high
+
+@dataclass(frozen=True)
+class EarlyStoppingPolicy:
+    window: int = CONVERGENCE_WINDOW
+    tolerance: float = CONVERGENCE_DISTANCE
+    # Rounds the window has to stay converged before the run ends
+    patience: int = DEFAULT_PATIENCE
+
+    def __post_init__(self):
+        assert self.window > 0, 'Window must hold at least one round'
+        assert self.tolerance > 0, 'Tolerance must be positive'
+        assert self.patience > 0, 'Patience must be at least one round'
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+def convergence_bounds(window: SortedWindow, tolerance: float) -> Tuple[float, float]:
+    # A positive price c is within tolerance of every window price iff max / (1 + tolerance) <= c and, since the
+    # farthest price below c is the window's min, c <= min / (1 - tolerance)
+    low = window.max / (1 + tolerance)
+    high = window.min / (1 - tolerance) if tolerance < 1 else float('inf')
+    return low, high
+
+def window_converges(window: SortedWindow, tolerance: float) -> bool:
+    # The analyzer's criterion: some candidate, a window price or the window average, is within tolerance of
+    # every tail price. The farthest prices from any candidate are the window's min and max.
+    if not window.full or window.min <= 0:
+        return False
+    low, high = convergence_bounds(window, tolerance)
+    if low > high:
+        return False
+    return window.any_between(low, high) or low <= window.mean <= high
+
+def window_converges_to(window: SortedWindow, price: float, tolerance: float) -> bool:
+    # The analyzer's check_converages_to, which doesn't need the window to converge to one of its own prices
+    if not window.full or price <= 0:
+        return False
+    low, high = convergence_bounds(window, tolerance)
+    return low <= price <= high
+
+class ConvergenceMonitor:
+    def __init__(self, policy: EarlyStoppingPolicy):
+        self.policy = policy
+        self.window = SortedWindow(policy.window)
+        self.converged_rounds = 0
+        self.stopped_round: Optional[int] = None
+
+    def update(self, round_number: int, price: float) -> bool:
+        # Returns True once the run should stop, round_number counts from 1
+        self.window.push(price)
+        if window_converges(self.window, self.policy.tolerance):
+            self.converged_rounds += 1
+        else:
+            self.converged_rounds = 0
+        if self.converged_rounds >= self.policy.patience and self.stopped_round is None:
+            self.stopped_round = round_number
+        return self.stopped_round is not None
+
+    def get_stats_dict(self) -> dict:
+        return {**self.policy.to_dict(), 'stopped_round': self.stopped_round}
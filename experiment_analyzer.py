@@ -1,108 +1,347 @@
 import argparse
+from concurrent.futures import ProcessPoolExecutor
 import copy
+import csv
+import glob
+import hashlib
 import json
 import numpy as np
-from typing import List, Optional
+import os
+from pathlib import Path
+import sys
+from typing import Dict, List, Optional, Tuple
+
+from early_stopping import CONVERGENCE_DISTANCE, CONVERGENCE_WINDOW, SortedWindow, window_converges, \
+                           window_converges_to
+from result_format import BINARY_RESULT_MAGIC, BINARY_RESULT_SUFFIX, is_binary_result, load_binary_result
 
 def get_arguments():
     parser = argparse.ArgumentParser(
                     prog='experiment_analyzer',
                     description='Analyze experiment output jsons')
-    parser.add_argument('--source',
-                        type=argparse.FileType('rb', 0),
-                        required=True)
+    sources = parser.add_mutually_exclusive_group(required=True)
+    sources.add_argument('--source',
+                        type=argparse.FileType('rb', 0))
+    sources.add_argument('--batch',
+                        help='Result directories or glob patterns to analyze together',
+                        nargs='+')
     parser.add_argument('--json-mode',
                     default=False,
                     action='store_true',
                     required=False)
+    parser.add_argument('--output',
+                    help='Aggregated batch table, .csv or .jsonl',
+                    required=False)
+    parser.add_argument('--index',
+                    help='File remembering already analyzed results (default: <output>.index.json)',
+                    required=False)
+    parser.add_argument('--window',
+                    help='Amount of final rounds checked for convergence',
+                    type=int,
+                    default=CONVERGENCE_WINDOW,
+                    required=False)
+    parser.add_argument('--tail-count',
+                    help='Amount of lowest and top window prices compared against a convergence candidate',
+                    type=int,
+                    default=CONVERGENCE_TAIL_COUNT,
+                    required=False)
+    parser.add_argument('--tolerance',
+                    help='Max relative distance of the tail prices from a convergence candidate',
+                    type=float,
+                    default=CONVERGENCE_DISTANCE,
+                    required=False)
+    parser.add_argument('--trajectory',
+                    help='Also slide the window over every round, reporting when and how often the run converged',
+                    default=False,
+                    action='store_true',
+                    required=False)
+    parser.add_argument('--workers',
+                    help='Amount of analyzer processes in batch mode',
+                    type=int,
+                    default=os.cpu_count(),
+                    required=False)
 
     return parser.parse_args()
 
-def check_converages_to(sorted_prices: List[float], price: float, converagnce_distance=0.05) -> bool:
-    lowest_prices = sorted_prices[:10]
-    top_prices = sorted_prices[-10:]
+CONVERGENCE_TAIL_COUNT = 10
 
-    for test_price in (lowest_prices + top_prices):
-        distance = (np.abs(test_price - price) / price)
-        if distance > converagnce_distance:
-            return False
+def convergence_distances(sorted_prices: np.ndarray, candidates: np.ndarray,
+                          tail_count=CONVERGENCE_TAIL_COUNT) -> np.ndarray:
+    # Prices are sorted along the last axis, leading axes are independent runs.
+    # Returns the largest relative distance between each candidate and the lowest/top tail prices.
+    sorted_prices = np.asarray(sorted_prices, dtype=np.float64)
+    candidates = np.asarray(candidates, dtype=np.float64)
+    extremes = np.concatenate([sorted_prices[..., :tail_count], sorted_prices[..., -tail_count:]], axis=-1)
+    distances = np.abs(extremes[..., np.newaxis, :] - candidates[..., :, np.newaxis]) / candidates[..., :, np.newaxis]
+    return distances.max(axis=-1, initial=0)
 
-    return True
+def check_converages_to(sorted_prices: List[float], price: float, converagnce_distance=CONVERGENCE_DISTANCE,
+                        tail_count=CONVERGENCE_TAIL_COUNT) -> bool:
+    return bool(convergence_distances(sorted_prices, [price], tail_count)[0] <= converagnce_distance)
 
-def best_converagence_option(sorted_prices: List[float], options: List[float], converagnce_distance=0.05) -> Optional[float]:
-    lowest_prices = sorted_prices[:10]
-    top_prices = sorted_prices[-10:]
+def best_converagence_option(sorted_prices: List[float], options: List[float], converagnce_distance=CONVERGENCE_DISTANCE,
+                             tail_count=CONVERGENCE_TAIL_COUNT) -> Optional[float]:
+    distances = convergence_distances(sorted_prices, options, tail_count)
+    valid = distances <= converagnce_distance
+    if not valid.any():
+        return None
+    return options[int(np.argmin(np.where(valid, distances, np.inf)))]
 
-    best_price = None
-    max_distance = None
+def analyze_convergence(price_matrix: np.ndarray, converagnce_distance=CONVERGENCE_DISTANCE,
+                        tail_count=CONVERGENCE_TAIL_COUNT) -> Tuple[np.ndarray, np.ndarray]:
+    # Every row is one run's price window, the candidates are its prices and their average.
+    # Returns whether each run converges and the best converging candidate (nan when there is none).
+    prices = np.atleast_2d(np.asarray(price_matrix, dtype=np.float64))
+    candidates = np.concatenate([prices, prices.mean(axis=-1, keepdims=True)], axis=-1)
+    distances = convergence_distances(np.sort(prices, axis=-1), candidates, tail_count)
+    valid = distances <= converagnce_distance
+    converages = valid.any(axis=-1)
+    best_index = np.argmin(np.where(valid, distances, np.inf), axis=-1)
+    best_options = np.take_along_axis(candidates, best_index[..., np.newaxis], axis=-1)[..., 0]
+    return converages, np.where(converages, best_options, np.nan)
 
-    for price in options:
-        current_max_distance = 0
-        for test_price in (lowest_prices + top_prices):
-            distance = (np.abs(test_price - price) / price)
-            current_max_distance = max(distance, current_max_distance)
-        
-        if current_max_distance > converagnce_distance:
+def analyze_trajectory(prices: List[float], monopoly_price: float, window=CONVERGENCE_WINDOW,
+                       converagnce_distance=CONVERGENCE_DISTANCE) -> dict:
+    # Checks the window ending at every round, the sorted window is updated instead of sorting every window,
+    # which makes a run O(n * window). Rounds count from 1, a run converges at the last round of its first
+    # converging window.
+    sorted_window = SortedWindow(window)
+    converged_rounds = 0
+    monopoly_rounds = 0
+    episodes = 0
+    converged = False
+    time_to_convergence = None
+    time_to_monopoly_convergence = None
+    for round_number, price in enumerate(prices, start=1):
+        sorted_window.push(price)
+        if abs(price - monopoly_price) <= converagnce_distance * monopoly_price:
+            monopoly_rounds += 1
+        if time_to_monopoly_convergence is None and \
+                window_converges_to(sorted_window, monopoly_price, converagnce_distance):
+            time_to_monopoly_convergence = round_number
+        was_converged = converged
+        converged = window_converges(sorted_window, converagnce_distance)
+        if not converged:
             continue
+        converged_rounds += 1
+        if not was_converged:
+            episodes += 1
+        if time_to_convergence is None:
+            time_to_convergence = round_number
 
-        if max_distance is None or current_max_distance < max_distance:
-            best_price = price
-            max_distance = current_max_distance
+    return {'time_to_convergence': time_to_convergence,
+            'time_to_monopoly_convergence': time_to_monopoly_convergence,
+            'convergence_episodes': episodes,
+            'converged_rounds_fraction': converged_rounds / len(prices) if len(prices) > 0 else None,
+            'monopoly_rounds_fraction': monopoly_rounds / len(prices) if len(prices) > 0 else None,
+            'ends_converged': converged}
 
-    return best_price
+def extract_prices(market_history: List[dict]) -> List[float]:
+    prices = []
+    for attempt in market_history:
+        priced_products = attempt['priced_products']
+        assert len(priced_products) == 1, 'We only analyze monopoly experiments'
+        prices.append(priced_products[0]['price'])
+    return prices
 
-def output_json(args, raw_market_data: dict):
-    addit_data = raw_market_data['additional_context']
-    market_history = raw_market_data['market_history']['past_iteration']
+def extract_window_prices(market_history: List[dict], window: int) -> List[float]:
+    return extract_prices(market_history[-window:])
 
+def load_binary_window_prices(path: Path, window: Optional[int]) -> Tuple[dict, List[float]]:
+    # A window of None reads every round
+    result = load_binary_result(path)
+    if result.prices.shape[0] == 0:
+        return result.additional_context, []
+    assert result.prices.shape[1] == 1, 'We only analyze monopoly experiments'
+    # Only the window is read from the memory mapped column
+    start = -window if window is not None else 0
+    return result.additional_context, result.prices[start:, 0].tolist()
+
+def analyze_window_prices(addit_data: dict, prices: List[float], filename: str,
+                          tail_count=CONVERGENCE_TAIL_COUNT, converagnce_distance=CONVERGENCE_DISTANCE) -> dict:
     final_output = copy.deepcopy(addit_data)
-    final_output['filename'] = args.source.name
+    final_output['filename'] = filename
     monopoly_price = addit_data['monopoly_price']
 
     if not addit_data['failed']:
-
-        prices = []
-
-        final_100_attemps = market_history[-100:]
-        for attempt in final_100_attemps:
-            priced_products = attempt['priced_products']
-            assert len(priced_products) == 1, 'We only analyze monopoly experiments'
-            priced_product = priced_products[0]
-            price = priced_product['price']
-            prices.append(price)
-        
-        sorted_prices = sorted(prices)
+        sorted_prices = np.sort(prices)
         average_price_last_100 = np.average(prices)
 
         final_output['average_price_last_100'] = average_price_last_100
         converage_options = prices + [average_price_last_100]
 
-        converages = any(map(lambda x: check_converages_to(sorted_prices, x), converage_options))
+        conv_num = best_converagence_option(sorted_prices, converage_options, converagnce_distance, tail_count)
+        converages = conv_num is not None
         final_output['converages'] = converages
-        final_output['converages_to_monopoly'] = check_converages_to(sorted_prices, monopoly_price)
+        final_output['converages_to_monopoly'] = check_converages_to(sorted_prices, monopoly_price,
+                                                                     converagnce_distance, tail_count)
 
         final_output['converages_number'] = None
         final_output['converages_number_dist_to_mono'] = None
 
         if converages:
-            conv_num = best_converagence_option(sorted_prices, converage_options)
-            assert conv_num is not None, 'We should be "converaging" to something'
             final_output['converages_number'] = conv_num
             final_output['converages_number_dist_to_mono'] = np.abs(conv_num - monopoly_price) / monopoly_price
 
+    return final_output
+
+def analyze_prices(addit_data: dict, prices: List[float], filename: str, window=CONVERGENCE_WINDOW,
+                   tail_count=CONVERGENCE_TAIL_COUNT, converagnce_distance=CONVERGENCE_DISTANCE,
+                   trajectory=False) -> dict:
+    # Prices are the whole run in trajectory mode, otherwise only its window
+    final_output = analyze_window_prices(addit_data, prices[-window:], filename, tail_count, converagnce_distance)
+    if trajectory and not addit_data['failed']:
+        final_output.update(analyze_trajectory(prices, addit_data['monopoly_price'], window, converagnce_distance))
+    return final_output
+
+def analyze_market_data(raw_market_data: dict, filename: str, window=CONVERGENCE_WINDOW,
+                        tail_count=CONVERGENCE_TAIL_COUNT, converagnce_distance=CONVERGENCE_DISTANCE,
+                        trajectory=False) -> dict:
+    addit_data = raw_market_data['additional_context']
+    prices = []
+    if not addit_data['failed']:
+        market_history = raw_market_data['market_history']['past_iteration']
+        prices = extract_prices(market_history) if trajectory else extract_window_prices(market_history, window)
+    return analyze_prices(addit_data, prices, filename, window, tail_count, converagnce_distance, trajectory)
+
+def analyze_binary_result(path: Path, filename: str, window=CONVERGENCE_WINDOW,
+                          tail_count=CONVERGENCE_TAIL_COUNT, converagnce_distance=CONVERGENCE_DISTANCE,
+                          trajectory=False) -> dict:
+    addit_data, prices = load_binary_window_prices(path, None if trajectory else window)
+    return analyze_prices(addit_data, prices, filename, window, tail_count, converagnce_distance, trajectory)
 
-    print(json.dumps(final_output))
+def get_convergence_parameters(args) -> dict:
+    parameters = {'window': args.window, 'tail_count': args.tail_count, 'converagnce_distance': args.tolerance}
+    # Only set when used, so indexes from before trajectory mode stay valid
+    if args.trajectory:
+        parameters['trajectory'] = True
+    return parameters
+
+def output_json(args, raw_market_data: dict):
+    print(json.dumps(analyze_market_data(raw_market_data, args.source.name, **get_convergence_parameters(args))))
+
+RESULT_FILE_PATTERNS = ['market_history_*.json', 'market_history_*' + BINARY_RESULT_SUFFIX]
+
+def expand_batch_sources(patterns: List[str]) -> List[str]:
+    paths = set()
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            for file_pattern in RESULT_FILE_PATTERNS:
+                paths.update(str(path) for path in Path(pattern).rglob(file_pattern))
+        else:
+            paths.update(path for path in glob.glob(pattern, recursive=True) if os.path.isfile(path))
+    return sorted(paths)
+
+def analyze_file(task: Tuple[str, Optional[str], dict]) -> Tuple[str, float, str, Optional[dict], Optional[str]]:
+    path, previous_hash, parameters = task
+    mtime = os.stat(path).st_mtime
+    with open(path, 'rb') as f:
+        raw = f.read()
+    file_hash = hashlib.sha256(raw).hexdigest()
+    if file_hash == previous_hash:
+        return path, mtime, file_hash, None, None
+    try:
+        if raw.startswith(BINARY_RESULT_MAGIC):
+            return path, mtime, file_hash, analyze_binary_result(Path(path), path, **parameters), None
+        return path, mtime, file_hash, analyze_market_data(json.loads(raw), path, **parameters), None
+    except Exception as e:
+        return path, mtime, file_hash, None, repr(e)
+
+def load_index(index_path: Path, parameters: dict) -> Dict[str, dict]:
+    if not index_path.exists():
+        return {}
+    with open(index_path, 'r') as f:
+        index = json.load(f)
+    # Records analyzed with other convergence parameters can't be reused
+    if index.get('parameters') != parameters:
+        return {}
+    return index['files']
+
+def save_index(index_path: Path, index: Dict[str, dict], parameters: dict):
+    temp_path = index_path.with_name(index_path.name + '.tmp')
+    with open(temp_path, 'w') as f:
+        json.dump({'parameters': parameters, 'files': index}, f)
+    os.replace(temp_path, index_path)
+
+def write_table(output_path: Path, records: List[dict]):
+    if output_path.suffix == '.csv':
+        fields: Dict[str, None] = {}
+        for record in records:
+            fields.update(dict.fromkeys(record.keys()))
+        with open(output_path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=list(fields.keys()))
+            writer.writeheader()
+            for record in records:
+                writer.writerow({key: json.dumps(value) if isinstance(value, (dict, list)) else value
+                                 for key, value in record.items()})
+    else:
+        with open(output_path, 'w') as f:
+            for record in records:
+                f.write(json.dumps(record) + '\n')
+
+def run_batch(args):
+    assert args.output is not None, 'Batch mode requires --output'
+    assert args.workers > 0, 'Need at least one worker'
+    output_path = Path(args.output)
+    index_path = Path(args.index) if args.index is not None else output_path.with_name(output_path.name + '.index.json')
+    parameters = get_convergence_parameters(args)
+    index = load_index(index_path, parameters)
+
+    paths = expand_batch_sources(args.batch)
+    tasks = []
+    for path in paths:
+        known = index.get(path)
+        if known is not None and known['mtime'] == os.stat(path).st_mtime:
+            continue
+        tasks.append((path, known['sha256'] if known is not None else None, parameters))
+
+    failures = 0
+    unchanged = 0
+    if len(tasks) > 0:
+        with ProcessPoolExecutor(max_workers=min(args.workers, len(tasks))) as executor:
+            for path, mtime, file_hash, record, error in executor.map(analyze_file, tasks,
+                                                                    chunksize=max(1, len(tasks) // (4 * args.workers))):
+                if error is not None:
+                    failures += 1
+                    print('Failed analyzing %s: %s' % (path, error), file=sys.stderr)
+                    continue
+                if record is None:
+                    unchanged += 1
+                    index[path]['mtime'] = mtime
+                    continue
+                index[path] = {'mtime': mtime, 'sha256': file_hash, 'record': record}
+
+    records = [index[path]['record'] for path in paths if path in index]
+    write_table(output_path, records)
+    save_index(index_path, index, parameters)
+    print('Analyzed %d of %d files (%d failed), wrote %d records to %s' % (len(tasks) - failures - unchanged,
+                                                                        len(paths), failures, len(records),
+                                                                        output_path),
+          file=sys.stderr)
 
 def main():
     arguments = get_arguments()
-    data = json.load(arguments.source)
-    
-    if arguments.json_mode:
-        output_json(arguments, data)
+    if arguments.batch is not None:
+        run_batch(arguments)
         return
-    
-    addit_data = data['additional_context']
-    market_history = data['market_history']['past_iteration']
+
+    source_path = Path(arguments.source.name)
+    if is_binary_result(source_path):
+        addit_data, prices = load_binary_window_prices(source_path, None if arguments.trajectory else arguments.window)
+        if arguments.json_mode:
+            print(json.dumps(analyze_prices(addit_data, prices, arguments.source.name,
+                                            **get_convergence_parameters(arguments))))
+            return
+    else:
+        data = json.load(arguments.source)
+
+        if arguments.json_mode:
+            output_json(arguments, data)
+            return
+
+        addit_data = data['additional_context']
+        prices = extract_prices(data['market_history']['past_iteration'])
+    window_prices = prices[-arguments.window:]
     
     print('Used model: %s' % addit_data['used_model'])
     print('Total time: %.2f seconds' % addit_data['total_time'])
@@ -110,22 +349,22 @@ def main():
     monopoly_price = addit_data['monopoly_price']
     print('monopoly price: %.2f' % monopoly_price)
 
-    prices = []
+    converages, _ = analyze_convergence([window_prices], arguments.tolerance, arguments.tail_count)
 
-    final_100_attemps = market_history[-100:]
-    for attempt in final_100_attemps:
-        priced_products = attempt['priced_products']
-        assert len(priced_products) == 1, 'We only analyze monopoly experiments'
-        priced_product = priced_products[0]
-        price = priced_product['price']
-        prices.append(price)
-    
-    sorted_prices = sorted(prices)
+    print('Average price: %.2f$' % np.average(window_prices))
+    print('Converges to anything:', bool(converages[0]))
+    print('Converges to monopoly:', check_converages_to(np.sort(window_prices), monopoly_price,
+                                                          arguments.tolerance, arguments.tail_count))
 
-    print('Average price: %.2f$' % np.average(prices))
-    converages = any(map(lambda x: check_converages_to(sorted_prices, x), prices + [np.average(prices)]))
-    print('Converges to anything:', converages)
-    print('Converges to monopoly:', check_converages_to(sorted_prices, monopoly_price))
+    if arguments.trajectory:
+        trajectory = analyze_trajectory(prices, monopoly_price, arguments.window, arguments.tolerance)
+        print('Converged at round:', trajectory['time_to_convergence'])
+        print('Converged to monopoly at round:', trajectory['time_to_monopoly_convergence'])
+        print('Convergence episodes:', trajectory['convergence_episodes'])
+        print('Ends converged:', trajectory['ends_converged'])
+        if len(prices) > 0:
+            print('Rounds converged: %.2f%%' % (100 * trajectory['converged_rounds_fraction']))
+            print('Rounds near the monopoly price: %.2f%%' % (100 * trajectory['monopoly_rounds_fraction']))
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
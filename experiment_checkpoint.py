@@ -0,0 +1,84 @@
+from dataclasses import dataclass, field
+import json
+import os
+from pathlib import Path
+from typing import List, Optional
+
+from logger import get_logger
+from market_history import MarketIteration
+
+CHECKPOINT_SUFFIX = '.checkpoint.jsonl'
+
+def checkpoint_path_for(result_path: Path) -> Path:
+    return result_path.with_name(result_path.stem + CHECKPOINT_SUFFIX)
+
+@dataclass
+class Checkpoint:
+    header: dict
+    rounds: List[dict] = field(default_factory=list)
+
+    @property
+    def completed_rounds(self) -> int:
+        return len(self.rounds)
+
+    @property
+    def last_round(self) -> Optional[dict]:
+        return self.rounds[-1] if len(self.rounds) > 0 else None
+
+class CheckpointWriter:
+    def __init__(self, path: Path, header: dict, rounds: List[dict] = []):
+        # Resumed runs rewrite the rounds they continue from, dropping any line cut short by a crash.
+        # The rewrite goes through a temporary file so a crash meanwhile keeps the old checkpoint.
+        self.path = path
+        temp_path = path.with_name(path.name + '.tmp')
+        with open(temp_path, 'w') as f:
+            f.write(json.dumps({'type': 'header', **header}) + '\n')
+            for record in rounds:
+                f.write(json.dumps({'type': 'round', **record}) + '\n')
+        os.replace(temp_path, path)
+        self._file = open(path, 'a')
+
+    def _write(self, record: dict):
+        self._file.write(json.dumps(record) + '\n')
+        self._file.flush()
+
+    def write_round(self, round_index: int, market_iteration: MarketIteration, context: dict,
+                    total_exceptions: int, tooling_info: dict, elapsed_time: float,
+                    retry_stats: Optional[dict] = None, metrics: Optional[dict] = None):
+        self._write({'type': 'round',
+                     'round': round_index,
+                     'priced_products': [{'firm_id': priced_product.firm_id,
+                                          'price': priced_product.price,
+                                          'quantity_sold': priced_product.quantity_sold,
+                                          'profit': priced_product.profit}
+                                         for priced_product in market_iteration.priced_products],
+                     'context': context,
+                     'total_exceptions': total_exceptions,
+                     'tooling_info': tooling_info,
+                     'elapsed_time': elapsed_time,
+                     'retry_stats': retry_stats,
+                     'metrics': metrics})
+
+    def close(self):
+        self._file.close()
+
+def load_checkpoint(path: Path) -> Checkpoint:
+    with open(path, 'r') as f:
+        lines = f.readlines()
+    assert len(lines) > 0, 'Empty checkpoint %s' % path
+
+    header = json.loads(lines[0])
+    assert header.pop('type') == 'header', 'Checkpoint %s doesn\'t start with a header' % path
+    checkpoint = Checkpoint(header=header)
+    for line_number, line in enumerate(lines[1:], start=2):
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError:
+            # Only the final line can be cut short by a crash mid-write
+            assert line_number == len(lines), 'Corrupted checkpoint %s at line %d' % (path, line_number)
+            get_logger().warning('Dropping truncated final line of checkpoint %s', path)
+            break
+        assert record.pop('type') == 'round', 'Unexpected checkpoint record at line %d' % line_number
+        assert record['round'] == checkpoint.completed_rounds, 'Missing rounds in checkpoint %s' % path
+        checkpoint.rounds.append(record)
+    return checkpoint
@@ -0,0 +1,66 @@
+from dataclasses import asdict, dataclass, field, replace
+from enum import Enum, auto
+import logging
+from typing import Optional, Union
+
+from early_stopping import EarlyStoppingPolicy
+from logger import get_experiment_logger, get_logger
+from market_simulation import PricingTimeoutPolicy
+
+DEFAULT_ROUND_MEMORY = 100
+LLM_RETRY_COUNT = 10
+
+class RetryStrategy(Enum):
+    RESAMPLE = auto()
+    REPAIR = auto()
+
+@dataclass(frozen=True)
+class RetryPolicy:
+    max_attempts: int = LLM_RETRY_COUNT
+    strategy: RetryStrategy = RetryStrategy.RESAMPLE
+    backoff_seconds: float = 0
+    backoff_multiplier: float = 2
+    max_backoff_seconds: float = 30
+
+    def __post_init__(self):
+        assert self.max_attempts > 0, 'Need at least one attempt'
+        assert self.backoff_seconds >= 0, 'Retry backoff can\'t be negative'
+        assert self.backoff_multiplier >= 1, 'Retry backoff multiplier must be at least 1'
+        assert self.max_backoff_seconds >= 0, 'Retry backoff cap can\'t be negative'
+
+    def backoff(self, attempt: int) -> float:
+        return min(self.max_backoff_seconds, self.backoff_seconds * self.backoff_multiplier ** attempt)
+
+    def to_dict(self) -> dict:
+        return {**asdict(self), 'strategy': self.strategy.name.lower()}
+
+@dataclass
+class ToolingCounters:
+    expr_hit_count: int = 0
+    invalid_expr_hit_count: int = 0
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+@dataclass
+class ExperimentConfig:
+    # Everything an experiment used to read from module globals, so experiments sharing a process don't
+    # see each other's settings. The agent, the prompt generators and the text generator all get it from here.
+    model: str
+    use_tooling: bool = False
+    add_example: bool = False
+    round_memory: int = DEFAULT_ROUND_MEMORY
+    compact_history: bool = False
+    pricing_timeout: PricingTimeoutPolicy = PricingTimeoutPolicy()
+    retry_policy: RetryPolicy = RetryPolicy()
+    early_stopping: Optional[EarlyStoppingPolicy] = None
+    tooling: ToolingCounters = field(default_factory=ToolingCounters)
+    logger: Union[logging.Logger, logging.LoggerAdapter] = field(default_factory=get_logger, repr=False)
+
+    def __post_init__(self):
+        assert self.round_memory >= 0, 'Can\'t have a negative round memory'
+        assert not self.compact_history or self.round_memory > 0, 'Compact history needs a positive round memory'
+
+    def for_experiment(self, model: str, label: str) -> 'ExperimentConfig':
+        # Same settings with fresh counters and a logger tagged with the experiment
+        return replace(self, model=model, tooling=ToolingCounters(), logger=get_experiment_logger(label))
@@ -0,0 +1,368 @@
+import ast
+from dataclasses import dataclass
+from functools import lru_cache
+import math
+import multiprocessing
+from multiprocessing.connection import Connection
+import numpy as np
+import sys
+import threading
+import time
+from types import CodeType, SimpleNamespace
+from typing import Any, Callable, Dict, FrozenSet, Optional, Tuple
+
+from market_history import MarketHistory
+
+class ExpressionError(ValueError):
+    pass
+
+class ExpressionLimitError(ExpressionError):
+    pass
+
+@dataclass(frozen=True)
+class ExpressionLimits:
+    max_seconds: float = 1.0
+    max_steps: int = 1_000_000
+    max_elements: int = 1_000_000
+    max_int_bits: int = 64 * 1024
+    max_polyfit_degree: int = 5
+    # Address space the sandbox process may grow by, on top of what it uses after starting
+    max_memory_bytes: int = 256 * 1024 * 1024
+
+DEFAULT_LIMITS = ExpressionLimits()
+MAX_EXPRESSION_LENGTH = 2000
+MAX_EXPRESSION_NODES = 256
+TIME_CHECK_INTERVAL = 1024
+# Extra seconds the sandbox gets for moving the variables and the result through the pipe
+SANDBOX_GRACE_SECONDS = 1.0
+
+_ALLOWED_NODES = (
+    ast.Expression, ast.BoolOp, ast.BinOp, ast.UnaryOp, ast.Compare, ast.IfExp, ast.Call, ast.keyword,
+    ast.Constant, ast.Name, ast.Attribute, ast.Subscript, ast.Slice, ast.List, ast.Tuple, ast.Dict, ast.Set,
+    ast.ListComp, ast.SetComp, ast.DictComp, ast.GeneratorExp, ast.comprehension, ast.Lambda, ast.arguments,
+    ast.arg, ast.expr_context, ast.operator, ast.unaryop, ast.cmpop, ast.boolop,
+)
+
+class LazyValue:
+    # Only built when the expression references the variable
+    def __init__(self, factory: Callable[[], Any]):
+        self.factory = factory
+
+def _read_only(array: np.ndarray) -> np.ndarray:
+    view = array.view()
+    view.flags.writeable = False
+    return view
+
+def _check_elements(count: int, limits: ExpressionLimits):
+    if count > limits.max_elements:
+        raise ExpressionLimitError('Result would hold %d elements (limit %d)' % (count, limits.max_elements))
+
+_CONTAINER_TYPES = frozenset({np.ndarray, str, bytes, dict, list, tuple, set, frozenset})
+
+def _count_elements(value: Any, limits: ExpressionLimits) -> int:
+    # Nested containers count every element they reach, shared ones every time. Stops once over the limit,
+    # so checking a huge value costs at most max_elements steps.
+    if isinstance(value, np.ndarray):
+        return value.size
+    if isinstance(value, (str, bytes)):
+        return len(value)
+    if isinstance(value, dict):
+        value = list(value.items())
+    elif not isinstance(value, (list, tuple, set, frozenset)):
+        return 1
+    count = len(value)
+    for item in value:
+        if count > limits.max_elements:
+            break
+        if type(item) in _CONTAINER_TYPES:
+            count += _count_elements(item, limits)
+    return count
+
+def _guard_builtin(function: Callable, limits: ExpressionLimits) -> Callable:
+    # C builtins run without the tracer seeing them, so their inputs and outputs are size checked instead
+    def guarded(*args, **kwargs):
+        for arg in args:
+            _check_elements(_count_elements(arg, limits), limits)
+        result = function(*args, **kwargs)
+        _check_elements(_count_elements(result, limits), limits)
+        return result
+    return guarded
+
+# The size checks are ours, their lines don't count against the expression's steps
+_UNTRACED_CODE = frozenset({_count_elements.__code__, _guard_builtin(abs, DEFAULT_LIMITS).__code__})
+
+def _make_guards(limits: ExpressionLimits) -> Dict[str, Callable]:
+    def safe_pow(base, exponent):
+        if isinstance(base, int) and isinstance(exponent, int) and abs(base) > 1 and exponent > 0:
+            if exponent * math.log2(abs(base)) > limits.max_int_bits:
+                raise ExpressionLimitError('Power result too large')
+        return base ** exponent
+
+    def safe_mul(left, right):
+        for sequence, count in ((left, right), (right, left)):
+            if isinstance(sequence, (str, list, tuple)) and isinstance(count, int):
+                _check_elements(len(sequence) * count, limits)
+        return left * right
+
+    def safe_lshift(left, right):
+        if isinstance(left, int) and isinstance(right, int) and right > limits.max_int_bits:
+            raise ExpressionLimitError('Shift result too large')
+        return left << right
+
+    def safe_range(*args):
+        values = range(*args)
+        _check_elements(len(values), limits)
+        return values
+
+    def polyfit(x, y, deg=1):
+        if deg > limits.max_polyfit_degree:
+            raise ExpressionLimitError('Polynomial degree above %d' % limits.max_polyfit_degree)
+        return np.polyfit(x, y, deg)
+
+    def arange(*args):
+        values = np.arange(*args)
+        _check_elements(values.size, limits)
+        return values
+
+    return {'_safe_pow': safe_pow, '_safe_mul': safe_mul, '_safe_lshift': safe_lshift,
+            'range': safe_range, 'polyfit': polyfit, 'arange': arange}
+
+_NUMPY_HELPERS = {
+    'mean': np.mean, 'median': np.median, 'std': np.std, 'var': np.var, 'argmax': np.argmax, 'argmin': np.argmin,
+    'argsort': np.argsort, 'percentile': np.percentile, 'cumsum': np.cumsum, 'diff': np.diff, 'where': np.where,
+    'clip': np.clip, 'maximum': np.maximum, 'minimum': np.minimum, 'unique': np.unique, 'corrcoef': np.corrcoef,
+    'polyval': np.polyval, 'log': np.log, 'exp': np.exp, 'sqrt': np.sqrt, 'array': np.asarray, 'nan': np.nan,
+}
+_MATH_HELPERS = {name: getattr(math, name) for name in ('log', 'exp', 'sqrt', 'floor', 'ceil', 'pi', 'e', 'isclose')}
+_SAFE_BUILTINS = {
+    'abs': abs, 'min': min, 'max': max, 'sum': sum, 'len': len, 'round': round, 'sorted': sorted,
+    'enumerate': enumerate, 'zip': zip, 'list': list, 'tuple': tuple, 'dict': dict, 'set': set, 'float': float,
+    'int': int, 'bool': bool, 'str': str, 'any': any, 'all': all, 'map': map, 'filter': filter, 'reversed': reversed,
+    'True': True, 'False': False, 'None': None,
+    # NumPy imports helper modules lazily from C, which looks up __import__ in the calling frame's builtins.
+    # Expressions can't reach it since underscore names are rejected.
+    '__import__': __import__,
+}
+# Builtins that walk or copy their whole input in C
+_SIZED_BUILTINS = ('str', 'sorted', 'sum', 'min', 'max', 'any', 'all', 'list', 'tuple', 'dict', 'set')
+_SAFE_ATTRIBUTES = frozenset(_NUMPY_HELPERS) | frozenset(_MATH_HELPERS) | {
+    'polyfit', 'arange', 'sum', 'max', 'min', 'tolist', 'shape', 'size', 'round', 'item', 'keys', 'values',
+    'items', 'get', 'count', 'index', 'real', 'imag', 'ndim', 'T',
+}
+
+class _GuardOperators(ast.NodeTransformer):
+    _GUARDED = {ast.Pow: '_safe_pow', ast.Mult: '_safe_mul', ast.LShift: '_safe_lshift'}
+
+    def visit_BinOp(self, node: ast.BinOp) -> ast.AST:
+        self.generic_visit(node)
+        guard = self._GUARDED.get(type(node.op))
+        if guard is None:
+            return node
+        return ast.copy_location(ast.Call(func=ast.Name(id=guard, ctx=ast.Load()),
+                                          args=[node.left, node.right], keywords=[]), node)
+
+def _validate(tree: ast.AST):
+    node_count = 0
+    for node in ast.walk(tree):
+        node_count += 1
+        if not isinstance(node, _ALLOWED_NODES):
+            raise ExpressionError('%s is not allowed in expressions' % type(node).__name__)
+        if isinstance(node, ast.Name) and node.id.startswith('_'):
+            raise ExpressionError('Name %s is not allowed' % node.id)
+        if isinstance(node, ast.Attribute) and node.attr not in _SAFE_ATTRIBUTES:
+            raise ExpressionError('Attribute %s is not allowed' % node.attr)
+        if isinstance(node, ast.arg) and node.arg.startswith('_'):
+            raise ExpressionError('Argument %s is not allowed' % node.arg)
+    if node_count > MAX_EXPRESSION_NODES:
+        raise ExpressionError('Expression too complex (%d nodes)' % node_count)
+
+@lru_cache(maxsize=512)
+def compile_expression(expr: str) -> Tuple[CodeType, FrozenSet[str]]:
+    if len(expr) > MAX_EXPRESSION_LENGTH:
+        raise ExpressionError('Expression longer than %d characters' % MAX_EXPRESSION_LENGTH)
+    try:
+        tree = ast.parse(expr.strip(), mode='eval')
+    except SyntaxError as e:
+        raise ExpressionError('Invalid syntax: %s' % e.msg)
+    _validate(tree)
+    names = frozenset(node.id for node in ast.walk(tree) if isinstance(node, ast.Name))
+    tree = ast.fix_missing_locations(_GuardOperators().visit(tree))
+    return compile(tree, '<expr>', 'eval'), names
+
+def _run_limited(code: CodeType, namespace: Dict[str, Any], limits: ExpressionLimits) -> Any:
+    # Every Python level step of the expression (lambda calls, comprehension iterations)
+    # counts against the step budget, the wall clock is checked every few steps
+    deadline = time.perf_counter() + limits.max_seconds
+    steps = 0
+
+    def tracer(frame, event, arg):
+        nonlocal steps
+        steps += 1
+        if steps > limits.max_steps:
+            raise ExpressionLimitError('Expression exceeded %d steps' % limits.max_steps)
+        if steps % TIME_CHECK_INTERVAL == 0 and time.perf_counter() > deadline:
+            raise ExpressionLimitError('Expression exceeded %.2f seconds' % limits.max_seconds)
+        if event == 'call' and frame.f_code in _UNTRACED_CODE:
+            return None
+        return tracer
+
+    previous_tracer = sys.gettrace()
+    sys.settrace(tracer)
+    try:
+        return eval(code, namespace)
+    finally:
+        sys.settrace(previous_tracer)
+
+def evaluate_expression(expr: str, variables: Dict[str, Any], limits: ExpressionLimits = DEFAULT_LIMITS) -> Any:
+    code, names = compile_expression(expr)
+    builtins = dict(_SAFE_BUILTINS)
+    builtins.update({name: _guard_builtin(_SAFE_BUILTINS[name], limits) for name in _SIZED_BUILTINS})
+    namespace: Dict[str, Any] = {'__builtins__': builtins}
+    namespace.update(_NUMPY_HELPERS)
+    guards = _make_guards(limits)
+    guards['array'] = _guard_builtin(np.asarray, limits)
+    namespace.update(guards)
+    numpy_helpers = {**_NUMPY_HELPERS, 'array': guards['array']}
+    namespace['np'] = SimpleNamespace(**numpy_helpers, polyfit=guards['polyfit'], arange=guards['arange'])
+    namespace['math'] = SimpleNamespace(**_MATH_HELPERS)
+    for name, value in variables.items():
+        if isinstance(value, LazyValue):
+            if name not in names:
+                continue
+            value = value.factory()
+        namespace[name] = value
+    result = _run_limited(code, namespace, limits)
+    _check_elements(_count_elements(result, limits), limits)
+    return result
+
+def _limit_resources(limits: ExpressionLimits):
+    # Linux only, elsewhere the sandbox is only bound by the parent's timeout
+    try:
+        import resource
+        with open('/proc/self/statm', 'r') as f:
+            used_bytes = int(f.read().split()[0]) * resource.getpagesize()
+    except (ImportError, OSError):
+        return
+    _, hard = resource.getrlimit(resource.RLIMIT_AS)
+    resource.setrlimit(resource.RLIMIT_AS, (used_bytes + limits.max_memory_bytes, hard))
+
+def _limit_cpu(limits: ExpressionLimits):
+    # RLIMIT_CPU counts the whole life of the process, so every evaluation moves it past what was used so far
+    try:
+        import resource
+    except ImportError:
+        return
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+    soft = int(usage.ru_utime + usage.ru_stime + limits.max_seconds) + 1
+    if hard != resource.RLIM_INFINITY:
+        soft = min(soft, hard)
+    resource.setrlimit(resource.RLIMIT_CPU, (soft, hard))
+
+def _sandbox_worker(connection: Connection, limits: ExpressionLimits):
+    _limit_resources(limits)
+    connection.send('ready')
+    while True:
+        try:
+            expr, variables = connection.recv()
+        except EOFError:
+            return
+        _limit_cpu(limits)
+        try:
+            reply = ('result', evaluate_expression(expr, variables, limits))
+        except MemoryError:
+            reply = ('error', ExpressionLimitError('Expression exceeded %d bytes of memory' % limits.max_memory_bytes))
+        except Exception as e:
+            reply = ('error', e)
+        try:
+            connection.send(reply)
+        except Exception:
+            # Pickling failed before anything was written
+            connection.send(('error', ExpressionError('Result of type %s can\'t be returned' %
+                                                      type(reply[1]).__name__)))
+
+class ExpressionSandbox:
+    # Evaluates in a separate process with capped memory and CPU time, a process that overruns is
+    # killed and replaced by the next evaluation
+    def __init__(self, limits: ExpressionLimits = DEFAULT_LIMITS):
+        self.limits = limits
+        self._lock = threading.Lock()
+        self._process: Optional[multiprocessing.Process] = None
+        self._connection: Optional[Connection] = None
+
+    def _start(self):
+        # Spawned so the worker doesn't inherit the threads and locks of the experiment
+        context = multiprocessing.get_context('spawn')
+        connection, child_connection = context.Pipe()
+        process = context.Process(target=_sandbox_worker, args=(child_connection, self.limits),
+                                  name='expression-sandbox', daemon=True)
+        try:
+            process.start()
+        finally:
+            child_connection.close()
+        assert connection.recv() == 'ready', 'Expression sandbox failed to start'
+        self._process = process
+        self._connection = connection
+
+    def _kill(self):
+        self._process.kill()
+        self._process.join()
+        self._connection.close()
+        self._process = None
+        self._connection = None
+
+    def evaluate(self, expr: str, variables: Dict[str, Any]) -> Any:
+        # Compiled here too, so invalid expressions never reach the worker
+        _, names = compile_expression(expr)
+        resolved = {name: value.factory() if isinstance(value, LazyValue) else value
+                    for name, value in variables.items() if name in names}
+        with self._lock:
+            if self._process is None or not self._process.is_alive():
+                if self._process is not None:
+                    self._kill()
+                self._start()
+            self._connection.send((expr, resolved))
+            if not self._connection.poll(self.limits.max_seconds + SANDBOX_GRACE_SECONDS):
+                self._kill()
+                raise ExpressionLimitError('Expression exceeded %.2f seconds' % self.limits.max_seconds)
+            try:
+                status, value = self._connection.recv()
+            except EOFError:
+                self._kill()
+                raise ExpressionLimitError('Expression exceeded its memory or CPU limit')
+        if status == 'error':
+            raise value
+        return value
+
+    def close(self):
+        with self._lock:
+            if self._process is not None:
+                self._kill()
+
+_SANDBOX: Optional[ExpressionSandbox] = None
+_SANDBOX_LOCK = threading.Lock()
+
+def get_sandbox() -> ExpressionSandbox:
+    global _SANDBOX
+    with _SANDBOX_LOCK:
+        if _SANDBOX is None:
+            _SANDBOX = ExpressionSandbox()
+        return _SANDBOX
+
+def evaluate_expression_isolated(expr: str, variables: Dict[str, Any]) -> Any:
+    return get_sandbox().evaluate(expr, variables)
+
+def history_variables(market_history: MarketHistory, firm_id: int) -> Dict[str, Any]:
+    prices = _read_only(market_history.firm_prices(firm_id))
+    quantities = _read_only(market_history.firm_quantities_sold(firm_id))
+    profits = _read_only(market_history.firm_profits(firm_id))
+
+    def build_rows():
+        return [{'price': price, 'quanity_sold': quantity_sold, 'profit': profit}
+                for price, quantity_sold, profit in zip(prices.tolist(), quantities.tolist(), profits.tolist())]
+
+    return {'prices': prices,
+            'quantities': quantities,
+            'profits': profits,
+            'rounds': np.arange(1, prices.size + 1),
+            'market_history': LazyValue(build_rows)}
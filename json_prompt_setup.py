@@ -1,8 +1,8 @@
 from dataclasses import replace
 import json
 from typing import Tuple
-import regex
 
+from json_scanner import iter_json_objects
 from llm_pricing_agent import LLMPricingAgent
 from logger import get_logger
 from market_history import MarketHistory
@@ -12,14 +12,6 @@ from prompt_costs import OBJECTIVE_TASK, SECTION_DIVIDER, PRODUCT_INFORMATION, P
 from prompt_costs_jsons import FINAL_TASK as FINAL_TASK_JSON, FINAL_TASK_WITH_EXAMPLE as FINAL_TASK_JSON_WITH_EXAMPLE
 from simple_llm_context import LLMContext
 
-ADD_EXAMPLE = False
-def set_add_example(should_add: bool):
-    global ADD_EXAMPLE
-    ADD_EXAMPLE = should_add
-
-def has_examples() -> bool:
-    return ADD_EXAMPLE
-
 def generate_prompt_for_json(llm_model: LLMPricingAgent, market_history: MarketHistory, context: LLMContext) -> str:
     full_prompt = OBJECTIVE_TASK
 
@@ -40,24 +32,17 @@ def generate_prompt_for_json(llm_model: LLMPricingAgent, market_history: MarketH
     full_prompt += MARKET_DATA.format(market_data=generate_market_history(llm_model, market_history))
 
     full_prompt += SECTION_DIVIDER
-    full_prompt += FINAL_TASK_JSON_WITH_EXAMPLE if ADD_EXAMPLE else FINAL_TASK_JSON
-
-    get_logger().debug('Built Promt:')
-    get_logger().debug(full_prompt)
+    full_prompt += FINAL_TASK_JSON_WITH_EXAMPLE if llm_model.config.add_example else FINAL_TASK_JSON
 
     return full_prompt
 
-json_regex_finder = regex.compile(r'\{(?:[^{}]|(?R))*\}')
-
 def output_json_parser(prev_context: LLMContext, result: str) -> Tuple[float, LLMContext]:
-    get_logger().debug('Returned result')
-    get_logger().debug(result)
-
-    optional_results = json_regex_finder.findall(result)
-    assert len(optional_results) > 0, 'Agent didn\'t attach any json'
-
-    for option in optional_results:
-        get_logger().debug('Trying to analyaze:\n%s' % option)
+    found_any = False
+    error = "no JSON object with a 'my_price' key"
+    # The final answer usually comes last, after any echoed template or drafts
+    for option in iter_json_objects(result, reverse=True):
+        found_any = True
+        get_logger().debug('Trying to analyaze:\n%s', option)
         plans = None
         insights = None
         price = None
@@ -75,21 +60,26 @@ def output_json_parser(prev_context: LLMContext, result: str) -> Tuple[float, LL
             insights = parsed_result['insights.txt']
             price = parsed_result['my_price']
 
-            assert type(plans) == str
-            assert type(insights) == str
-            assert type(price) == int or type(price) == float
+            assert type(plans) == str, "'plans.txt' should be a string"
+            assert type(insights) == str, "'insights.txt' should be a string"
+            assert type(price) == int or type(price) == float, "'my_price' should be a number"
 
             break
-        except Exception:
-            plans = None
-            insights = None
-            price = None
-            get_logger().debug('Failed parsing json')
-
+        except json.JSONDecodeError as e:
+            error = "invalid JSON (%s)" % e.msg
+        except KeyError as e:
+            error = "missing %s key" % e
+        except AssertionError as e:
+            error = str(e)
+        except Exception as e:
+            error = "couldn't read the JSON object (%s)" % e
+        plans = None
+        insights = None
+        price = None
+        get_logger().debug('Failed parsing json')
 
-    assert plans != None, "Couldn't parse any plans"
-    assert insights != None, "Couldn't parse any insights"
-    assert price != None, "Couldn't parse any price"
+    assert found_any, "no JSON object found in the answer"
+    assert price != None, error
 
     get_logger().debug('Parsed plan:')
     get_logger().debug(plans)
@@ -0,0 +1,60 @@
+import re
+from typing import Iterator, List, Tuple
+
+# A brace, or a string up to its closing quote. JSON strings can't hold a raw newline, so one ends the string
+# too and a stray quote can't hide the rest of the answer.
+_TOKEN = re.compile(r'[{}]|"(?:[^"\\\n]|\\.)*')
+
+Span = Tuple[int, int]
+
+def _scan(text: str) -> Iterator[Tuple[bool, Span]]:
+    # One pass over the text, yields (final, span) for every outermost balanced {...}. Outermost pairs are
+    # final as soon as they close, pairs nested in a brace that never closes are only known to be outermost
+    # once the text ends, which matches what the recursive regex found. Quotes only start strings inside braces.
+    open_braces: List[int] = []
+    closed_children: List[List[Span]] = []
+    position = 0
+    while True:
+        if not open_braces:
+            i = text.find('{', position)
+            if i == -1:
+                break
+            open_braces.append(i)
+            closed_children.append([])
+            position = i + 1
+            continue
+        match = _TOKEN.search(text, position)
+        if match is None:
+            break
+        i = match.start()
+        char = text[i]
+        if char == '"':
+            position = match.end() + 1
+        elif char == '{':
+            open_braces.append(i)
+            closed_children.append([])
+            position = i + 1
+        else:
+            start = open_braces.pop()
+            closed_children.pop()
+            position = i + 1
+            if not open_braces:
+                yield True, (start, i + 1)
+            else:
+                closed_children[-1].append((start, i + 1))
+    for children in closed_children:
+        for span in children:
+            yield False, span
+
+def find_json_spans(text: str) -> List[Span]:
+    return sorted(span for _, span in _scan(text))
+
+def iter_json_objects(text: str, reverse: bool = False) -> Iterator[str]:
+    # Candidates are produced lazily, so callers that stop at the first valid object skip the rest of the scan.
+    # Going from the end needs the whole scan first, it is still a single linear pass.
+    if reverse:
+        for start, end in reversed(find_json_spans(text)):
+            yield text[start:end]
+        return
+    for _, (start, end) in _scan(text):
+        yield text[start:end]
@@ -10,14 +10,6 @@ from prompt_costs import OBJECTIVE_TASK, SECTION_DIVIDER, PRODUCT_INFORMATION, P
                     INSIGHT_CONTENT_INDICATOR, CHOSEN_PRICE_INDICATOR, FINAL_TASK_WITH_EXAMPLE
 from simple_llm_context import LLMContext
 
-ADD_EXAMPLE = False
-def set_add_example(should_add: bool):
-    global ADD_EXAMPLE
-    ADD_EXAMPLE = should_add
-    
-def has_examples() -> bool:
-    return ADD_EXAMPLE
-
 def generate_prompt(llm_model: LLMPricingAgent, market_history: MarketHistory, context: LLMContext) -> str:
     full_prompt = OBJECTIVE_TASK
 
@@ -38,26 +30,23 @@ def generate_prompt(llm_model: LLMPricingAgent, market_history: MarketHistory, c
     full_prompt += MARKET_DATA.format(market_data=generate_market_history(llm_model, market_history))
 
     full_prompt += SECTION_DIVIDER
-    full_prompt += FINAL_TASK_WITH_EXAMPLE if ADD_EXAMPLE else FINAL_TASK
-
-    get_logger().debug('Built Promt:')
-    get_logger().debug(full_prompt)
+    full_prompt += FINAL_TASK_WITH_EXAMPLE if llm_model.config.add_example else FINAL_TASK
 
     return full_prompt
 
 def output_parser(prev_context: LLMContext, result: str) -> Tuple[float, LLMContext]:
-    get_logger().debug('Returned result')
-    get_logger().debug(result)
-
     plan_location = result.find(PLAN_CONTENT_INDICATOR)
     insight_location = result.find(INSIGHT_CONTENT_INDICATOR)
     price_location = result.find(CHOSEN_PRICE_INDICATOR)
 
-    assert plan_location != -1, "Agent didn't attach a plan"
-    assert insight_location != -1, "Agent didn't attach insights"
-    assert price_location != -1, "Agent didn't attach a price"
+    assert plan_location != -1, "missing the '%s' section" % PLAN_CONTENT_INDICATOR
+    assert insight_location != -1, "missing the '%s' section" % INSIGHT_CONTENT_INDICATOR
+    assert price_location != -1, "missing the '%s' section" % CHOSEN_PRICE_INDICATOR
 
-    assert plan_location < insight_location < price_location, "Agent out of order"
+    assert plan_location < insight_location < price_location, \
+        "sections out of order, expected '%s', then '%s', then '%s'" % (PLAN_CONTENT_INDICATOR,
+                                                                       INSIGHT_CONTENT_INDICATOR,
+                                                                       CHOSEN_PRICE_INDICATOR)
 
     plan = result[plan_location + len(PLAN_CONTENT_INDICATOR):insight_location].strip()
     insights = result[insight_location + len(INSIGHT_CONTENT_INDICATOR):price_location].strip()
@@ -71,6 +60,9 @@ def output_parser(prev_context: LLMContext, result: str) -> Tuple[float, LLMCont
     get_logger().debug(price_str)
 
     price_strip_dollar = price_str.replace('$', '')
-    price = float(price_strip_dollar)
+    try:
+        price = float(price_strip_dollar)
+    except ValueError:
+        raise ValueError("the chosen price should be just a number, got %r" % price_str[:40])
 
     return price, replace(prev_context, plans=plan,insights=insights)
\ No newline at end of file
@@ -0,0 +1,318 @@
+import abc
+import argparse
+import asyncio
+from dataclasses import dataclass
+import hashlib
+import json
+import math
+import random
+import re
+import threading
+import time
+from typing import TYPE_CHECKING, Callable, Dict, Optional
+
+if TYPE_CHECKING:
+    from http.server import ThreadingHTTPServer
+
+@dataclass
+class Completion:
+    content: str
+    prompt_tokens: int
+    completion_tokens: int
+
+class RateLimitedError(RuntimeError):
+    pass
+
+class LLMBackend(abc.ABC):
+    @abc.abstractmethod
+    def complete(self, request: dict) -> Completion:
+        pass
+
+    async def complete_async(self, request: dict) -> Completion:
+        # Backends without a native async client block in a thread, not on the loop every experiment shares
+        return await asyncio.to_thread(self.complete, request)
+
+class TogetherBackend(LLMBackend):
+    # together and its clients are loaded on the first request, so a missing API key only fails runs that
+    # query the API. All experiments of a process share the clients. base_url can point at any OpenAI compatible server.
+    def __init__(self, base_url: Optional[str] = None):
+        self.base_url = base_url
+        self._client = None
+        self._async_client = None
+        self._lock = threading.Lock()
+
+    def _get_client(self):
+        # Firms of a round price from several threads, only one of them may create the client
+        with self._lock:
+            if self._client is None:
+                from together import Together
+                self._client = Together(base_url=self.base_url)
+            return self._client
+
+    def _get_async_client(self):
+        with self._lock:
+            if self._async_client is None:
+                from together import AsyncTogether
+                self._async_client = AsyncTogether(base_url=self.base_url)
+            return self._async_client
+
+    @staticmethod
+    def _to_completion(response) -> Completion:
+        usage = getattr(response, 'usage', None)
+        return Completion(content=response.choices[0].message.content,
+                          prompt_tokens=getattr(usage, 'prompt_tokens', None) or 0,
+                          completion_tokens=getattr(usage, 'completion_tokens', None) or 0)
+
+    def complete(self, request: dict) -> Completion:
+        return self._to_completion(self._get_client().chat.completions.create(**request))
+
+    async def complete_async(self, request: dict) -> Completion:
+        return self._to_completion(await self._get_async_client().chat.completions.create(**request))
+
+@dataclass
+class PricingPrompt:
+    cost: float
+    max_pay: float
+    last_price: Optional[float]
+    json_mode: bool
+
+_COST_PATTERN = re.compile(r'cost I pay to produce each unit is \$([0-9.]+)')
+_MAX_PAY_PATTERN = re.compile(r'No customer would pay more than \$([0-9.]+)')
+_LAST_PRICE_PATTERN = re.compile(r'My Price: ([0-9.]+)')
+
+def parse_pricing_prompt(prompt: str) -> PricingPrompt:
+    cost = _COST_PATTERN.search(prompt)
+    max_pay = _MAX_PAY_PATTERN.search(prompt)
+    last_prices = _LAST_PRICE_PATTERN.findall(prompt)
+    return PricingPrompt(cost=float(cost.group(1).rstrip('.')) if cost is not None else 1.0,
+                         max_pay=float(max_pay.group(1).rstrip('.')) if max_pay is not None else 10.0,
+                         last_price=float(last_prices[-1]) if len(last_prices) > 0 else None,
+                         json_mode='"my_price"' in prompt)
+
+@dataclass(frozen=True)
+class LocalBackendConfig:
+    policy: str = 'anchor'
+    markup: float = 1.0
+    step: float = 0.05
+    latency_distribution: str = 'constant'
+    latency_mean: float = 0.0
+    latency_sigma: float = 0.5
+    malformed_rate: float = 0.0
+    rate_limit_rate: float = 0.0
+    seed: int = 0
+
+PricingPolicy = Callable[[LocalBackendConfig, PricingPrompt, random.Random], float]
+
+def markup_policy(config: LocalBackendConfig, prompt: PricingPrompt, rng: random.Random) -> float:
+    return prompt.cost * (1 + config.markup)
+
+def random_policy(config: LocalBackendConfig, prompt: PricingPrompt, rng: random.Random) -> float:
+    return rng.uniform(prompt.cost, prompt.max_pay)
+
+def anchor_policy(config: LocalBackendConfig, prompt: PricingPrompt, rng: random.Random) -> float:
+    # A random walk from the last price, starting from the markup price
+    if prompt.last_price is None:
+        return markup_policy(config, prompt, rng)
+    price = prompt.last_price * math.exp(rng.gauss(0, config.step))
+    return min(max(price, prompt.cost), prompt.max_pay)
+
+PRICING_POLICIES: Dict[str, PricingPolicy] = {
+    'markup': markup_policy,
+    'random': random_policy,
+    'anchor': anchor_policy,
+}
+
+def sample_latency(config: LocalBackendConfig, rng: random.Random) -> float:
+    mean = config.latency_mean
+    if mean <= 0:
+        return 0.0
+    if config.latency_distribution == 'constant':
+        return mean
+    if config.latency_distribution == 'uniform':
+        return rng.uniform(0, 2 * mean)
+    if config.latency_distribution == 'exponential':
+        return rng.expovariate(1 / mean)
+    if config.latency_distribution == 'lognormal':
+        # Parameterized so the mean stays at latency_mean
+        return rng.lognormvariate(math.log(mean) - config.latency_sigma ** 2 / 2, config.latency_sigma)
+    raise RuntimeError('Unknown latency distribution %s' % config.latency_distribution)
+
+LATENCY_DISTRIBUTIONS = ['constant', 'uniform', 'exponential', 'lognormal']
+
+def well_formed_answer(prompt: PricingPrompt, price: float) -> str:
+    plans = 'Keep exploring prices around %.2f' % price
+    insights = 'Last price seen was %s' % ('%.2f' % prompt.last_price if prompt.last_price is not None else 'none')
+    if prompt.json_mode:
+        return 'My observations and thoughts:\nLocal stand-in answer.\nMy final answer:\n' + \
+            json.dumps({'plans.txt': plans, 'insights.txt': insights, 'my_price': round(price, 2)}, indent=4)
+    return ('My observations and thoughts:\nLocal stand-in answer.\n'
+            'New content for PLANS.txt:\n%s\nNew content for INSIGHTS.txt:\n%s\nMy chosen price:\n%.2f'
+            % (plans, insights, price))
+
+def malformed_answer(prompt: PricingPrompt, price: float, rng: random.Random) -> str:
+    answer = well_formed_answer(prompt, price)
+    kind = rng.choice(['truncated', 'no_price', 'prose_price'])
+    if kind == 'truncated':
+        return answer[:len(answer) // 2]
+    if kind == 'no_price':
+        return answer.replace('my_price', 'price').replace('My chosen price:', 'Price:')
+    return answer.replace('%.2f' % price, 'about %.2f dollars' % price)
+
+def estimate_tokens(text: str) -> int:
+    return max(1, len(text) // 4)
+
+class LocalBackend(LLMBackend):
+    # Answers are a pure function of the seed, the request and how many times that exact request was made,
+    # so a run is reproducible no matter how concurrent experiments interleave.
+    def __init__(self, config: LocalBackendConfig = LocalBackendConfig()):
+        assert config.policy in PRICING_POLICIES, 'Unknown pricing policy %s' % config.policy
+        assert config.latency_distribution in LATENCY_DISTRIBUTIONS, \
+            'Unknown latency distribution %s' % config.latency_distribution
+        self.config = config
+        self._request_counts: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def _rng(self, request: dict) -> random.Random:
+        encoded = json.dumps(request['messages'], sort_keys=True).encode('utf-8')
+        key = hashlib.sha256(encoded).hexdigest()
+        with self._lock:
+            count = self._request_counts.get(key, 0)
+            self._request_counts[key] = count + 1
+        seed = hashlib.sha256(('%d:%s:%d' % (self.config.seed, key, count)).encode('utf-8')).digest()
+        return random.Random(seed)
+
+    def _answer(self, request: dict, rng: random.Random) -> Completion:
+        if rng.random() < self.config.rate_limit_rate:
+            raise RateLimitedError('Local backend rate limited the request')
+        messages = request['messages']
+        prompt_text = next(message['content'] for message in messages if message['role'] == 'user')
+        prompt = parse_pricing_prompt(prompt_text)
+        price = PRICING_POLICIES[self.config.policy](self.config, prompt, rng)
+        if rng.random() < self.config.malformed_rate:
+            content = malformed_answer(prompt, price, rng)
+        else:
+            content = well_formed_answer(prompt, price)
+        return Completion(content=content,
+                          prompt_tokens=sum(estimate_tokens(message['content']) for message in messages),
+                          completion_tokens=estimate_tokens(content))
+
+    def complete(self, request: dict) -> Completion:
+        rng = self._rng(request)
+        time.sleep(sample_latency(self.config, rng))
+        return self._answer(request, rng)
+
+    async def complete_async(self, request: dict) -> Completion:
+        rng = self._rng(request)
+        await asyncio.sleep(sample_latency(self.config, rng))
+        return self._answer(request, rng)
+
+def make_completion_handler(backend: LLMBackend):
+    # Only the stand-in server needs http.server, it is imported here to keep it out of experiment startup
+    from http.server import BaseHTTPRequestHandler
+
+    class CompletionHandler(BaseHTTPRequestHandler):
+        def _reply(self, status: int, body: dict):
+            encoded = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(encoded)))
+            self.end_headers()
+            self.wfile.write(encoded)
+
+        def do_POST(self):
+            if not self.path.rstrip('/').endswith('/chat/completions'):
+                self._reply(404, {'error': {'message': 'Unknown path %s' % self.path}})
+                return
+            request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            try:
+                completion = backend.complete(request)
+            except RateLimitedError as e:
+                self._reply(429, {'error': {'message': str(e), 'type': 'rate_limit_exceeded'}})
+                return
+            self._reply(200, {
+                'id': 'local-%d' % time.time_ns(),
+                'object': 'chat.completion',
+                'created': int(time.time()),
+                'model': request.get('model'),
+                'choices': [{'index': 0,
+                             'message': {'role': 'assistant', 'content': completion.content},
+                             'finish_reason': 'stop'}],
+                'usage': {'prompt_tokens': completion.prompt_tokens,
+                          'completion_tokens': completion.completion_tokens,
+                          'total_tokens': completion.prompt_tokens + completion.completion_tokens},
+            })
+
+        def log_message(self, format, *args):
+            pass
+
+    return CompletionHandler
+
+def serve_openai_compatible(backend: LLMBackend, host: str, port: int) -> 'ThreadingHTTPServer':
+    from http.server import ThreadingHTTPServer
+    return ThreadingHTTPServer((host, port), make_completion_handler(backend))
+
+def add_local_backend_args(parser: argparse.ArgumentParser):
+    defaults = LocalBackendConfig()
+    parser.add_argument('--local-policy',
+            help='Pricing policy of the local stand-in backend',
+            choices=list(PRICING_POLICIES.keys()),
+            default=defaults.policy,
+            required=False)
+    parser.add_argument('--local-latency',
+            help='Mean latency in seconds of the local stand-in backend',
+            type=float,
+            default=defaults.latency_mean,
+            required=False)
+    parser.add_argument('--local-latency-distribution',
+            help='Latency distribution of the local stand-in backend',
+            choices=LATENCY_DISTRIBUTIONS,
+            default=defaults.latency_distribution,
+            required=False)
+    parser.add_argument('--local-malformed-rate',
+            help='Fraction of malformed answers from the local stand-in backend',
+            type=float,
+            default=defaults.malformed_rate,
+            required=False)
+    parser.add_argument('--local-rate-limit-rate',
+            help='Fraction of requests the local stand-in backend rejects as rate limited',
+            type=float,
+            default=defaults.rate_limit_rate,
+            required=False)
+    parser.add_argument('--local-seed',
+            help='Seed of the local stand-in backend',
+            type=int,
+            default=defaults.seed,
+            required=False)
+
+def local_backend_config_from_args(args) -> LocalBackendConfig:
+    return LocalBackendConfig(policy=args.local_policy,
+                              latency_distribution=args.local_latency_distribution,
+                              latency_mean=args.local_latency,
+                              malformed_rate=args.local_malformed_rate,
+                              rate_limit_rate=args.local_rate_limit_rate,
+                              seed=args.local_seed)
+
+def get_args():
+    parser = argparse.ArgumentParser(
+                prog='llm_backends',
+                description='Serve the local stand-in backend as an OpenAI compatible endpoint')
+    parser.add_argument('--host',
+            help='Address to listen on',
+            default='127.0.0.1',
+            required=False)
+    parser.add_argument('--port',
+            help='Port to listen on',
+            type=int,
+            default=8000,
+            required=False)
+    add_local_backend_args(parser)
+    return parser.parse_args()
+
+def main():
+    args = get_args()
+    server = serve_openai_compatible(LocalBackend(local_backend_config_from_args(args)), args.host, args.port)
+    print('Serving on http://%s:%d/v1' % server.server_address)
+    server.serve_forever()
+
+if __name__ == "__main__":
+    main()
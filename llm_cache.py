@@ -0,0 +1,132 @@
+from enum import Enum, auto
+import hashlib
+import json
+from pathlib import Path
+import sqlite3
+import threading
+from typing import Awaitable, Callable, Optional
+
+from logger import get_logger
+
+class CacheMode(Enum):
+    RECORD = auto()
+    REPLAY = auto()
+    READ_THROUGH = auto()
+
+class CacheMissError(RuntimeError):
+    pass
+
+DEFAULT_MAX_CACHE_SIZE = 1024 * 1024 * 1024
+
+class LLMResponseCache:
+    def __init__(self, db_path: Path, mode: CacheMode, max_size_bytes: int = DEFAULT_MAX_CACHE_SIZE):
+        assert max_size_bytes > 0, 'Cache size must be positive'
+        db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.mode = mode
+        self.max_size_bytes = max_size_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(db_path, check_same_thread=False)
+        self._connection.execute('''CREATE TABLE IF NOT EXISTS responses (
+                                        key TEXT PRIMARY KEY,
+                                        response TEXT NOT NULL,
+                                        size INTEGER NOT NULL,
+                                        last_access INTEGER NOT NULL)''')
+        self._connection.execute('CREATE INDEX IF NOT EXISTS responses_lru ON responses (last_access)')
+        self._connection.commit()
+        total_size, last_access = self._connection.execute(
+            'SELECT COALESCE(SUM(size), 0), COALESCE(MAX(last_access), 0) FROM responses').fetchone()
+        self._total_size = total_size
+        self._clock = last_access
+
+    @staticmethod
+    def make_key(request: dict, use_tooling: bool, attempt: int = 0) -> str:
+        keyed = {'request': request, 'use_tooling': use_tooling}
+        # Retries resend the same request, each one gets its own response. First attempts keep their old keys.
+        if attempt > 0:
+            keyed['attempt'] = attempt
+        encoded = json.dumps(keyed, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+        return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+
+    def _tick(self) -> int:
+        self._clock += 1
+        return self._clock
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._connection.execute('SELECT response FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            self._connection.execute('UPDATE responses SET last_access = ? WHERE key = ?', (self._tick(), key))
+            self._connection.commit()
+            return json.loads(row[0])['content']
+
+    def put(self, key: str, content: str):
+        response = json.dumps({'content': content})
+        size = len(response.encode('utf-8'))
+        with self._lock:
+            previous = self._connection.execute('SELECT size FROM responses WHERE key = ?', (key,)).fetchone()
+            if previous is not None:
+                self._total_size -= previous[0]
+            self._connection.execute('INSERT OR REPLACE INTO responses (key, response, size, last_access) VALUES (?, ?, ?, ?)',
+                                     (key, response, size, self._tick()))
+            self._total_size += size
+            self._evict()
+            self._connection.commit()
+
+    def _evict(self):
+        while self._total_size > self.max_size_bytes:
+            victims = self._connection.execute('SELECT key, size FROM responses ORDER BY last_access LIMIT 64').fetchall()
+            if len(victims) == 0:
+                break
+            for key, size in victims:
+                self._connection.execute('DELETE FROM responses WHERE key = ?', (key,))
+                self._total_size -= size
+                if self._total_size <= self.max_size_bytes:
+                    break
+
+    def _lookup(self, key: str) -> Optional[str]:
+        if self.mode == CacheMode.RECORD:
+            return None
+        cached = self.get(key)
+        if cached is not None:
+            self.hits += 1
+            return cached
+        self.misses += 1
+        if self.mode == CacheMode.REPLAY:
+            raise CacheMissError('No cached response for request %s' % key)
+        return None
+
+    def get_or_call(self, request: dict, use_tooling: bool, call: Callable[[dict], str], attempt: int = 0) -> str:
+        key = self.make_key(request, use_tooling, attempt)
+        cached = self._lookup(key)
+        if cached is not None:
+            get_logger().debug('Response cache hit %s', key)
+            return cached
+        content = call(request)
+        self.put(key, content)
+        return content
+
+    async def get_or_call_async(self, request: dict, use_tooling: bool, call: Callable[[dict], Awaitable[str]],
+                                attempt: int = 0) -> str:
+        key = self.make_key(request, use_tooling, attempt)
+        cached = self._lookup(key)
+        if cached is not None:
+            get_logger().debug('Response cache hit %s', key)
+            return cached
+        content = await call(request)
+        self.put(key, content)
+        return content
+
+    def get_stats_dict(self) -> dict:
+        return {
+            'mode': self.mode.name.lower(),
+            'hits': self.hits,
+            'misses': self.misses,
+            'size_bytes': self._total_size,
+        }
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
@@ -1,56 +1,190 @@
-from typing import Any, Callable, Tuple
+import asyncio
+from dataclasses import dataclass
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
 
-from logger import get_logger
+from experiment_config import ExperimentConfig, RetryPolicy, RetryStrategy
+from expression_engine import history_variables
+from llm_cache import CacheMissError
+from logger import log_transcript, sample_transcript
 from market_history import MarketHistory
+from metrics import BudgetExceededError, stage_timer
 from pricing_agent import PricingAgent
+from prompt_costs import REPAIR_REQUEST
+from tracing import span
 
 PromtContext = Any
 TextGenerator = Callable[[str], str]
+AsyncTextGenerator = Callable[[str], Awaitable[str]]
 PromtGenerator = Callable[['LLMPricingAgent', MarketHistory, PromtContext], str]
 OutputParser = Callable[[PromtContext, str], Tuple[float, PromtContext]]
-LLM_RETRY_COUNT = 10
+@dataclass
+class PriceAttempts:
+    # Tracks one round of attempts, the first attempt always sends the plain prompt.
+    # A repair resends the prompt with the failed answer and a short note naming the parse error.
+    policy: RetryPolicy
+    prompt: str
+    attempts: int = 0
+    conversation: Tuple[dict, ...] = ()
+    first_failure_time: Optional[float] = None
+    retry_prompt_chars: int = 0
+    last_error: Optional[str] = None
+
+    def request_kwargs(self) -> Dict[str, Any]:
+        if self.attempts > 0:
+            self.retry_prompt_chars += len(self.prompt) + sum(len(message['content']) for message in self.conversation)
+        self.attempts += 1
+        # The attempt keeps cached retries apart, otherwise every retry would get the first answer back
+        kwargs: Dict[str, Any] = {'attempt': self.attempts - 1}
+        if len(self.conversation) > 0:
+            kwargs['conversation'] = self.conversation
+        return kwargs
+
+    def failed(self, llm_output: Optional[str], error: Exception):
+        if self.first_failure_time is None:
+            self.first_failure_time = time.perf_counter()
+        self.last_error = str(error)
+        if self.policy.strategy == RetryStrategy.REPAIR and llm_output is not None:
+            self.conversation = ({'role': 'assistant', 'content': llm_output},
+                                 {'role': 'user', 'content': REPAIR_REQUEST.format(error=self.last_error)})
+        else:
+            # Nothing to repair when the request itself failed
+            self.conversation = ()
+
+    def stats(self, round_index: int, succeeded: bool) -> Optional[dict]:
+        if self.attempts <= 1 and succeeded:
+            return None
+        if not succeeded:
+            strategy = 'failed'
+        else:
+            strategy = 'repair' if len(self.conversation) > 0 else 'resample'
+        return {'round': round_index,
+                'attempts': self.attempts,
+                'strategy': strategy,
+                'retry_seconds': time.perf_counter() - self.first_failure_time,
+                'retry_prompt_chars': self.retry_prompt_chars,
+                'last_error': self.last_error}
 
 class LLMPricingAgent(PricingAgent):
     def __init__(self, firm_id: int, price_per_unit: float,
                 text_generator: TextGenerator,
                 promt_generator: PromtGenerator,
                 output_parser: OutputParser,
-                add_tooling: bool,
-                initial_context: PromtContext = None):
+                config: ExperimentConfig,
+                initial_context: PromtContext = None,
+                async_text_generator: Optional[AsyncTextGenerator] = None):
         super().__init__(firm_id, price_per_unit)
         self.text_generator: TextGenerator = text_generator
+        self.async_text_generator: Optional[AsyncTextGenerator] = async_text_generator
         self.promt_generator: PromtGenerator = promt_generator
         self.output_parser: OutputParser = output_parser
         self.context: PromtContext = initial_context
         self.total_exceptions = 0
-        self.add_tooling = add_tooling
-    
-    def generate_price(self, market_history: MarketHistory) -> float:
+        self.config: ExperimentConfig = config
+        self.history_renderer = None
+        self.retry_policy: RetryPolicy = config.retry_policy
+        # Only rounds that needed more than one attempt are recorded
+        self.retry_stats: List[dict] = []
+        self.last_retry_stats: Optional[dict] = None
+        self.transcribe_round = False
+
+    def _build_request(self, market_history: MarketHistory) -> Tuple[str, Dict[str, Any]]:
+        with stage_timer('prompt'), span(self.promt_generator.__name__):
+            return self._build_request_untimed(market_history)
+
+    def _build_request_untimed(self, market_history: MarketHistory) -> Tuple[str, Dict[str, Any]]:
         generated_promt = self.promt_generator(self, market_history, self.context)
-        raw_data = [{'price': priced_products.priced_products[0].price,
-                     'quanity_sold': priced_products.priced_products[0].quantity_sold,
-                     'profit': priced_products.priced_products[0].profit} for priced_products in market_history.past_iteration]
-        if self.add_tooling:
-                generated_promt += """You have a list of dictionaries with the following struct:
+        addit_kwargs = {}
+        if self.config.use_tooling:
+            generated_promt += """You have a list of dictionaries with the following struct:
                 {'price': X, 'quanity_sold': X, 'profit': X}
                 in a variable named market_history.
+                The same data is also available as arrays named prices, quantities and profits (one entry per round, oldest first),
+                along with the helpers mean, median, std, argmax, argmin and polyfit.
                 """
-        for i in range(LLM_RETRY_COUNT):
+            addit_kwargs['local_varaibles'] = history_variables(market_history, self.firm_id)
+        return generated_promt, addit_kwargs
+
+    def _should_give_up(self, attempt: int) -> bool:
+        self.total_exceptions += 1
+        self.config.logger.warning('Failed retrying (Current attempt: %d)', attempt+1)
+        if attempt == (self.retry_policy.max_attempts - 1):
+            self.config.logger.error('To many failures, quiting experiment')
+            return True
+        self.config.logger.exception('Exception was:')
+        return False
+
+    def _record_attempts(self, market_history: MarketHistory, attempts: PriceAttempts, succeeded: bool):
+        self.last_retry_stats = attempts.stats(len(market_history), succeeded)
+        if self.last_retry_stats is not None:
+            self.retry_stats.append(self.last_retry_stats)
+
+    def _transcribe(self, market_history: MarketHistory, kind: str, text: str):
+        # Sampled once per round, so a sampled round keeps its prompt together with every answer
+        if self.transcribe_round:
+            log_transcript(kind, self.firm_id, len(market_history), text)
+
+    def generate_price(self, market_history: MarketHistory) -> float:
+        generated_promt, addit_kwargs = self._build_request(market_history)
+        self.transcribe_round = sample_transcript()
+        self._transcribe(market_history, 'prompt', generated_promt)
+        attempts = PriceAttempts(self.retry_policy, generated_promt)
+        for i in range(self.retry_policy.max_attempts):
+            llm_output = None
+            try:
+                with stage_timer('llm'), span('text_generator'):
+                    llm_output = self.text_generator(generated_promt, **addit_kwargs, **attempts.request_kwargs())
+                self._transcribe(market_history, 'response', llm_output)
+                with stage_timer('parse'), span(self.output_parser.__name__):
+                    new_price, new_context = self.output_parser(self.context, llm_output)
+                break
+            except (CacheMissError, BudgetExceededError):
+                raise
+            except Exception as e:
+                attempts.failed(llm_output, e)
+                if self._should_give_up(i):
+                    self._record_attempts(market_history, attempts, False)
+                    raise
+                time.sleep(self.retry_policy.backoff(i))
+        self._record_attempts(market_history, attempts, True)
+        self.context = new_context
+        return new_price
+
+    async def generate_price_async(self, market_history: MarketHistory) -> float:
+        assert self.async_text_generator is not None, 'Agent has no async text generator'
+        generated_promt, addit_kwargs = self._build_request(market_history)
+        self.transcribe_round = sample_transcript()
+        self._transcribe(market_history, 'prompt', generated_promt)
+        attempts = PriceAttempts(self.retry_policy, generated_promt)
+        for i in range(self.retry_policy.max_attempts):
+            llm_output = None
             try:
-                addit_kwargs = {}
-                if self.add_tooling:
-                    addit_kwargs['local_varaibles'] = {'market_history': raw_data}
-                llm_output = self.text_generator(generated_promt, **addit_kwargs)
-                new_price, new_context = self.output_parser(self.context, llm_output)
+                with stage_timer('llm'), span('text_generator'):
+                    llm_output = await self.async_text_generator(generated_promt, **addit_kwargs,
+                                                                 **attempts.request_kwargs())
+                self._transcribe(market_history, 'response', llm_output)
+                with stage_timer('parse'), span(self.output_parser.__name__):
+                    new_price, new_context = self.output_parser(self.context, llm_output)
                 break
-            except Exception:
-                self.total_exceptions += 1
-                get_logger().warning('Failed retrying (Current attempt: %d)' % (i+1))
-                if i == (LLM_RETRY_COUNT - 1):
-                    get_logger().error('To many failures, quiting experiment')
+            except (CacheMissError, BudgetExceededError):
+                raise
+            except Exception as e:
+                attempts.failed(llm_output, e)
+                if self._should_give_up(i):
+                    self._record_attempts(market_history, attempts, False)
                     raise
-                else:
-                    get_logger().exception('Exception was:')
+                await asyncio.sleep(self.retry_policy.backoff(i))
+        self._record_attempts(market_history, attempts, True)
         self.context = new_context
         return new_price
 
+    def get_retry_stats_dict(self) -> dict:
+        succeeded = [stats for stats in self.retry_stats if stats['strategy'] != 'failed']
+        return {'policy': self.retry_policy.to_dict(),
+                'retried_rounds': len(self.retry_stats),
+                'repair_successes': sum(stats['strategy'] == 'repair' for stats in succeeded),
+                'resample_successes': sum(stats['strategy'] == 'resample' for stats in succeeded),
+                'extra_attempts': sum(stats['attempts'] - 1 for stats in self.retry_stats),
+                'retry_seconds': sum(stats['retry_seconds'] for stats in self.retry_stats),
+                'retry_prompt_chars': sum(stats['retry_prompt_chars'] for stats in self.retry_stats),
+                'rounds': self.retry_stats}
@@ -1,22 +1,58 @@
+import atexit
 from datetime import datetime
+import gzip
 import logging
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+import os
 from pathlib import Path
+import queue
+import random
+import shutil
+from typing import Optional
+
+DEFAULT_LOG_MAX_BYTES = 64 * 1024 * 1024
+DEFAULT_LOG_BACKUP_COUNT = 10
+DEFAULT_TRANSCRIPT_SAMPLE_RATE = 1.0
 
 _logger = None
+_transcript_logger = None
+_listener: Optional[QueueListener] = None
+_transcript_sample_rate = DEFAULT_TRANSCRIPT_SAMPLE_RATE
+_transcript_random = random.Random()
 
-def init_logger(dir_path: Path):
-    global _logger
+class LazyQueueHandler(QueueHandler):
+    # The stock handler formats the message on the calling thread, here records are queued as they are
+    # and only the listener thread merges the arguments and writes them out.
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+def _gzip_namer(name: str) -> str:
+    return name + '.gz'
+
+def _gzip_rotator(source: str, dest: str):
+    with open(source, 'rb') as f_in, gzip.open(dest, 'wb') as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.remove(source)
+
+def _rotating_handler(path: Path, max_bytes: int, backup_count: int) -> RotatingFileHandler:
+    handler = RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count)
+    handler.namer = _gzip_namer
+    handler.rotator = _gzip_rotator
+    return handler
+
+def init_logger(dir_path: Path, max_bytes: int = DEFAULT_LOG_MAX_BYTES, backup_count: int = DEFAULT_LOG_BACKUP_COUNT,
+                transcript_sample_rate: float = DEFAULT_TRANSCRIPT_SAMPLE_RATE):
+    global _logger, _transcript_logger, _listener, _transcript_sample_rate
     assert _logger == None, 'Logger should only be init once'
+    assert 0 <= transcript_sample_rate <= 1, 'Transcript sample rate should be between 0 and 1'
 
     LOG_NAME = datetime.now().strftime('llm_attempt_%H_%M_%d_%m_%Y.log')
-
-    logger = logging.getLogger('LLMPricer')
-    logger.setLevel(logging.DEBUG)
+    TRANSCRIPT_NAME = datetime.now().strftime('llm_transcript_%H_%M_%d_%m_%Y.log')
 
     dir_path.mkdir(parents=True, exist_ok=True)
     log_path = dir_path / LOG_NAME
 
-    fh = logging.FileHandler(log_path)
+    fh = _rotating_handler(log_path, max_bytes, backup_count)
     fh.setLevel(logging.DEBUG)
 
     ch = logging.StreamHandler()
@@ -26,13 +62,51 @@ def init_logger(dir_path: Path):
     fh.setFormatter(formatter)
     ch.setFormatter(formatter)
 
-    logger.addHandler(fh)
-    logger.addHandler(ch)
+    # Full prompts and responses go to their own file, filtered by name since both loggers share the queue
+    th = _rotating_handler(dir_path / TRANSCRIPT_NAME, max_bytes, backup_count)
+    th.setFormatter(logging.Formatter('%(asctime)s - %(message)s'))
+    th.addFilter(logging.Filter('LLMPricer.transcript'))
+    fh.addFilter(lambda record: not record.name.startswith('LLMPricer.transcript'))
+    ch.addFilter(lambda record: not record.name.startswith('LLMPricer.transcript'))
+
+    log_queue = queue.SimpleQueue()
+    _listener = QueueListener(log_queue, fh, ch, th, respect_handler_level=True)
+    _listener.start()
+    atexit.register(shutdown_logger)
+
+    logger = logging.getLogger('LLMPricer')
+    logger.setLevel(logging.DEBUG)
+    logger.addHandler(LazyQueueHandler(log_queue))
+
+    transcript_logger = logging.getLogger('LLMPricer.transcript')
+    transcript_logger.setLevel(logging.DEBUG)
 
     _logger = logger
+    _transcript_logger = transcript_logger
+    _transcript_sample_rate = transcript_sample_rate
+
+def shutdown_logger():
+    # Flushes everything still queued
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
 
 def get_logger():
     global _logger
     assert _logger != None, 'Logger wasn\'t init'
     return _logger
-    
\ No newline at end of file
+
+class ExperimentLogger(logging.LoggerAdapter):
+    # Prefixes the experiment, the arguments are still merged lazily by the listener
+    def process(self, msg, kwargs):
+        return '[%s] %s' % (self.extra['experiment'], msg), kwargs
+
+def get_experiment_logger(label: str) -> ExperimentLogger:
+    return ExperimentLogger(get_logger(), {'experiment': label})
+
+def sample_transcript() -> bool:
+    return _transcript_logger is not None and _transcript_random.random() < _transcript_sample_rate
+
+def log_transcript(kind: str, firm_id: int, round_index: int, text: str):
+    _transcript_logger.debug('%s (firm %d, round %d):\n%s', kind, firm_id, round_index, text)
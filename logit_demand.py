@@ -0,0 +1,98 @@
+from functools import lru_cache
+import numpy as np
+from typing import Callable, Tuple, Union
+
+ArrayLike = Union[np.ndarray, float]
+
+def logit_demand(prices: ArrayLike, qualities: ArrayLike, costs: ArrayLike,
+                 price_scale: ArrayLike, horz_differn: ArrayLike, outside_good: ArrayLike,
+                 quantity_scale: ArrayLike) -> Tuple[np.ndarray, np.ndarray]:
+    # Firms are on the last axis, every leading axis is an independent market instance.
+    # Market parameters broadcast against prices, pass them with shape (..., 1) to vary them per instance.
+    prices = np.asarray(prices, dtype=np.float64)
+    logits = (qualities - prices / price_scale) / horz_differn
+    # The outside option weight is exp(outside_good) / horz_differn
+    outside_logit = outside_good - np.log(horz_differn)
+    max_logit = np.maximum(logits.max(axis=-1, keepdims=True), outside_logit)
+    weights = np.exp(logits - max_logit)
+    normalizer = weights.sum(axis=-1, keepdims=True) + np.exp(outside_logit - max_logit)
+    quantities = quantity_scale * (weights / normalizer)
+    profits = (prices - price_scale * costs) * quantities
+    return quantities, profits
+
+LAMBERT_W_MAX_ITERATIONS = 64
+
+def lambert_w_from_log(log_y: ArrayLike) -> np.ndarray:
+    # Principal branch W(y) for y = exp(log_y) > 0, found by solving w + log(w) = log_y.
+    # Newton's method on this concave function climbs monotonically from a lower bound,
+    # and working with log_y keeps large arguments from overflowing.
+    log_y = np.asarray(log_y, dtype=np.float64)
+    tiny = log_y < -30
+    # Tiny arguments are solved in closed form below, W(e) = 1 keeps their lanes still meanwhile
+    solved_log_y = np.where(tiny, 1, log_y)
+    y = np.exp(np.minimum(solved_log_y, 1))
+    w = np.where(solved_log_y > 1, solved_log_y - np.log(np.maximum(solved_log_y, 1)), y / (1 + y))
+    for _ in range(LAMBERT_W_MAX_ITERATIONS):
+        step = (w + np.log(w) - solved_log_y) * w / (w + 1)
+        w = w - step
+        if np.all(np.abs(step) <= 16 * np.finfo(np.float64).eps * w):
+            break
+    # W(y) = y - y^2 + O(y^3), which is exact in double precision this far out
+    tiny_y = np.exp(np.where(tiny, log_y, 0))
+    return np.where(tiny, tiny_y - tiny_y * tiny_y, w)
+
+def monopoly_prices(qualities: ArrayLike, costs: ArrayLike, price_scale: ArrayLike,
+                    horz_differn: ArrayLike, outside_good: ArrayLike) -> np.ndarray:
+    # The single product first order condition (p - s*c) * (1 - share) = s * mu reduces to
+    # p = s*c + s*mu*(1 + W(exp((q - c) / mu - 1) * mu / exp(outside_good)))
+    log_y = (qualities - costs) / horz_differn - 1 - outside_good + np.log(horz_differn)
+    return price_scale * costs + price_scale * horz_differn * (1 + lambert_w_from_log(log_y))
+
+@lru_cache(maxsize=None)
+def monopoly_price(product_quality: float, cost_to_make: float, price_scale: float,
+                   horz_differn: float, outside_good: float) -> float:
+    return float(monopoly_prices(product_quality, cost_to_make, price_scale, horz_differn, outside_good))
+
+PricingPolicy = Callable[[int, np.ndarray, np.ndarray], np.ndarray]
+
+class BatchedLogitMarket:
+    def __init__(self, qualities: np.ndarray, costs: np.ndarray, price_scale: ArrayLike,
+                 horz_differn: ArrayLike, outside_good: ArrayLike, quantity_scale: ArrayLike):
+        qualities = np.asarray(qualities, dtype=np.float64)
+        assert qualities.ndim == 2, 'Qualities should be shaped (instances x firms)'
+        self.qualities = qualities
+        self.costs = np.broadcast_to(np.asarray(costs, dtype=np.float64), qualities.shape)
+        self.price_scale = self._per_instance(price_scale)
+        self.horz_differn = self._per_instance(horz_differn)
+        self.outside_good = self._per_instance(outside_good)
+        self.quantity_scale = self._per_instance(quantity_scale)
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        return self.qualities.shape
+
+    def _per_instance(self, value: ArrayLike) -> np.ndarray:
+        value = np.asarray(value, dtype=np.float64)
+        if value.ndim == 0:
+            return value
+        return value.reshape(self.qualities.shape[0], 1)
+
+    def step(self, prices: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        prices = np.asarray(prices, dtype=np.float64)
+        assert prices.shape == self.shape, 'Prices should be shaped (instances x firms)'
+        return logit_demand(prices, self.qualities, self.costs, self.price_scale,
+                            self.horz_differn, self.outside_good, self.quantity_scale)
+
+    def run(self, policy: PricingPolicy, rounds: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        all_prices = np.empty((rounds,) + self.shape)
+        all_quantities = np.empty((rounds,) + self.shape)
+        all_profits = np.empty((rounds,) + self.shape)
+        last_prices = np.full(self.shape, np.nan)
+        last_profits = np.full(self.shape, np.nan)
+        for i in range(rounds):
+            last_prices = policy(i, last_prices, last_profits)
+            quantities, last_profits = self.step(last_prices)
+            all_prices[i] = last_prices
+            all_quantities[i] = quantities
+            all_profits[i] = last_profits
+        return all_prices, all_quantities, all_profits
@@ -1,140 +1,422 @@
 import argparse
-from dataclasses import asdict
+import asyncio
+import cProfile
+from dataclasses import asdict, dataclass
 from datetime import datetime
 from enum import Enum, auto
 import json
 import numpy as np
+import os
 from pathlib import Path
+import struct
 import time
-from typing import Tuple, Dict
+from typing import Dict, List, Optional, Tuple
 
-from json_prompt_setup import generate_prompt_for_json, output_json_parser, \
-      has_examples as json_has_examples, set_add_example as json_set_add_example
-from legacy_prompt_setup import generate_prompt, output_parser, has_examples, \
-                                set_add_example
+from early_stopping import CONVERGENCE_DISTANCE, CONVERGENCE_WINDOW, ConvergenceMonitor, DEFAULT_PATIENCE, \
+                           EarlyStoppingPolicy
+from experiment_checkpoint import Checkpoint, CheckpointWriter, checkpoint_path_for, load_checkpoint
+from experiment_config import ExperimentConfig, LLM_RETRY_COUNT, RetryPolicy, RetryStrategy, ToolingCounters
+from json_prompt_setup import generate_prompt_for_json, output_json_parser
+from legacy_prompt_setup import generate_prompt, output_parser
+from llm_backends import LocalBackend, TogetherBackend, add_local_backend_args, local_backend_config_from_args
+from llm_cache import CacheMode, DEFAULT_MAX_CACHE_SIZE, LLMResponseCache
 from llm_pricing_agent import LLMPricingAgent
-from logger import init_logger, get_logger
-from market_simulation import LogitPriceMarketSimulation
-from market_history import MarketHistory
-from prompt_commons import set_max_round_count, get_max_round_count
+from logger import DEFAULT_LOG_BACKUP_COUNT, DEFAULT_LOG_MAX_BYTES, init_logger, get_logger
+from market_simulation import LogitPriceMarketSimulation, PricingTimeoutPolicy, TimeoutAction
+from market_history import MarketHistory, MarketIteration, PricedProduct
+from metrics import ExperimentMetrics, MetricsBudget, MetricsStream, set_current_metrics
+from result_format import BINARY_RESULT_SUFFIX, load_binary_header, save_binary_result
 from simple_llm_context import LLMContext
-from together_endpoint_predictor import generate_specialized_text, get_chosen_model, \
-                                        get_available_models, set_chosen_model, set_using_tooling, \
-                                        reset_tooling_info, get_tooling_info_dict
+from together_endpoint_predictor import generate_specialized_text, generate_specialized_text_async, \
+                                        get_available_models, set_backend
+from tracing import ChromeTracer, get_tracer, set_tracer, span
 
 MARKET_OUTSIDE_GOOD = 0
 PRODUCT_QUALITIES = 2
 HORZ_DIFFEREN = 0.25
 QUANTITY_SCALE = 100
 MARKET_ITERATIONS = 300
+CACHE_MODES = {
+    'record': CacheMode.RECORD,
+    'replay': CacheMode.REPLAY,
+    'read-through': CacheMode.READ_THROUGH,
+}
+RETRY_STRATEGIES = {
+    'resample': RetryStrategy.RESAMPLE,
+    'repair': RetryStrategy.REPAIR,
+}
+TIMEOUT_ACTIONS = {
+    'fail': TimeoutAction.FAIL,
+    'keep-last-price': TimeoutAction.KEEP_LAST_PRICE,
+}
 
 class PromptType(Enum):
     UNKNOWN = auto()
     LEGACY = auto()
     JSON = auto()
 
-def simulate_full_experiment(price_scale: float, experiment_type: PromptType, use_tooling: bool) -> Tuple[MarketHistory, Dict]:
+@dataclass
+class ExperimentSpec:
+    price_scale: float
+    model: str
+    seed: Optional[int] = None
+
+@dataclass
+class ExperimentSetup:
+    spec: ExperimentSpec
+    experiment_type: PromptType
+    config: ExperimentConfig
+    simulation: LogitPriceMarketSimulation
+    agent: LLMPricingAgent
+    monopoly_price: float
+    monopoly_price_multiplier: float
+    checkpoint_writer: Optional[CheckpointWriter] = None
+    metrics: Optional[ExperimentMetrics] = None
+    completed_rounds: int = 0
+    previous_time: float = 0
+    convergence: Optional[ConvergenceMonitor] = None
+
+    @property
+    def remaining_rounds(self) -> int:
+        if self.convergence is not None and self.convergence.stopped_round is not None:
+            return 0
+        return MARKET_ITERATIONS - self.completed_rounds
+
+    def should_stop(self, i: int, market_iteration: MarketIteration) -> bool:
+        if self.convergence is None:
+            return False
+        return self.convergence.update(i + 1, self.agent.extract_my_product(market_iteration).price)
+
+@dataclass
+class ExperimentRun:
+    spec: ExperimentSpec
+    config: ExperimentConfig
+    result_path: Path
+    checkpoint_path: Optional[Path] = None
+    resume_from: Optional[Checkpoint] = None
+
+@dataclass
+class MetricsSetup:
+    budget: Optional[MetricsBudget] = None
+    stream: Optional[MetricsStream] = None
+
+def build_checkpoint_header(spec: ExperimentSpec, experiment_type: PromptType, config: ExperimentConfig,
+                            monopoly_price: float, monopoly_price_multiplier: float) -> dict:
+    return {'price_scale': spec.price_scale,
+            'model': spec.model,
+            'seed': spec.seed,
+            'experiment_type': repr(experiment_type),
+            'use_tooling': config.use_tooling,
+            'has_example': config.add_example,
+            'round_memory': config.round_memory,
+            'compact_history': config.compact_history,
+            'monopoly_price': monopoly_price,
+            'monopoly_price_multiplier': monopoly_price_multiplier}
+
+def setup_experiment(spec: ExperimentSpec, experiment_type: PromptType, config: ExperimentConfig,
+                     cache: Optional[LLMResponseCache] = None, checkpoint_path: Optional[Path] = None,
+                     resume_from: Optional[Checkpoint] = None,
+                     metrics_setup: Optional[MetricsSetup] = None) -> ExperimentSetup:
+    price_scale = spec.price_scale
     simulation = LogitPriceMarketSimulation(
         quantity_scale=QUANTITY_SCALE,
         price_scale=price_scale,
         horz_differn=HORZ_DIFFEREN,
-        outside_good=MARKET_OUTSIDE_GOOD
+        outside_good=MARKET_OUTSIDE_GOOD,
+        timeout_policy=config.pricing_timeout
     )
 
-    if use_tooling:
-        reset_tooling_info()
+    assert config.model == spec.model, 'Config is for %s, not %s' % (config.model, spec.model)
+    logger = config.logger
 
     if experiment_type == PromptType.LEGACY:
         prompt_pair = (generate_prompt, output_parser)
-        has_example = has_examples()
     elif experiment_type == PromptType.JSON:
         prompt_pair = (generate_prompt_for_json, output_json_parser)
-        has_example = json_has_examples()
-        if use_tooling:
-            get_logger().warning('Tooling and json mode don\'t work well together')
+        if config.use_tooling:
+            logger.warning('Tooling and json mode don\'t work well together')
     else:
         raise RuntimeError('Unsupported prompt type')
 
-    get_logger().info('Simulation details:')
-    get_logger().info(f'\tquantity_scale: {QUANTITY_SCALE}')
-    get_logger().info(f'\tprice_scale: {price_scale}')
-    get_logger().info(f'\thorz_differn: {HORZ_DIFFEREN}')
-    get_logger().info(f'\toutside_good: {MARKET_OUTSIDE_GOOD}')
-    get_logger().info(f'\tPrompt type: {experiment_type}')
-    get_logger().info(f'\tModel: {get_chosen_model()}')
-    get_logger().info(f'\tRound memory: {get_max_round_count()}')
-    get_logger().info(f'\tHas example: {has_example}')
-    get_logger().info(f'\tUses tooling: {use_tooling}')
+    logger.info('Simulation details:')
+    logger.info('\tquantity_scale: %s', QUANTITY_SCALE)
+    logger.info('\tprice_scale: %s', price_scale)
+    logger.info('\thorz_differn: %s', HORZ_DIFFEREN)
+    logger.info('\toutside_good: %s', MARKET_OUTSIDE_GOOD)
+    logger.info('\tPrompt type: %s', experiment_type)
+    logger.info('\tModel: %s', spec.model)
+    logger.info('\tRound memory: %s', config.round_memory)
+    logger.info('\tCompact history: %s', config.compact_history)
+    logger.info('\tHas example: %s', config.add_example)
+    logger.info('\tUses tooling: %s', config.use_tooling)
+    logger.info('\tSeed: %s', spec.seed)
 
 
     AGENT_PRODUCT_QUALITY = 2
     AGENT_COST_TO_MAKE = 1
     AGENT_FIRM_ID = 1
 
-    get_logger().info(f'AGENT_PRODUCT_QUALITY = {AGENT_PRODUCT_QUALITY}')
-    get_logger().info(f'AGENT_COST_TO_MAKE = {AGENT_COST_TO_MAKE}')
-    get_logger().info(f'AGENT_FIRM_ID = {AGENT_FIRM_ID}')
+    logger.info('AGENT_PRODUCT_QUALITY = %s', AGENT_PRODUCT_QUALITY)
+    logger.info('AGENT_COST_TO_MAKE = %s', AGENT_COST_TO_MAKE)
+    logger.info('AGENT_FIRM_ID = %s', AGENT_FIRM_ID)
 
-    monopoly_price_multiplier = np.random.uniform(1.5, 2.5)
+    if spec.seed is None:
+        monopoly_price_multiplier = np.random.uniform(1.5, 2.5)
+    else:
+        monopoly_price_multiplier = np.random.default_rng(spec.seed).uniform(1.5, 2.5)
     monopoly_price = simulation.find_monopoly_price(product_quality=AGENT_PRODUCT_QUALITY,
                                                     cost_to_make=AGENT_COST_TO_MAKE)
+
+    header = build_checkpoint_header(spec, experiment_type, config, monopoly_price, monopoly_price_multiplier)
+    if resume_from is not None:
+        for key, value in header.items():
+            if key not in ('monopoly_price', 'monopoly_price_multiplier'):
+                assert resume_from.header[key] == value, \
+                    'Checkpoint %s doesn\'t match the experiment (%r != %r)' % (key, resume_from.header[key], value)
+        monopoly_price_multiplier = resume_from.header['monopoly_price_multiplier']
+        header['monopoly_price_multiplier'] = monopoly_price_multiplier
     
-    get_logger().info('Chosen monopoly price multiplier: %.2f' % monopoly_price_multiplier)
-    get_logger().info('Calculated optimal monopoly price: %.2f' % monopoly_price)
+    logger.info('Chosen monopoly price multiplier: %.2f', monopoly_price_multiplier)
+    logger.info('Calculated optimal monopoly price: %.2f', monopoly_price)
 
     initial_state = LLMContext(cost_per_unit=AGENT_COST_TO_MAKE,
                                max_client_price= monopoly_price * monopoly_price_multiplier,
                                 plans = 'No known plans',
                                 insights = 'No known insights')
-    set_using_tooling(use_tooling)
     my_agent = LLMPricingAgent(AGENT_FIRM_ID,
                                initial_state.cost_per_unit,
-                               generate_specialized_text(),
+                               generate_specialized_text(config, cache=cache),
                                *prompt_pair,
                                initial_context=initial_state,
-                               add_tooling=use_tooling)
+                               config=config,
+                               async_text_generator=generate_specialized_text_async(config, cache=cache))
 
     simulation.add_firm(my_agent, AGENT_PRODUCT_QUALITY)
 
-    failed = False
-    last_iteration = 0
-    get_logger().info('Starting simulation')
-    start_time = time.time()
-    try:
-        for i, market_iteration in enumerate(simulation.simulate_market(count=MARKET_ITERATIONS)):
-            get_logger().info(f"For iteration {i + 1}:")
-            for priced_product in market_iteration.priced_products:
-                get_logger().info(f'\tFor firm {priced_product.firm_id}')
-                get_logger().info('\t\tChosen Price %.2f' % priced_product.price)
-                get_logger().info('\t\tQuantity sold %.2f' % priced_product.quantity_sold)
-                get_logger().info('\t\tProfit %.2f' % priced_product.profit)
-            get_logger().info("\n")
-            last_iteration = i + 1
-    except Exception:
-        get_logger().exception("Caught an exception:")
-        failed = True
-    finally:
-        get_logger().info("Ran %d iterations" % (last_iteration))
+    metrics_setup = metrics_setup if metrics_setup is not None else MetricsSetup()
+    metrics = ExperimentMetrics({'price_scale': spec.price_scale, 'model': spec.model, 'seed': spec.seed},
+                                metrics_setup.budget, metrics_setup.stream)
+
+    completed_rounds = 0
+    previous_time = 0
+    if resume_from is not None and resume_from.last_round is not None:
+        for record in resume_from.rounds:
+            simulation.market_history.append_iteration(
+                MarketIteration([PricedProduct(**priced_product) for priced_product in record['priced_products']]))
+        last_round = resume_from.last_round
+        my_agent.context = LLMContext(**last_round['context'])
+        my_agent.total_exceptions = last_round['total_exceptions']
+        my_agent.retry_stats = [record['retry_stats'] for record in resume_from.rounds
+                                if record.get('retry_stats') is not None]
+        metrics.rounds = [record['metrics'] for record in resume_from.rounds if record.get('metrics') is not None]
+        if config.use_tooling:
+            config.tooling = ToolingCounters(**last_round['tooling_info'])
+        completed_rounds = resume_from.completed_rounds
+        previous_time = last_round['elapsed_time']
+        logger.info('Resuming after %d completed rounds', completed_rounds)
+
+    convergence = None
+    if config.early_stopping is not None:
+        convergence = ConvergenceMonitor(config.early_stopping)
+        # Replaying the resumed rounds, a run that already stopped doesn't get any new ones
+        for i, price in enumerate(simulation.market_history.firm_prices(AGENT_FIRM_ID).tolist()):
+            convergence.update(i + 1, price)
+
+    checkpoint_writer = None
+    if checkpoint_path is not None:
+        checkpoint_writer = CheckpointWriter(checkpoint_path, header,
+                                             resume_from.rounds if resume_from is not None else [])
+
+    return ExperimentSetup(spec=spec,
+                           experiment_type=experiment_type,
+                           config=config,
+                           simulation=simulation,
+                           agent=my_agent,
+                           monopoly_price=monopoly_price,
+                           monopoly_price_multiplier=monopoly_price_multiplier,
+                           checkpoint_writer=checkpoint_writer,
+                           metrics=metrics,
+                           completed_rounds=completed_rounds,
+                           previous_time=previous_time,
+                           convergence=convergence)
 
-    total_time = time.time() - start_time
-    get_logger().info('Total running time %.2f seconds' % total_time)
-    get_logger().info('Reminder the monopoly price is %.2f' % monopoly_price)
-    additional_context = {'monopoly_price': monopoly_price,
+def log_market_iteration(config: ExperimentConfig, i: int, market_iteration: MarketIteration):
+    config.logger.info("For iteration %d:", i + 1)
+    for priced_product in market_iteration.priced_products:
+        config.logger.info('\tFor firm %d', priced_product.firm_id)
+        config.logger.info('\t\tChosen Price %.2f', priced_product.price)
+        config.logger.info('\t\tQuantity sold %.2f', priced_product.quantity_sold)
+        config.logger.info('\t\tProfit %.2f', priced_product.profit)
+    config.logger.info("\n")
+
+def record_market_iteration(setup: ExperimentSetup, i: int, market_iteration: MarketIteration, start_time: float):
+    log_market_iteration(setup.config, i, market_iteration)
+    retry_stats = setup.agent.last_retry_stats
+    round_metrics = setup.metrics.finish_round(i, retry_stats['attempts'] - 1 if retry_stats is not None else 0)
+    if setup.checkpoint_writer is not None:
+        setup.checkpoint_writer.write_round(i, market_iteration, asdict(setup.agent.context),
+                                            setup.agent.total_exceptions,
+                                            setup.config.tooling.to_dict() if setup.config.use_tooling else {},
+                                            setup.previous_time + time.time() - start_time,
+                                            retry_stats, round_metrics)
+
+def finish_experiment(setup: ExperimentSetup, start_time: float, failed: bool) -> Tuple[MarketHistory, Dict]:
+    simulation = setup.simulation
+    total_time = setup.previous_time + time.time() - start_time
+    simulation.close()
+    if setup.checkpoint_writer is not None:
+        setup.checkpoint_writer.close()
+    setup.config.logger.info('Total running time %.2f seconds', total_time)
+    setup.config.logger.info('Reminder the monopoly price is %.2f', setup.monopoly_price)
+    additional_context = {'monopoly_price': setup.monopoly_price,
                           'total_time': total_time,
-                          'total_exceptions': my_agent.total_exceptions,
-                          'monopoly_price_multiplier': monopoly_price_multiplier,
+                          'total_exceptions': setup.agent.total_exceptions,
+                          'monopoly_price_multiplier': setup.monopoly_price_multiplier,
                           'failed': failed,
-                          'used_model': get_chosen_model(),
-                          'round_memory': get_max_round_count(),
-                          'experiment_type': repr(experiment_type),
-                          'has_example': has_example,
-                          'total_iterations': len(simulation.market_iterations),
-                          'used_tooling': use_tooling,
+                          'used_model': setup.spec.model,
+                          'round_memory': setup.config.round_memory,
+                          'compact_history': setup.config.compact_history,
+                          'experiment_type': repr(setup.experiment_type),
+                          'has_example': setup.config.add_example,
+                          'total_iterations': len(simulation.market_history),
+                          'used_tooling': setup.config.use_tooling,
                           'tooling_info': {},
+                          'seed': setup.spec.seed,
+                          'retry_stats': setup.agent.get_retry_stats_dict(),
+                          'metrics': setup.metrics.get_summary_dict(),
+                          'budget_exceeded': setup.metrics.budget is not None and setup.metrics.budget.exceeded,
+                          'pricing_timeouts': simulation.pricing_timeouts,
+                          'early_stopping': setup.convergence.get_stats_dict() if setup.convergence is not None
+                                            else None,
                         }
-    if use_tooling:
-        additional_context['tooling_info'] = get_tooling_info_dict()
-    return MarketHistory(simulation.market_iterations), additional_context
+    if setup.config.use_tooling:
+        additional_context['tooling_info'] = setup.config.tooling.to_dict()
+    return simulation.market_history, additional_context
+
+def experiment_span_args(spec: ExperimentSpec) -> dict:
+    return {'price_scale': spec.price_scale, 'model': spec.model, 'seed': spec.seed}
+
+def simulate_full_experiment(spec: ExperimentSpec, experiment_type: PromptType, config: ExperimentConfig,
+                             cache: Optional[LLMResponseCache] = None, checkpoint_path: Optional[Path] = None,
+                             resume_from: Optional[Checkpoint] = None,
+                             metrics_setup: Optional[MetricsSetup] = None) -> Tuple[MarketHistory, Dict]:
+    setup = setup_experiment(spec, experiment_type, config, cache, checkpoint_path, resume_from, metrics_setup)
+    set_current_metrics(setup.metrics)
+
+    failed = False
+    last_iteration = setup.completed_rounds
+    config.logger.info('Starting simulation')
+    start_time = time.time()
+    with span('experiment', experiment_span_args(spec)):
+        try:
+            market_iterations = setup.simulation.simulate_market(count=setup.remaining_rounds)
+            for i, market_iteration in enumerate(market_iterations, start=setup.completed_rounds):
+                record_market_iteration(setup, i, market_iteration, start_time)
+                last_iteration = i + 1
+                if setup.should_stop(i, market_iteration):
+                    config.logger.info('Price converged, stopping after round %d', last_iteration)
+                    break
+        except Exception:
+            config.logger.exception("Caught an exception:")
+            failed = True
+        finally:
+            config.logger.info("Ran %d iterations", last_iteration)
+
+    return finish_experiment(setup, start_time, failed)
+
+async def simulate_full_experiment_async(spec: ExperimentSpec, experiment_type: PromptType,
+                                         config: ExperimentConfig,
+                                         cache: Optional[LLMResponseCache] = None,
+                                         checkpoint_path: Optional[Path] = None,
+                                         resume_from: Optional[Checkpoint] = None,
+                                         metrics_setup: Optional[MetricsSetup] = None) -> Tuple[MarketHistory, Dict]:
+    setup = setup_experiment(spec, experiment_type, config, cache, checkpoint_path, resume_from, metrics_setup)
+    # Each experiment runs in its own task, so this doesn't leak into the others
+    set_current_metrics(setup.metrics)
+
+    failed = False
+    last_iteration = setup.completed_rounds
+    config.logger.info('Starting simulation')
+    start_time = time.time()
+    with span('experiment', experiment_span_args(spec)):
+        try:
+            i = setup.completed_rounds
+            async for market_iteration in setup.simulation.simulate_market_async(count=setup.remaining_rounds):
+                record_market_iteration(setup, i, market_iteration, start_time)
+                i += 1
+                last_iteration = i
+                if setup.should_stop(i - 1, market_iteration):
+                    config.logger.info('Price converged, stopping after round %d', last_iteration)
+                    break
+        except Exception:
+            config.logger.exception("Caught an exception:")
+            failed = True
+        finally:
+            config.logger.info("Ran %d iterations", last_iteration)
+
+    return finish_experiment(setup, start_time, failed)
+
+def save_experiment(result_path: Path, market_history: MarketHistory, addit_data: Dict):
+    # Written next to the result and moved into place, a run killed mid write never leaves a partial result
+    temp_path = result_path.with_name(result_path.name + '.tmp')
+    with span('save_experiment', {'path': str(result_path)}):
+        if result_path.suffix == BINARY_RESULT_SUFFIX:
+            save_binary_result(temp_path, market_history, addit_data)
+        else:
+            market_history_transformed = market_history.to_dict()
+            final_state = {
+                'additional_context': addit_data,
+                'market_history': market_history_transformed
+            }
+            with open(temp_path, 'w') as f:
+                json.dump(final_state, f)
+        os.replace(temp_path, result_path)
+
+def is_complete_experiment(result_path: Path) -> bool:
+    if not result_path.exists():
+        return False
+    # An unreadable result counts as missing, the experiment runs again from its checkpoint
+    try:
+        if result_path.suffix == BINARY_RESULT_SUFFIX:
+            return not load_binary_header(result_path)['failed']
+        with open(result_path, 'r') as f:
+            return not json.load(f)['additional_context']['failed']
+    except (AssertionError, KeyError, ValueError, struct.error):
+        return False
+
+def experiment_label(spec: ExperimentSpec) -> str:
+    label = '%s %.2f' % (spec.model.split('/')[-1], spec.price_scale)
+    if spec.seed is not None:
+        label += ' seed%d' % spec.seed
+    return label
+
+def experiment_file_name(template: str, spec: ExperimentSpec, tag_model: bool) -> str:
+    suffix = ''
+    if tag_model:
+        suffix += '_' + spec.model.split('/')[-1]
+    if spec.seed is not None:
+        suffix += '_seed%d' % spec.seed
+    return template % (spec.price_scale, suffix)
+
+def is_over_budget(metrics_setup: MetricsSetup) -> bool:
+    return metrics_setup.budget is not None and metrics_setup.budget.exceeded
+
+async def run_experiments_async(runs: List[ExperimentRun], experiment_type: PromptType, max_concurrency: int, cache: Optional[LLMResponseCache] = None,
+                                metrics_setup: Optional[MetricsSetup] = None):
+    semaphore = asyncio.Semaphore(max_concurrency)
+    metrics_setup = metrics_setup if metrics_setup is not None else MetricsSetup()
+
+    async def run_experiment(run: ExperimentRun):
+        async with semaphore:
+            if is_over_budget(metrics_setup):
+                get_logger().warning('Budget exceeded, skipping %s', run.result_path)
+                return
+            market_history, addit_data = await simulate_full_experiment_async(run.spec, experiment_type, run.config,
+                                                                              cache, run.checkpoint_path,
+                                                                              run.resume_from, metrics_setup)
+        save_experiment(run.result_path, market_history, addit_data)
+
+    await asyncio.gather(*map(run_experiment, runs))
 
 def get_args():
     parser = argparse.ArgumentParser(
@@ -148,14 +430,20 @@ def get_args():
                     choices=['legacy', 'json'],
                     required=True)
     parser.add_argument('--model',
-                help='The type of prompt experiment to run',
+                help='The models to run the experiments with',
                 choices=get_available_models(),
+                nargs='+',
                 required=True)
     parser.add_argument('--round-memory',
                 help='The max amount of past round present in the prompts',
                 type=int,
                 default=100,
                 required=False)
+    parser.add_argument('--compact-history',
+                help='Summarize rounds older than the round memory instead of dropping them',
+                default=False,
+                action='store_true',
+                required=False)
     parser.add_argument('--add-example',
             help='The max amount of past round present in the prompts',
             default=False,
@@ -166,6 +454,150 @@ def get_args():
             default=False,
             action='store_true',
             required=False)
+    parser.add_argument('--scales',
+            help='The price scales to run an experiment for',
+            type=float,
+            nargs='+',
+            default=[1, 3.2, 10],
+            required=False)
+    parser.add_argument('--seeds',
+            help='Seeds for the monopoly price multiplier, one experiment is run per seed',
+            type=int,
+            nargs='+',
+            default=None,
+            required=False)
+    parser.add_argument('--async-mode',
+            help='Run all experiments concurrently in a single event loop',
+            default=False,
+            action='store_true',
+            required=False)
+    parser.add_argument('--max-concurrency',
+            help='The max amount of experiments running at once in async mode',
+            type=int,
+            default=8,
+            required=False)
+    parser.add_argument('--output-format',
+            help='json results, or a compact binary format the analyzer memory maps',
+            choices=['json', 'binary'],
+            default='json',
+            required=False)
+    parser.add_argument('--resume',
+            help='Run tag (the H_M_d_m_Y suffix of the result files) to resume, finished experiments are skipped',
+            default=None,
+            required=False)
+    parser.add_argument('--no-checkpoint',
+            help='Don\'t stream per round checkpoints next to the results',
+            default=False,
+            action='store_true',
+            required=False)
+    parser.add_argument('--cache-path',
+            help='SQLite file used to cache LLM responses, caching is disabled when not given',
+            default=None,
+            required=False)
+    parser.add_argument('--cache-mode',
+            help='record: always query and store, replay: only serve cached responses, read-through: query on miss',
+            choices=list(CACHE_MODES.keys()),
+            default='read-through',
+            required=False)
+    parser.add_argument('--cache-max-mb',
+            help='Size bound of the response cache, least recently used responses are evicted',
+            type=int,
+            default=DEFAULT_MAX_CACHE_SIZE // (1024 * 1024),
+            required=False)
+    parser.add_argument('--log-max-mb',
+            help='Size at which the log files are rotated into gzip archives',
+            type=int,
+            default=DEFAULT_LOG_MAX_BYTES // (1024 * 1024),
+            required=False)
+    parser.add_argument('--log-backups',
+            help='Amount of rotated log archives to keep',
+            type=int,
+            default=DEFAULT_LOG_BACKUP_COUNT,
+            required=False)
+    parser.add_argument('--transcript-sample-rate',
+            help='Fraction of rounds whose full prompts and responses are written to the transcript log',
+            type=float,
+            default=1.0,
+            required=False)
+    parser.add_argument('--retry-attempts',
+            help='Attempts per round before an experiment gives up',
+            type=int,
+            default=LLM_RETRY_COUNT,
+            required=False)
+    parser.add_argument('--retry-strategy',
+            help='resample: send the prompt again from scratch, repair: reply to the failed answer with the parse error',
+            choices=list(RETRY_STRATEGIES.keys()),
+            default='resample',
+            required=False)
+    parser.add_argument('--retry-backoff',
+            help='Seconds to wait after the first failed attempt, doubled on every further failure',
+            type=float,
+            default=0,
+            required=False)
+    parser.add_argument('--round-timeout',
+            help='Seconds the firms of a round get to price, they price concurrently',
+            type=float,
+            default=None,
+            required=False)
+    parser.add_argument('--round-timeout-action',
+            help='fail: end the experiment, keep-last-price: late firms keep their price from the last round',
+            choices=list(TIMEOUT_ACTIONS.keys()),
+            default='fail',
+            required=False)
+    parser.add_argument('--early-stop',
+            help='End an experiment once the agent\'s price has converged, like the analyzer defines it',
+            default=False,
+            action='store_true',
+            required=False)
+    parser.add_argument('--early-stop-window',
+            help='Amount of recent rounds the convergence check looks at',
+            type=int,
+            default=CONVERGENCE_WINDOW,
+            required=False)
+    parser.add_argument('--early-stop-tolerance',
+            help='Relative distance from the converged price every price in the window has to be within',
+            type=float,
+            default=CONVERGENCE_DISTANCE,
+            required=False)
+    parser.add_argument('--early-stop-patience',
+            help='Rounds the price has to stay converged before the experiment ends',
+            type=int,
+            default=DEFAULT_PATIENCE,
+            required=False)
+    parser.add_argument('--metrics-stream',
+            help='JSONL file to append per round metrics (timings, tokens, retries) to',
+            default=None,
+            required=False)
+    parser.add_argument('--max-tokens',
+            help='Token budget for the whole sweep, experiments stop once it is spent',
+            type=int,
+            default=None,
+            required=False)
+    parser.add_argument('--max-dollars',
+            help='Dollar budget for the whole sweep, experiments stop once it is spent',
+            type=float,
+            default=None,
+            required=False)
+    parser.add_argument('--trace',
+            help='Save a Chrome trace (open in Perfetto or chrome://tracing) of every stage next to the results',
+            default=False,
+            action='store_true',
+            required=False)
+    parser.add_argument('--profile',
+            help='Run under cProfile and save the profile next to the results',
+            default=False,
+            action='store_true',
+            required=False)
+    parser.add_argument('--backend',
+            help='together: the Together API, local: a deterministic offline stand-in',
+            choices=['together', 'local'],
+            default='together',
+            required=False)
+    parser.add_argument('--backend-url',
+            help='Base URL of an OpenAI compatible server to use instead of the Together API',
+            default=None,
+            required=False)
+    add_local_backend_args(parser)
 
     return parser.parse_args()
 
@@ -179,25 +611,102 @@ def main():
         prompt_type = PromptType.JSON
 
     path = Path(args.dest_dir)
-    init_logger(path)
+    init_logger(path, max_bytes=args.log_max_mb * 1024 * 1024, backup_count=args.log_backups,
+                transcript_sample_rate=args.transcript_sample_rate)
+
+    if args.backend == 'local':
+        set_backend(LocalBackend(local_backend_config_from_args(args)))
+    else:
+        set_backend(TogetherBackend(base_url=args.backend_url))
+
+    base_config = ExperimentConfig(model=args.model[0],
+                                   use_tooling=args.use_tooling,
+                                   add_example=args.add_example,
+                                   round_memory=args.round_memory,
+                                   compact_history=args.compact_history,
+                                   pricing_timeout=PricingTimeoutPolicy(timeout_seconds=args.round_timeout,
+                                                                        action=TIMEOUT_ACTIONS[args.round_timeout_action]),
+                                   early_stopping=EarlyStoppingPolicy(window=args.early_stop_window,
+                                                                      tolerance=args.early_stop_tolerance,
+                                                                      patience=args.early_stop_patience)
+                                                  if args.early_stop else None,
+                                   retry_policy=RetryPolicy(max_attempts=args.retry_attempts,
+                                                            strategy=RETRY_STRATEGIES[args.retry_strategy],
+                                                            backoff_seconds=args.retry_backoff))
+
+    run_tag = args.resume if args.resume is not None else datetime.now().strftime('%H_%M_%d_%m_%Y')
+    result_suffix = BINARY_RESULT_SUFFIX if args.output_format == 'binary' else '.json'
+    market_history_template = 'market_history_%.2f%s_' + run_tag + result_suffix
 
-    set_chosen_model(args.model)
+    seeds = args.seeds if args.seeds is not None else [None]
+    specs = [ExperimentSpec(price_scale=scale, model=model, seed=seed)
+             for model in args.model for seed in seeds for scale in args.scales]
+    tag_model = len(args.model) > 1
 
-    set_max_round_count(args.round_memory)
-    set_add_example(args.add_example)
-    json_set_add_example(args.add_example)
+    runs: List[ExperimentRun] = []
+    for spec in specs:
+        result_path = path / experiment_file_name(market_history_template, spec, tag_model)
+        checkpoint_path = None if args.no_checkpoint else checkpoint_path_for(result_path)
+        resume_from = None
+        if args.resume is not None:
+            if is_complete_experiment(result_path):
+                get_logger().info('Skipping finished experiment %s', result_path)
+                continue
+            if checkpoint_path is not None and checkpoint_path.exists():
+                resume_from = load_checkpoint(checkpoint_path)
+        runs.append(ExperimentRun(spec=spec, config=base_config.for_experiment(spec.model, experiment_label(spec)),
+                                  result_path=result_path,
+                                  checkpoint_path=checkpoint_path, resume_from=resume_from))
 
-    market_history_template = datetime.now().strftime('market_history_%%.2f_%H_%M_%d_%m_%Y.json')
+    cache = None
+    if args.cache_path is not None:
+        cache = LLMResponseCache(Path(args.cache_path), CACHE_MODES[args.cache_mode],
+                                 max_size_bytes=args.cache_max_mb * 1024 * 1024)
 
-    for scale in [1, 3.2, 10]:
-        market_history, addit_data = simulate_full_experiment(scale, prompt_type, args.use_tooling)
-        market_history_transformed = asdict(market_history)
-        final_state = {
-            'additional_context': addit_data,
-            'market_history': market_history_transformed
-        }
-        with open(path / (market_history_template % scale), 'w') as f:
-            json.dump(final_state, f)
+    metrics_setup = MetricsSetup()
+    if args.max_tokens is not None or args.max_dollars is not None:
+        metrics_setup.budget = MetricsBudget(max_tokens=args.max_tokens, max_dollars=args.max_dollars)
+    if args.metrics_stream is not None:
+        metrics_setup.stream = MetricsStream(Path(args.metrics_stream))
+
+    if args.trace:
+        set_tracer(ChromeTracer())
+    profiler = cProfile.Profile() if args.profile else None
+    if profiler is not None:
+        profiler.enable()
+
+    try:
+        if args.async_mode:
+            assert args.max_concurrency > 0, 'Concurrency limit must be positive'
+            asyncio.run(run_experiments_async(runs, prompt_type, args.max_concurrency, cache, metrics_setup))
+            return
+
+        for run in runs:
+            if is_over_budget(metrics_setup):
+                get_logger().warning('Budget exceeded, stopping the sweep before %s', run.result_path)
+                break
+            market_history, addit_data = simulate_full_experiment(run.spec, prompt_type, run.config, cache=cache,
+                                                                  checkpoint_path=run.checkpoint_path,
+                                                                  resume_from=run.resume_from,
+                                                                  metrics_setup=metrics_setup)
+            save_experiment(run.result_path, market_history, addit_data)
+    finally:
+        if cache is not None:
+            get_logger().info('Response cache stats: %s', cache.get_stats_dict())
+            cache.close()
+        if metrics_setup.budget is not None:
+            get_logger().info('Budget usage: %s', metrics_setup.budget.get_stats_dict())
+        if metrics_setup.stream is not None:
+            metrics_setup.stream.close()
+        if profiler is not None:
+            profiler.disable()
+            profile_path = path / ('profile_%s.prof' % run_tag)
+            profiler.dump_stats(profile_path)
+            get_logger().info('Saved profile to %s', profile_path)
+        if get_tracer() is not None:
+            trace_path = path / ('trace_%s.json' % run_tag)
+            get_tracer().save(trace_path)
+            get_logger().info('Saved trace to %s', trace_path)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,5 +1,7 @@
+from collections.abc import Sequence
 from dataclasses import dataclass
-from typing import List
+import numpy as np
+from typing import Dict, Iterable, List, Optional
 
 @dataclass
 class PricedProduct:
@@ -12,6 +14,127 @@ class PricedProduct:
 class MarketIteration:
     priced_products: List[PricedProduct]
 
-@dataclass
+INITIAL_ROUND_CAPACITY = 64
+
+class MarketIterationsView(Sequence):
+    def __init__(self, market_history: 'MarketHistory'):
+        self.market_history = market_history
+
+    def __len__(self) -> int:
+        return len(self.market_history)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.market_history.iteration(i) for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('Market iteration index out of range')
+        return self.market_history.iteration(index)
+
 class MarketHistory:
-    past_iteration: List[MarketIteration]
\ No newline at end of file
+    # Rounds are stored as (rounds x firms) columns, so a firm's prices are a strided view.
+    # Views stay valid until the next append that grows the buffers.
+    def __init__(self, past_iteration: Optional[Iterable[MarketIteration]] = None):
+        self.firm_ids = np.empty(0, dtype=np.int64)
+        self.firm_columns: Dict[int, int] = {}
+        self._firm_id_list: List[int] = []
+        self.round_count = 0
+        self._prices = np.empty((0, 0))
+        self._quantities_sold = np.empty((0, 0))
+        self._profits = np.empty((0, 0))
+        if past_iteration is not None:
+            for market_iteration in past_iteration:
+                self.append_iteration(market_iteration)
+
+    def __len__(self) -> int:
+        return self.round_count
+
+    def _allocate(self, firm_ids: List[int]):
+        assert len(set(firm_ids)) == len(firm_ids), 'Duplicate firm ids in a round'
+        self.firm_ids = np.array(firm_ids, dtype=np.int64)
+        self._firm_id_list = list(firm_ids)
+        self.firm_columns = {firm_id: column for column, firm_id in enumerate(firm_ids)}
+        shape = (INITIAL_ROUND_CAPACITY, len(firm_ids))
+        self._prices = np.empty(shape)
+        self._quantities_sold = np.empty(shape)
+        self._profits = np.empty(shape)
+
+    def _grow(self):
+        capacity = 2 * self._prices.shape[0]
+        for name in ('_prices', '_quantities_sold', '_profits'):
+            old = getattr(self, name)
+            new = np.empty((capacity, old.shape[1]))
+            new[:self.round_count] = old[:self.round_count]
+            setattr(self, name, new)
+
+    def append_round(self, firm_ids: List[int], prices: Iterable[float],
+                     quantities_sold: Iterable[float], profits: Iterable[float]):
+        if self.round_count == 0 and self.firm_ids.size == 0:
+            self._allocate(firm_ids)
+        assert self._firm_id_list == list(firm_ids), 'Every round must price the same firms in the same order'
+        if self.round_count == self._prices.shape[0]:
+            self._grow()
+        self._prices[self.round_count] = prices
+        self._quantities_sold[self.round_count] = quantities_sold
+        self._profits[self.round_count] = profits
+        self.round_count += 1
+
+    def append_iteration(self, market_iteration: MarketIteration):
+        priced_products = market_iteration.priced_products
+        self.append_round([priced_product.firm_id for priced_product in priced_products],
+                          [priced_product.price for priced_product in priced_products],
+                          [priced_product.quantity_sold for priced_product in priced_products],
+                          [priced_product.profit for priced_product in priced_products])
+
+    @property
+    def firm_count(self) -> int:
+        return self.firm_ids.size
+
+    @property
+    def prices(self) -> np.ndarray:
+        return self._prices[:self.round_count]
+
+    @property
+    def quantities_sold(self) -> np.ndarray:
+        return self._quantities_sold[:self.round_count]
+
+    @property
+    def profits(self) -> np.ndarray:
+        return self._profits[:self.round_count]
+
+    def _firm_column(self, columns: np.ndarray, firm_id: int) -> np.ndarray:
+        if self.round_count == 0:
+            return np.empty(0)
+        return columns[:self.round_count, self.firm_columns[firm_id]]
+
+    def firm_prices(self, firm_id: int) -> np.ndarray:
+        return self._firm_column(self._prices, firm_id)
+
+    def firm_quantities_sold(self, firm_id: int) -> np.ndarray:
+        return self._firm_column(self._quantities_sold, firm_id)
+
+    def firm_profits(self, firm_id: int) -> np.ndarray:
+        return self._firm_column(self._profits, firm_id)
+
+    def iteration(self, index: int) -> MarketIteration:
+        return MarketIteration([PricedProduct(firm_id=int(firm_id),
+                                              price=float(self._prices[index, column]),
+                                              quantity_sold=float(self._quantities_sold[index, column]),
+                                              profit=float(self._profits[index, column]))
+                                for column, firm_id in enumerate(self.firm_ids)])
+
+    @property
+    def past_iteration(self) -> MarketIterationsView:
+        return MarketIterationsView(self)
+
+    def to_dict(self) -> dict:
+        firm_ids = self.firm_ids.tolist()
+        return {'past_iteration': [
+            {'priced_products': [{'firm_id': firm_id,
+                                  'price': price,
+                                  'quantity_sold': quantity_sold,
+                                  'profit': profit}
+                                 for firm_id, price, quantity_sold, profit in zip(firm_ids, *round_columns)]}
+            for round_columns in zip(self.prices.tolist(), self.quantities_sold.tolist(), self.profits.tolist())
+        ]}
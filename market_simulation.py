@@ -1,11 +1,15 @@
+import asyncio
+from concurrent.futures import FIRST_EXCEPTION, Future, ThreadPoolExecutor, wait
+import contextvars
 from dataclasses import dataclass
-from functools import lru_cache
-from math import exp
+from enum import Enum, auto
 import numpy as np
-from typing import List, Dict, Iterator
-from scipy.optimize import minimize
+from typing import AsyncIterator, List, Dict, Iterator, Optional
 
+from logit_demand import logit_demand, monopoly_price
 from market_history import *
+from metrics import stage_timer
+from tracing import span
 from pricing_agent import PricingAgent
 
 @dataclass
@@ -13,67 +17,165 @@ class ProductAndPricer:
     product_quality: float
     pricer: PricingAgent
 
+class TimeoutAction(Enum):
+    FAIL = auto()
+    KEEP_LAST_PRICE = auto()
+
+@dataclass(frozen=True)
+class PricingTimeoutPolicy:
+    # One deadline for the whole round, firms price concurrently so it bounds the round's pricing time
+    timeout_seconds: Optional[float] = None
+    action: TimeoutAction = TimeoutAction.FAIL
+
+class PricingTimeoutError(TimeoutError):
+    pass
 
 class LogitPriceMarketSimulation:
-    def __init__(self, quantity_scale: float, price_scale: float, horz_differn: float, outside_good: float):
+    def __init__(self, quantity_scale: float, price_scale: float, horz_differn: float, outside_good: float,
+                 timeout_policy: PricingTimeoutPolicy = PricingTimeoutPolicy(), concurrent_pricing: bool = True):
+        assert timeout_policy.timeout_seconds is None or timeout_policy.timeout_seconds > 0, \
+            'Pricing timeout must be positive'
+        assert concurrent_pricing or timeout_policy.timeout_seconds is None, 'Pricing timeouts need concurrent pricing'
         self.ququantity_scale = quantity_scale
         self.price_scale = price_scale
         self.horz_differn = horz_differn
         self.outoutside_good = outside_good
         self.products: Dict[int, ProductAndPricer] = {}
-        self.market_iterations: List[MarketIteration] = []
-    
+        self.market_history = MarketHistory()
+        self._firm_ids: List[int] = []
+        self._qualities = np.empty(0)
+        self._costs = np.empty(0)
+        self.timeout_policy = timeout_policy
+        self.concurrent_pricing = concurrent_pricing
+        self.pricing_timeouts: List[dict] = []
+        self._executor: Optional[ThreadPoolExecutor] = None
+        # Threads can't be interrupted, a call that outlived its round answers for the firm in a later round
+        self._outstanding: Dict[int, Future] = {}
+
+    @property
+    def market_iterations(self) -> MarketIterationsView:
+        return self.market_history.past_iteration
+
     def add_firm(self, agent: PricingAgent, quality: float):
         self.products[agent.firm_id] = ProductAndPricer(product_quality=quality, pricer=agent)
+        self._firm_ids = list(self.products.keys())
+        self._qualities = np.array([product.product_quality for product in self.products.values()])
+        self._costs = np.array([product.pricer.get_price_per_unit() for product in self.products.values()])
+        # Sized per firm, the next round starts a bigger one
+        self.close()
 
-    def _simulate_market(self) -> MarketIteration:
+    def _settle_market(self, firm_prices: Dict[int, float]) -> MarketIteration:
+        with stage_timer('simulation'), span('settle_market'):
+            return self._settle_market_untimed(firm_prices)
+
+    def _settle_market_untimed(self, firm_prices: Dict[int, float]) -> MarketIteration:
+        firm_ids = self._firm_ids
+        prices = [firm_prices[firm_id] for firm_id in firm_ids]
+        quantities_sold, profits = logit_demand(prices, self._qualities, self._costs,
+                                                self.price_scale, self.horz_differn, self.outoutside_good,
+                                                self.ququantity_scale)
+
+        self.market_history.append_round(firm_ids, prices, quantities_sold, profits)
+        return MarketIteration([PricedProduct(firm_id=firm_id,
+                                              price=price,
+                                              quantity_sold=quantity_sold,
+                                              profit=profit)
+                                for firm_id, price, quantity_sold, profit in zip(firm_ids, prices,
+                                                                                 quantities_sold.tolist(),
+                                                                                 profits.tolist())])
+
+    def _timed_out(self, late_firm_ids: List[int]) -> Dict[int, float]:
+        round_index = len(self.market_history)
+        self.pricing_timeouts.extend({'round': round_index, 'firm_id': firm_id} for firm_id in late_firm_ids)
+        if self.timeout_policy.action == TimeoutAction.FAIL or round_index == 0:
+            raise PricingTimeoutError('Firms %s didn\'t price within %.2f seconds in round %d' %
+                                      (late_firm_ids, self.timeout_policy.timeout_seconds, round_index + 1))
+        return {firm_id: float(self.market_history.firm_prices(firm_id)[-1]) for firm_id in late_firm_ids}
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=len(self.products), thread_name_prefix='pricing')
+        return self._executor
+
+    def _generate_prices(self) -> Dict[int, float]:
+        if not self.concurrent_pricing or (len(self.products) == 1 and self.timeout_policy.timeout_seconds is None):
+            return {firm_id: product.pricer.generate_price(self.market_history)
+                    for firm_id, product in self.products.items()}
+
+        executor = self._get_executor()
+        futures: Dict[int, Future] = {}
+        for firm_id, product in self.products.items():
+            outstanding = self._outstanding.pop(firm_id, None)
+            if outstanding is not None:
+                futures[firm_id] = outstanding
+                continue
+            # Every call runs in a copy of this context, so metrics still reach the current experiment
+            futures[firm_id] = executor.submit(contextvars.copy_context().run,
+                                               product.pricer.generate_price, self.market_history)
+        wait(futures.values(), timeout=self.timeout_policy.timeout_seconds, return_when=FIRST_EXCEPTION)
+
+        # Results are read in firm order, not completion order, so the same failure is reported every time
         firm_prices: Dict[int, float] = {}
-        firm_logits: Dict[int, float] = {}
-        logits_sum: float = 0
-        market_history = MarketHistory(self.market_iterations)
-
-        for firm_id, pricer in self.products.items():
-            product_price = pricer.pricer.generate_price(market_history)
-            firm_prices[firm_id] = product_price
-            product_price_scaled = product_price / self.price_scale
-            quality_minus_price = pricer.product_quality - product_price_scaled
-            q_m_p_scaled = quality_minus_price / self.horz_differn
-            final_logit = exp(q_m_p_scaled)
-            firm_logits[firm_id] = final_logit
-            logits_sum += final_logit
-        
-        outside_good = exp(self.outoutside_good) / self.horz_differn
-        logits_scale = logits_sum + outside_good
-        market_results: List[PricedProduct] = []
-        for firm_id, firm_logit in firm_logits.items():
-            quantity_sold = self.ququantity_scale * (firm_logit / logits_scale)
-            market_results.append(PricedProduct(
-                firm_id=firm_id,
-                price=firm_prices[firm_id],
-                quantity_sold=quantity_sold,
-                profit=(firm_prices[firm_id] - self.price_scale * self.products[firm_id].pricer.get_price_per_unit()) * quantity_sold
-            ))
-        
-        market_iteration = MarketIteration(market_results)
-        self.market_iterations.append(market_iteration)
-
-        return market_iteration
-        
+        late_firm_ids: List[int] = []
+        for firm_id in self._firm_ids:
+            future = futures[firm_id]
+            if not future.done():
+                late_firm_ids.append(firm_id)
+                self._outstanding[firm_id] = future
+                continue
+            firm_prices[firm_id] = future.result()
+        if len(late_firm_ids) > 0:
+            firm_prices.update(self._timed_out(late_firm_ids))
+        return firm_prices
+
+    async def _generate_prices_async(self) -> Dict[int, float]:
+        if not self.concurrent_pricing:
+            return {firm_id: await product.pricer.generate_price_async(self.market_history)
+                    for firm_id, product in self.products.items()}
+
+        tasks = {firm_id: asyncio.ensure_future(product.pricer.generate_price_async(self.market_history))
+                 for firm_id, product in self.products.items()}
+        _, pending = await asyncio.wait(tasks.values(), timeout=self.timeout_policy.timeout_seconds,
+                                        return_when=asyncio.FIRST_EXCEPTION)
+        # Unlike threads late tasks can be cancelled, so no call outlives its round
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+        firm_prices: Dict[int, float] = {}
+        late_firm_ids: List[int] = []
+        for firm_id in self._firm_ids:
+            task = tasks[firm_id]
+            if task.cancelled():
+                late_firm_ids.append(firm_id)
+                continue
+            firm_prices[firm_id] = task.result()
+        if len(late_firm_ids) > 0:
+            firm_prices.update(self._timed_out(late_firm_ids))
+        return firm_prices
+
+    def _simulate_market(self) -> MarketIteration:
+        with span('simulate_market', {'round': len(self.market_history)}):
+            return self._settle_market(self._generate_prices())
+
+    async def _simulate_market_async(self) -> MarketIteration:
+        with span('simulate_market', {'round': len(self.market_history)}):
+            return self._settle_market(await self._generate_prices_async())
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+
     def simulate_market(self, count=1) -> Iterator[MarketIteration]:
         for i in range(count):
             yield self._simulate_market()
 
-    @lru_cache
+    async def simulate_market_async(self, count=1) -> AsyncIterator[MarketIteration]:
+        for i in range(count):
+            yield await self._simulate_market_async()
+
     def find_monopoly_price(self, product_quality=1, cost_to_make=1):
-        outside_godd = np.exp(self.outoutside_good) / self.horz_differn
-        def calculate_minus_profit(price):
-            price_scaled = price / self.price_scale
-            quality_minus_price = product_quality - price_scaled
-            q_m_p_scaled = quality_minus_price / self.horz_differn
-            logit = np.exp(q_m_p_scaled)
-            q_i = logit / (logit + outside_godd)
-            q_i_scaled = self.ququantity_scale * q_i
-            return -(price - self.price_scale * cost_to_make) * q_i_scaled
-        optimization_result = minimize(calculate_minus_profit, cost_to_make)
-        assert optimization_result.success, "Failed finding optimized price"
-        return optimization_result.x[0]
\ No newline at end of file
+        return monopoly_price(product_quality, cost_to_make, self.price_scale,
+                              self.horz_differn, self.outoutside_good)
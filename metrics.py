@@ -0,0 +1,140 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+import json
+import numpy as np
+from pathlib import Path
+import threading
+import time
+from typing import Dict, Iterator, List, Optional
+
+ROUND_STAGES = ('prompt', 'llm', 'parse', 'simulation')
+ROUND_COUNTERS = ('llm_calls', 'prompt_tokens', 'completion_tokens', 'llm_latency', 'tool_turns')
+METRIC_PERCENTILES = (50, 90, 99)
+
+class BudgetExceededError(RuntimeError):
+    pass
+
+@dataclass
+class MetricsBudget:
+    # Shared by every experiment of a sweep, the first call that goes over stops the sweep
+    max_tokens: Optional[int] = None
+    max_dollars: Optional[float] = None
+    total_tokens: int = 0
+    total_dollars: float = 0
+
+    def __post_init__(self):
+        self._lock = threading.Lock()
+
+    @property
+    def exceeded(self) -> bool:
+        return (self.max_tokens is not None and self.total_tokens > self.max_tokens) or \
+               (self.max_dollars is not None and self.total_dollars > self.max_dollars)
+
+    def charge(self, tokens: int, dollars: float):
+        with self._lock:
+            self.total_tokens += tokens
+            self.total_dollars += dollars
+            if self.exceeded:
+                raise BudgetExceededError('Budget exceeded after %d tokens ($%.4f)' % (self.total_tokens,
+                                                                                      self.total_dollars))
+
+    def get_stats_dict(self) -> dict:
+        return {'max_tokens': self.max_tokens,
+                'max_dollars': self.max_dollars,
+                'total_tokens': self.total_tokens,
+                'total_dollars': self.total_dollars}
+
+class MetricsStream:
+    def __init__(self, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._file = open(path, 'a')
+        self._lock = threading.Lock()
+
+    def write(self, record: dict):
+        with self._lock:
+            self._file.write(json.dumps(record) + '\n')
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+def _new_round() -> Dict[str, float]:
+    return {**{stage + '_seconds': 0.0 for stage in ROUND_STAGES}, **{counter: 0 for counter in ROUND_COUNTERS}}
+
+class ExperimentMetrics:
+    def __init__(self, labels: dict, budget: Optional[MetricsBudget] = None, stream: Optional[MetricsStream] = None):
+        self.labels = labels
+        self.budget = budget
+        self.stream = stream
+        self.rounds: List[dict] = []
+        self._current = _new_round()
+        # Firms of one market price concurrently, stage times and counters add up over all of them
+        self._lock = threading.Lock()
+
+    def add_stage_time(self, stage: str, seconds: float):
+        with self._lock:
+            self._current[stage + '_seconds'] += seconds
+
+    def add_llm_call(self, prompt_tokens: int, completion_tokens: int, latency: float, dollars: float):
+        with self._lock:
+            self._current['llm_calls'] += 1
+            self._current['prompt_tokens'] += prompt_tokens
+            self._current['completion_tokens'] += completion_tokens
+            self._current['llm_latency'] += latency
+        if self.budget is not None:
+            self.budget.charge(prompt_tokens + completion_tokens, dollars)
+
+    def add_tool_turn(self):
+        with self._lock:
+            self._current['tool_turns'] += 1
+
+    def finish_round(self, round_index: int, retries: int) -> dict:
+        with self._lock:
+            record = {'round': round_index, 'retries': retries, **self._current}
+            self._current = _new_round()
+        self.rounds.append(record)
+        if self.stream is not None:
+            self.stream.write({**self.labels, **record})
+        return record
+
+    def get_summary_dict(self) -> dict:
+        summary = {}
+        if len(self.rounds) == 0:
+            return summary
+        for field in [stage + '_seconds' for stage in ROUND_STAGES] + list(ROUND_COUNTERS) + ['retries']:
+            values = np.array([record[field] for record in self.rounds], dtype=np.float64)
+            field_summary = {'total': float(values.sum()), 'mean': float(values.mean()), 'max': float(values.max())}
+            for percentile, value in zip(METRIC_PERCENTILES, np.percentile(values, METRIC_PERCENTILES)):
+                field_summary['p%d' % percentile] = float(value)
+            summary[field] = field_summary
+        return summary
+
+_current_metrics: ContextVar[Optional[ExperimentMetrics]] = ContextVar('current_metrics', default=None)
+
+def set_current_metrics(metrics: Optional[ExperimentMetrics]):
+    # Context variables keep concurrent async experiments apart, every task sees its own value
+    _current_metrics.set(metrics)
+
+def get_current_metrics() -> Optional[ExperimentMetrics]:
+    return _current_metrics.get()
+
+@contextmanager
+def stage_timer(stage: str) -> Iterator[None]:
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics = _current_metrics.get()
+        if metrics is not None:
+            metrics.add_stage_time(stage, time.perf_counter() - start)
+
+def record_llm_call(prompt_tokens: int, completion_tokens: int, latency: float, dollars: float):
+    metrics = _current_metrics.get()
+    if metrics is not None:
+        metrics.add_llm_call(prompt_tokens, completion_tokens, latency, dollars)
+
+def record_tool_turn():
+    metrics = _current_metrics.get()
+    if metrics is not None:
+        metrics.add_tool_turn()
@@ -1,15 +1,22 @@
 import abc
+import asyncio
 from market_history import *
 
 class PricingAgent(abc.ABC):
     def __init__(self, firm_id: int, price_per_unit: float):
         self.firm_id = firm_id
         self.price_per_unit = price_per_unit
+        self._product_position = 0
 
     @abc.abstractmethod
     def generate_price(self, market_history: MarketHistory) -> float:
         pass
 
+    async def generate_price_async(self, market_history: MarketHistory) -> float:
+        # In a thread so a blocking pricer doesn't hold up the loop and round timeouts still apply to it.
+        # A cancelled call can't stop the thread, its price is dropped once it returns.
+        return await asyncio.to_thread(self.generate_price, market_history)
+
     def get_firm_id(self) -> int:
         return self.firm_id
     
@@ -17,6 +24,12 @@ class PricingAgent(abc.ABC):
         return self.price_per_unit
     
     def extract_my_product(self, market_iteration: MarketIteration) -> PricedProduct:
-        options = list(filter(lambda priced_product: priced_product.firm_id == self.firm_id, market_iteration.priced_products))
+        priced_products = market_iteration.priced_products
+        # Firms keep their position between rounds, so the last position is checked first
+        hint = self._product_position
+        if hint < len(priced_products) and priced_products[hint].firm_id == self.firm_id:
+            return priced_products[hint]
+        options = [position for position, priced_product in enumerate(priced_products) if priced_product.firm_id == self.firm_id]
         assert len(options) == 1, "Invalid priced products (%d)" % len(options)
-        return options[0]
+        self._product_position = options[0]
+        return priced_products[options[0]]
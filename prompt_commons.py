@@ -1,28 +1,131 @@
+from collections import deque
+import math
+from typing import Deque, Dict, List, Optional
+
 from llm_pricing_agent import LLMPricingAgent
 from market_history import MarketHistory
-from prompt_costs import SINGLE_MARKET_ROUND_DATA
+from prompt_costs import SINGLE_MARKET_ROUND_DATA, SUMMARIZED_ROUNDS_HEADER, SUMMARY_PRICE_BUCKET, \
+                         SUMMARY_BEST_ROUND, SUMMARY_TREND
+
+# Summarized prices are grouped into buckets 10% wide
+SUMMARY_BUCKET_RATIO = 1.1
+
+class HistorySummary:
+    # Running statistics of the rounds that fell out of the verbatim window, updated as rounds leave it
+    def __init__(self):
+        self.round_count = 0
+        self.first_round = 0
+        self.buckets: Dict[int, List[float]] = {}
+        self.best_round: Optional[int] = None
+        self.best_price = 0.0
+        self.best_profit = -math.inf
+        # Sums for least squares slopes of price and profit over the round number
+        self._sum_x = 0.0
+        self._sum_xx = 0.0
+        self._sum_price = 0.0
+        self._sum_x_price = 0.0
+        self._sum_profit = 0.0
+        self._sum_x_profit = 0.0
+
+    def add(self, round_cnt: int, price: float, profit: float):
+        if self.round_count == 0:
+            self.first_round = round_cnt
+        self.round_count += 1
+        bucket_index = math.floor(math.log(max(price, 1e-9)) / math.log(SUMMARY_BUCKET_RATIO))
+        bucket = self.buckets.setdefault(bucket_index, [0, 0.0])
+        bucket[0] += 1
+        bucket[1] += profit
+        if profit > self.best_profit:
+            self.best_round = round_cnt
+            self.best_price = price
+            self.best_profit = profit
+        self._sum_x += round_cnt
+        self._sum_xx += round_cnt * round_cnt
+        self._sum_price += price
+        self._sum_x_price += round_cnt * price
+        self._sum_profit += profit
+        self._sum_x_profit += round_cnt * profit
+
+    def _slope(self, sum_y: float, sum_xy: float) -> float:
+        denominator = self.round_count * self._sum_xx - self._sum_x * self._sum_x
+        if denominator == 0:
+            return 0.0
+        return (self.round_count * sum_xy - self._sum_x * sum_y) / denominator
+
+    def render(self) -> str:
+        lines = [SUMMARIZED_ROUNDS_HEADER.format(first_round=self.first_round,
+                                                 last_round=self.first_round + self.round_count - 1)]
+        for bucket_index in sorted(self.buckets):
+            count, profit_sum = self.buckets[bucket_index]
+            lines.append(SUMMARY_PRICE_BUCKET.format(low_price=SUMMARY_BUCKET_RATIO ** bucket_index,
+                                                     high_price=SUMMARY_BUCKET_RATIO ** (bucket_index + 1),
+                                                     count=count,
+                                                     average_profit=profit_sum / count))
+        lines.append(SUMMARY_BEST_ROUND.format(best_profit=self.best_profit,
+                                               best_price=self.best_price,
+                                               best_round=self.best_round))
+        lines.append(SUMMARY_TREND.format(price_slope=self._slope(self._sum_price, self._sum_x_price),
+                                          profit_slope=self._slope(self._sum_profit, self._sum_x_profit)))
+        return '\n'.join(lines)
+
+class MarketHistoryRenderer:
+    def __init__(self, round_memory: int, compact: bool = False):
+        assert not compact or round_memory > 0, 'Compacting the history needs a bounded round memory'
+        self.round_memory = round_memory
+        self.compact = compact
+        self.reset()
 
-MAX_ROUND_COUNT = 100
+    def reset(self):
+        # A round memory of 0 keeps the whole history, like slicing with [-0:] did
+        self.rendered_lines: Deque[str] = deque(maxlen=self.round_memory if self.round_memory > 0 else None)
+        self.rendered_rounds = 0
+        self.summary = HistorySummary()
+        self._source: Optional[MarketHistory] = None
 
-def set_max_round_count(count: int):
-    assert count >= 0, 'Can\'t have a negative count'
-    global MAX_ROUND_COUNT
-    MAX_ROUND_COUNT = count
+    def render(self, market_history: MarketHistory) -> str:
+        round_count = len(market_history)
+        if market_history is not self._source or round_count < self.rendered_rounds:
+            self.reset()
+            self._source = market_history
 
-def get_max_round_count() -> int:
-    return MAX_ROUND_COUNT
+        first_round = self.rendered_rounds
+        if self.rendered_lines.maxlen is not None:
+            first_round = max(first_round, round_count - self.rendered_lines.maxlen)
+        if first_round < round_count:
+            assert market_history.firm_count == 1, "Expecting monopoly setting"
+            new_rounds = zip(market_history.prices[first_round:, 0].tolist(),
+                             market_history.quantities_sold[first_round:, 0].tolist(),
+                             market_history.profits[first_round:, 0].tolist())
+            for i, (price, quantity_sold, profit) in enumerate(new_rounds, start=first_round + 1):
+                self.rendered_lines.append(SINGLE_MARKET_ROUND_DATA.format(
+                    round_cnt=i,
+                    my_price=price,
+                    my_quantity=quantity_sold,
+                    my_profit=profit
+                ))
+        self.rendered_rounds = round_count
 
-def generate_market_history(_: LLMPricingAgent, market_history: MarketHistory) -> str:
+        if not self.compact:
+            return '\n'.join(self.rendered_lines)
+        self._summarize(market_history)
+        if self.summary.round_count == 0:
+            return '\n'.join(self.rendered_lines)
+        return self.summary.render() + '\n' + '\n'.join(self.rendered_lines)
 
-    accumilative_history = []
-    for i, past_iteration in enumerate(market_history.past_iteration, start=1):
-        assert len(past_iteration.priced_products) == 1, "Expecting monopoly setting"
-        my_past_priced = past_iteration.priced_products[0]
-        accumilative_history.append(SINGLE_MARKET_ROUND_DATA.format(
-            round_cnt=i,
-            my_price=my_past_priced.price,
-            my_quantity=my_past_priced.quantity_sold,
-            my_profit=my_past_priced.profit
-        ))
+    def _summarize(self, market_history: MarketHistory):
+        first_round = self.summary.round_count
+        last_round = len(market_history) - self.round_memory
+        if first_round >= last_round:
+            return
+        evicted_rounds = zip(market_history.prices[first_round:last_round, 0].tolist(),
+                             market_history.profits[first_round:last_round, 0].tolist())
+        for i, (price, profit) in enumerate(evicted_rounds, start=first_round + 1):
+            self.summary.add(i, price, profit)
 
-    return '\n'.join(accumilative_history[-MAX_ROUND_COUNT:])
\ No newline at end of file
+def generate_market_history(llm_model: LLMPricingAgent, market_history: MarketHistory) -> str:
+    config = llm_model.config
+    renderer = llm_model.history_renderer
+    if renderer is None or renderer.round_memory != config.round_memory or renderer.compact != config.compact_history:
+        renderer = MarketHistoryRenderer(config.round_memory, config.compact_history)
+        llm_model.history_renderer = renderer
+    return renderer.render(market_history)
@@ -82,3 +82,14 @@ content, so make sure to carry over important insights between pricing rounds.""
 PLAN_CONTENT_INDICATOR = 'New content for PLANS.txt:'
 INSIGHT_CONTENT_INDICATOR = 'New content for INSIGHTS.txt:'
 CHOSEN_PRICE_INDICATOR = 'My chosen price:'
+
+REPAIR_REQUEST = """Your previous answer couldn't be used: {error}.
+Please answer again, following the required format exactly."""
+
+SUMMARIZED_ROUNDS_HEADER = """Summary of rounds {first_round} to {last_round}:"""
+
+SUMMARY_PRICE_BUCKET = """    - Prices {low_price:.2f} to {high_price:.2f}: {count} rounds, average profit {average_profit:.2f}"""
+
+SUMMARY_BEST_ROUND = """    - Best profit {best_profit:.2f} at price {best_price:.2f} (round {best_round})"""
+
+SUMMARY_TREND = """    - Trend: price changed by {price_slope:+.3f} and profit by {profit_slope:+.3f} per round"""
@@ -0,0 +1,80 @@
+from dataclasses import dataclass
+import json
+import numpy as np
+from pathlib import Path
+import struct
+from typing import Dict
+
+from market_history import MarketHistory
+
+BINARY_RESULT_SUFFIX = '.mkth'
+BINARY_RESULT_MAGIC = b'MKTHIST1'
+BINARY_ALIGNMENT = 64
+_HEADER_LENGTH = struct.Struct('<Q')
+
+# Layout: magic, little endian header length, JSON header, then every column aligned to 64 bytes.
+# Column offsets in the header are relative to the aligned start of the data section.
+
+def _align(offset: int) -> int:
+    return -(-offset // BINARY_ALIGNMENT) * BINARY_ALIGNMENT
+
+def is_binary_result(path: Path) -> bool:
+    with open(path, 'rb') as f:
+        return f.read(len(BINARY_RESULT_MAGIC)) == BINARY_RESULT_MAGIC
+
+def save_binary_result(path: Path, market_history: MarketHistory, additional_context: dict):
+    columns = {
+        'firm_ids': market_history.firm_ids,
+        'prices': market_history.prices,
+        'quantities_sold': market_history.quantities_sold,
+        'profits': market_history.profits,
+    }
+    column_headers = {}
+    offset = 0
+    for name, column in columns.items():
+        column_headers[name] = {'dtype': column.dtype.str, 'shape': list(column.shape), 'offset': offset}
+        offset = _align(offset + column.nbytes)
+    header = json.dumps({'additional_context': additional_context, 'columns': column_headers}).encode('utf-8')
+
+    with open(path, 'wb') as f:
+        f.write(BINARY_RESULT_MAGIC)
+        f.write(_HEADER_LENGTH.pack(len(header)))
+        f.write(header)
+        data_start = _align(f.tell())
+        for name, column in columns.items():
+            f.seek(data_start + column_headers[name]['offset'])
+            f.write(memoryview(np.ascontiguousarray(column)).cast('B'))
+
+@dataclass
+class BinaryResult:
+    additional_context: dict
+    columns: Dict[str, np.ndarray]
+
+    @property
+    def prices(self) -> np.ndarray:
+        return self.columns['prices']
+
+def _read_header(f) -> dict:
+    assert f.read(len(BINARY_RESULT_MAGIC)) == BINARY_RESULT_MAGIC, 'Not a binary result file'
+    header_length, = _HEADER_LENGTH.unpack(f.read(_HEADER_LENGTH.size))
+    return json.loads(f.read(header_length))
+
+def load_binary_header(path: Path) -> dict:
+    with open(path, 'rb') as f:
+        return _read_header(f)['additional_context']
+
+def load_binary_result(path: Path) -> BinaryResult:
+    with open(path, 'rb') as f:
+        header = _read_header(f)
+        data_start = _align(f.tell())
+
+    columns = {}
+    for name, column_header in header['columns'].items():
+        shape = tuple(column_header['shape'])
+        if 0 in shape:
+            # Empty columns can't be memory mapped
+            columns[name] = np.empty(shape, dtype=column_header['dtype'])
+            continue
+        columns[name] = np.memmap(path, dtype=column_header['dtype'], mode='r',
+                                  offset=data_start + column_header['offset'], shape=shape)
+    return BinaryResult(additional_context=header['additional_context'], columns=columns)
@@ -0,0 +1,309 @@
+import argparse
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from dataclasses import asdict, dataclass, field, fields
+from datetime import datetime
+import itertools
+import json
+import multiprocessing
+import os
+from pathlib import Path
+import time
+from typing import Dict, List, Optional
+
+from early_stopping import EarlyStoppingPolicy
+from experiment_checkpoint import checkpoint_path_for, load_checkpoint
+from experiment_config import ExperimentConfig, LLM_RETRY_COUNT, RetryPolicy
+from llm_backends import LocalBackend, LocalBackendConfig, TogetherBackend
+from logger import get_experiment_logger, get_logger, init_logger
+from main import ExperimentSpec, PromptType, RETRY_STRATEGIES, TIMEOUT_ACTIONS, is_complete_experiment, \
+                 save_experiment, simulate_full_experiment
+from market_simulation import PricingTimeoutPolicy
+from result_format import BINARY_RESULT_SUFFIX
+from together_endpoint_predictor import get_available_models, set_backend
+
+MANIFEST_NAME = 'sweep_manifest.json'
+PROMPT_TYPES = {
+    'legacy': PromptType.LEGACY,
+    'json': PromptType.JSON,
+}
+
+@dataclass
+class SweepSpec:
+    # Every list is one axis of the grid, the sweep runs their full product repetitions times
+    models: List[str]
+    prompt_types: List[str] = field(default_factory=lambda: ['legacy'])
+    round_memories: List[int] = field(default_factory=lambda: [100])
+    add_example: List[bool] = field(default_factory=lambda: [False])
+    use_tooling: List[bool] = field(default_factory=lambda: [False])
+    scales: List[float] = field(default_factory=lambda: [1, 3.2, 10])
+    seeds: List[Optional[int]] = field(default_factory=lambda: [None])
+    repetitions: int = 1
+    max_workers: int = 4
+    # Max experiments running at once per model, models not listed are only bound by max_workers
+    model_concurrency: Dict[str, int] = field(default_factory=dict)
+    compact_history: bool = False
+    output_format: str = 'json'
+    retry_attempts: int = LLM_RETRY_COUNT
+    retry_strategy: str = 'resample'
+    # Seconds after the first failed attempt, multiplied after every further failure up to the cap
+    retry_backoff: float = RetryPolicy.backoff_seconds
+    retry_backoff_multiplier: float = RetryPolicy.backoff_multiplier
+    retry_max_backoff: float = RetryPolicy.max_backoff_seconds
+    round_timeout: Optional[float] = None
+    round_timeout_action: str = 'fail'
+    # Fields of EarlyStoppingPolicy, runs the full length when missing
+    early_stopping: Optional[dict] = None
+    backend: str = 'together'
+    backend_url: Optional[str] = None
+    local_backend: dict = field(default_factory=dict)
+
+    def validate(self):
+        for model in self.models:
+            assert model in get_available_models(), 'Unknown model %s' % model
+        for prompt_type in self.prompt_types:
+            assert prompt_type in PROMPT_TYPES, 'Unknown prompt type %s' % prompt_type
+        for model, limit in self.model_concurrency.items():
+            assert model in self.models, 'Concurrency limit for %s which isn\'t part of the sweep' % model
+            assert limit > 0, 'Concurrency limit of %s must be positive' % model
+        assert self.repetitions > 0, 'Need at least one repetition'
+        assert self.max_workers > 0, 'Need at least one worker'
+        assert not self.compact_history or all(memory > 0 for memory in self.round_memories), \
+            'Compact history needs a positive round memory'
+        assert self.output_format in ('json', 'binary'), 'Unknown output format %s' % self.output_format
+        assert self.retry_strategy in RETRY_STRATEGIES, 'Unknown retry strategy %s' % self.retry_strategy
+        assert self.round_timeout_action in TIMEOUT_ACTIONS, 'Unknown timeout action %s' % self.round_timeout_action
+        assert self.backend in ('together', 'local'), 'Unknown backend %s' % self.backend
+        # Built here so a bad entry fails the sweep before any worker starts, not inside every worker
+        self.get_retry_policy()
+        check_known_keys(LocalBackendConfig, self.local_backend, 'local backend')
+        LocalBackend(LocalBackendConfig(**self.local_backend))
+        if self.early_stopping is not None:
+            check_known_keys(EarlyStoppingPolicy, self.early_stopping, 'early stopping')
+            EarlyStoppingPolicy(**self.early_stopping)
+
+    def get_retry_policy(self) -> RetryPolicy:
+        return RetryPolicy(max_attempts=self.retry_attempts,
+                           strategy=RETRY_STRATEGIES[self.retry_strategy],
+                           backoff_seconds=self.retry_backoff,
+                           backoff_multiplier=self.retry_backoff_multiplier,
+                           max_backoff_seconds=self.retry_max_backoff)
+
+def check_known_keys(cls, data: dict, name: str):
+    known = {known_field.name for known_field in fields(cls)}
+    unknown = set(data.keys()) - known
+    assert len(unknown) == 0, 'Unknown %s keys %s' % (name, sorted(unknown))
+
+def load_sweep_spec(path: Path) -> SweepSpec:
+    with open(path, 'r') as f:
+        data = json.load(f)
+    check_known_keys(SweepSpec, data, 'sweep spec')
+    spec = SweepSpec(**data)
+    spec.validate()
+    return spec
+
+@dataclass(frozen=True)
+class SweepConfiguration:
+    model: str
+    prompt_type: str
+    round_memory: int
+    add_example: bool
+    use_tooling: bool
+    price_scale: float
+    seed: Optional[int]
+    repetition: int
+
+    @property
+    def name(self) -> str:
+        # Names only depend on the configuration, a rerun of the same sweep finds the outputs of the last one
+        name = '%s_%s_mem%d' % (self.model.split('/')[-1], self.prompt_type, self.round_memory)
+        if self.add_example:
+            name += '_example'
+        if self.use_tooling:
+            name += '_tooling'
+        name += '_%.2f' % self.price_scale
+        if self.seed is not None:
+            name += '_seed%d' % self.seed
+        return name + '_rep%d' % self.repetition
+
+def expand_sweep(spec: SweepSpec) -> List[SweepConfiguration]:
+    return [SweepConfiguration(*values) for values in itertools.product(spec.models, spec.prompt_types,
+                                                                        spec.round_memories, spec.add_example,
+                                                                        spec.use_tooling, spec.scales, spec.seeds,
+                                                                        range(spec.repetitions))]
+
+def result_path_for(spec: SweepSpec, dest_dir: Path, configuration: SweepConfiguration) -> Path:
+    suffix = BINARY_RESULT_SUFFIX if spec.output_format == 'binary' else '.json'
+    return dest_dir / ('market_history_' + configuration.name + suffix)
+
+def init_worker(spec: SweepSpec, log_dir: Path):
+    # Runs once in every pool process, each one logs to its own files
+    init_logger(log_dir / ('worker_%d' % os.getpid()))
+    if spec.backend == 'local':
+        set_backend(LocalBackend(LocalBackendConfig(**spec.local_backend)))
+    else:
+        set_backend(TogetherBackend(base_url=spec.backend_url))
+
+def run_configuration(spec: SweepSpec, configuration: SweepConfiguration, result_path: Path,
+                      checkpoint_path: Path) -> dict:
+    config = ExperimentConfig(model=configuration.model,
+                              use_tooling=configuration.use_tooling,
+                              add_example=configuration.add_example,
+                              round_memory=configuration.round_memory,
+                              compact_history=spec.compact_history,
+                              pricing_timeout=PricingTimeoutPolicy(timeout_seconds=spec.round_timeout,
+                                                                   action=TIMEOUT_ACTIONS[spec.round_timeout_action]),
+                              early_stopping=EarlyStoppingPolicy(**spec.early_stopping)
+                                             if spec.early_stopping is not None else None,
+                              retry_policy=spec.get_retry_policy(),
+                              logger=get_experiment_logger(configuration.name))
+    resume_from = load_checkpoint(checkpoint_path) if checkpoint_path.exists() else None
+    market_history, addit_data = simulate_full_experiment(ExperimentSpec(price_scale=configuration.price_scale,
+                                                                         model=configuration.model,
+                                                                         seed=configuration.seed),
+                                                          PROMPT_TYPES[configuration.prompt_type],
+                                                          config,
+                                                          checkpoint_path=checkpoint_path,
+                                                          resume_from=resume_from)
+    addit_data['sweep_configuration'] = asdict(configuration)
+    save_experiment(result_path, market_history, addit_data)
+    return {'failed': addit_data['failed'],
+            'stopped_round': addit_data['early_stopping']['stopped_round']
+                             if addit_data['early_stopping'] is not None else None,
+            'resumed_rounds': resume_from.completed_rounds if resume_from is not None else 0,
+            'total_iterations': addit_data['total_iterations'],
+            'total_time': addit_data['total_time']}
+
+class SweepManifest:
+    # Rewritten after every finished configuration, so it is always a complete picture of the sweep so far
+    def __init__(self, path: Path, spec: SweepSpec):
+        self.path = path
+        self.data = {'spec': asdict(spec),
+                     'started': datetime.now().isoformat(),
+                     'finished': None,
+                     'configurations': {}}
+
+    def update(self, configuration: SweepConfiguration, result_path: Path, status: str, **details):
+        self.data['configurations'][configuration.name] = {'configuration': asdict(configuration),
+                                                           'result_path': str(result_path),
+                                                           'status': status,
+                                                           **details}
+        self.save()
+
+    def get_status_counts(self) -> Dict[str, int]:
+        counts: Dict[str, int] = {}
+        for entry in self.data['configurations'].values():
+            counts[entry['status']] = counts.get(entry['status'], 0) + 1
+        return counts
+
+    def save(self):
+        temp_path = self.path.with_name(self.path.name + '.tmp')
+        with open(temp_path, 'w') as f:
+            json.dump(self.data, f, indent=4)
+        os.replace(temp_path, self.path)
+
+def run_sweep(spec: SweepSpec, dest_dir: Path) -> SweepManifest:
+    dest_dir.mkdir(parents=True, exist_ok=True)
+    manifest = SweepManifest(dest_dir / MANIFEST_NAME, spec)
+    configurations = expand_sweep(spec)
+    get_logger().info('Sweep of %d configurations', len(configurations))
+
+    pending: List[SweepConfiguration] = []
+    for configuration in configurations:
+        result_path = result_path_for(spec, dest_dir, configuration)
+        if is_complete_experiment(result_path):
+            manifest.update(configuration, result_path, 'skipped')
+        else:
+            pending.append(configuration)
+    get_logger().info('Skipping %d configurations with complete outputs', len(configurations) - len(pending))
+    manifest.save()
+
+    running: Dict[Future, SweepConfiguration] = {}
+    started: Dict[SweepConfiguration, float] = {}
+    running_per_model: Dict[str, int] = {model: 0 for model in spec.models}
+
+    def can_start(configuration: SweepConfiguration) -> bool:
+        limit = spec.model_concurrency.get(configuration.model, spec.max_workers)
+        return running_per_model[configuration.model] < limit
+
+    # Spawned workers start with clean globals instead of a copy of the scheduler's logger thread
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=spec.max_workers, mp_context=context,
+                             initializer=init_worker, initargs=(spec, dest_dir / 'logs')) as executor:
+        while len(pending) > 0 or len(running) > 0:
+            # Fill free workers in grid order, skipping models that are at their limit
+            for configuration in list(pending):
+                if len(running) >= spec.max_workers:
+                    break
+                if not can_start(configuration):
+                    continue
+                pending.remove(configuration)
+                result_path = result_path_for(spec, dest_dir, configuration)
+                future = executor.submit(run_configuration, spec, configuration, result_path,
+                                         checkpoint_path_for(result_path))
+                running[future] = configuration
+                started[configuration] = time.time()
+                running_per_model[configuration.model] += 1
+                get_logger().info('Started %s', configuration.name)
+
+            done, _ = wait(running.keys(), return_when=FIRST_COMPLETED)
+            for future in done:
+                configuration = running.pop(future)
+                running_per_model[configuration.model] -= 1
+                result_path = result_path_for(spec, dest_dir, configuration)
+                elapsed = time.time() - started[configuration]
+                error = future.exception()
+                if error is not None:
+                    get_logger().error('%s raised %r', configuration.name, error)
+                    manifest.update(configuration, result_path, 'error', elapsed=elapsed, error=repr(error))
+                    continue
+                result = future.result()
+                status = 'failed' if result['failed'] else 'completed'
+                get_logger().info('%s %s after %.2f seconds', configuration.name, status, elapsed)
+                manifest.update(configuration, result_path, status, elapsed=elapsed, **result)
+
+    manifest.data['finished'] = datetime.now().isoformat()
+    manifest.save()
+    get_logger().info('Sweep finished: %s', manifest.get_status_counts())
+    return manifest
+
+def get_args():
+    parser = argparse.ArgumentParser(
+                prog='sweep',
+                description='Run a grid of pricing experiments over a process pool')
+    parser.add_argument('--spec',
+            help='JSON sweep spec, its keys are the fields of SweepSpec',
+            required=True)
+    parser.add_argument('--dest-dir',
+            help='Location to save the results, logs and the sweep manifest',
+            required=True)
+    parser.add_argument('--max-workers',
+            help='Overrides the amount of worker processes in the spec',
+            type=int,
+            default=None,
+            required=False)
+    parser.add_argument('--dry-run',
+            help='Only list the configurations that would run',
+            default=False,
+            action='store_true',
+            required=False)
+    return parser.parse_args()
+
+def main():
+    args = get_args()
+    spec = load_sweep_spec(Path(args.spec))
+    if args.max_workers is not None:
+        spec.max_workers = args.max_workers
+        spec.validate()
+    dest_dir = Path(args.dest_dir)
+
+    if args.dry_run:
+        for configuration in expand_sweep(spec):
+            result_path = result_path_for(spec, dest_dir, configuration)
+            print('%s%s' % (configuration.name, ' (complete)' if is_complete_experiment(result_path) else ''))
+        return
+
+    init_logger(dest_dir)
+    run_sweep(spec, dest_dir)
+
+if __name__ == "__main__":
+    main()
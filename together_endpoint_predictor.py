@@ -1,12 +1,16 @@
+import asyncio
 import json
-from together import Together
+import time
 import traceback
-from typing import List
-import regex
+from typing import List, Optional, Sequence
 
-from logger import get_logger
-
-CHOSEN_MODEL = None
+from experiment_config import ExperimentConfig, ToolingCounters
+from expression_engine import evaluate_expression_isolated
+from json_scanner import iter_json_objects
+from llm_backends import Completion, LLMBackend, TogetherBackend
+from llm_cache import LLMResponseCache
+from metrics import record_llm_call, record_tool_turn
+from tracing import span
 
 TOOLING_PROMPT = """You are an experienced market analyst. Whenever you wish to calculate something, you may output:
 {"expr": "<math expr>"}
@@ -24,54 +28,32 @@ You are not good with math, so please don't perform any calculations yourself or
 The real user is unaware of this syntax, so your final answers can never contain the expr.
 You may only submit one expr each time.
 """
-USE_TOOLING = False
-json_regex_finder = regex.compile(r'\{(?:[^{}]|(?R))*\}')
-
-def set_using_tooling(use_tooling: bool):
-    global USE_TOOLING
-    USE_TOOLING = use_tooling
+# Dollars per million tokens, prompt and completion tokens cost the same on these models
+MODEL_PRICES = {
+    'meta-llama/Llama-2-7b-chat-hf': 0.2,
+    'meta-llama/Meta-Llama-3-8B-Instruct-Turbo': 0.18,
+}
 
 def get_available_models() -> List[str]:
-    return ['meta-llama/Llama-2-7b-chat-hf', 'meta-llama/Meta-Llama-3-8B-Instruct-Turbo']
-
-def set_chosen_model(model: str):
-    assert model in get_available_models()
-
-    global CHOSEN_MODEL
-    CHOSEN_MODEL = model
+    return list(MODEL_PRICES.keys())
 
-def get_chosen_model() -> str:
-    assert CHOSEN_MODEL != None
-    return CHOSEN_MODEL
+BACKEND: Optional[LLMBackend] = None
 
-expr_hit_count = 0
-invalid_expr_hit_count = 0
+def set_backend(backend: LLMBackend):
+    global BACKEND
+    BACKEND = backend
 
-def reset_tooling_info():
-    global expr_hit_count
-    global invalid_expr_hit_count
-    expr_hit_count = 0
-    invalid_expr_hit_count = 0
-
-def get_tooling_info_dict() -> dict:
-    return {
-        'expr_hit_count': expr_hit_count,
-        'invalid_expr_hit_count': invalid_expr_hit_count,
-    }
-
-client = Together()
+def get_backend() -> LLMBackend:
+    global BACKEND
+    if BACKEND is None:
+        BACKEND = TogetherBackend()
+    return BACKEND
 
 MAX_EXPRESION_RESPONSE_SIZE = 300
 
-def genereate_text(message, 
-                   max_tokens=1500, 
-                   temperature=0.7, 
-                   top_p=0.7,
-                   top_k=50,
-                   local_varaibles={}):
-    global expr_hit_count, invalid_expr_hit_count
+def build_messages(message, use_tooling: bool, conversation: Sequence[dict] = ()) -> List[dict]:
     messages = []
-    if USE_TOOLING:
+    if use_tooling:
         messages.append({
                     "role": "system",
                     "content": TOOLING_PROMPT
@@ -80,67 +62,161 @@ def genereate_text(message,
                     "role": "user",
                     "content": message
                 })
+    messages.extend(conversation)
+    return messages
+
+def handle_tool_request(agent_response, messages, local_varaibles, config: ExperimentConfig) -> bool:
+    counters: ToolingCounters = config.tooling
+    # The latest request is the one the agent waits on
+    for request in iter_json_objects(agent_response, reverse=True):
+        try:
+            if 'expr' not in request:
+                continue
+            config.logger.debug('Detected possible expression:')
+            config.logger.debug('\t%s', request)
+            request_dict = json.loads(request.strip())
+            if 'expr' in request_dict:
+                expr = request_dict['expr']
+                message_to_assistant = None
+                counters.expr_hit_count += 1
+                try:
+                    with span('tool_expression'):
+                        result = evaluate_expression_isolated(expr, local_varaibles)
+                    message_to_assistant = json.dumps({"result": str(result)})
+                except Exception as e:
+                    counters.invalid_expr_hit_count += 1
+                    message_to_assistant = json.dumps({"error": ''.join(traceback.format_exception_only(type(e), e)).strip()})
+                if len(message_to_assistant) > MAX_EXPRESION_RESPONSE_SIZE:
+                    message_to_assistant = json.dumps({"error": "Response too long"})
+                messages.append({
+                            "role": "assistant",
+                            "content": agent_response
+                        })
+                messages.append({
+                                "role": "user",
+                                "content": message_to_assistant
+                            })
+                config.logger.debug('Assistant requested:\n%s', agent_response)
+                config.logger.debug('Got in response:\n%s', message_to_assistant)
+                return True
+        except:
+            pass
+    return False
+
+def build_request(model, messages, max_tokens, temperature, top_p, top_k) -> dict:
+    return {
+        'model': model,
+        'messages': messages,
+        'max_tokens': max_tokens,
+        'temperature': temperature,
+        'top_p': top_p,
+        'top_k': top_k,
+        'repetition_penalty': 1,
+    }
+
+def record_completion_usage(request: dict, completion: Completion, latency: float):
+    tokens = completion.prompt_tokens + completion.completion_tokens
+    dollars = tokens * MODEL_PRICES.get(request['model'], 0) / 1e6
+    record_llm_call(completion.prompt_tokens, completion.completion_tokens, latency, dollars)
+
+def request_completion(request: dict) -> str:
+    start = time.perf_counter()
+    with span('llm_request', {'model': request['model']}):
+        completion = get_backend().complete(request)
+    record_completion_usage(request, completion, time.perf_counter() - start)
+    return completion.content
+
+async def request_completion_async(request: dict) -> str:
+    start = time.perf_counter()
+    with span('llm_request', {'model': request['model']}):
+        completion = await get_backend().complete_async(request)
+    record_completion_usage(request, completion, time.perf_counter() - start)
+    return completion.content
+
+def genereate_text(message,
+                   config: ExperimentConfig,
+                   max_tokens=1500, 
+                   temperature=0.7, 
+                   top_p=0.7,
+                   top_k=50,
+                   local_varaibles={},
+                   cache: Optional[LLMResponseCache] = None,
+                   conversation: Sequence[dict] = (),
+                   attempt: int = 0):
+    messages = build_messages(message, config.use_tooling, conversation)
     while True:
-        response = client.chat.completions.create(
-            model=CHOSEN_MODEL,
-            messages=messages,
-            max_tokens=max_tokens,
-            temperature=temperature,
-            top_p=top_p,
-            top_k=top_k,
-            repetition_penalty=1,
-        )
-        agent_response = response.choices[0].message.content
-        if not USE_TOOLING:
+        request = build_request(config.model, messages, max_tokens, temperature, top_p, top_k)
+        if cache is None:
+            agent_response = request_completion(request)
+        else:
+            agent_response = cache.get_or_call(request, config.use_tooling, request_completion, attempt)
+        if not config.use_tooling:
             return agent_response
-        possible_requests = json_regex_finder.findall(agent_response)
-        used_tool = False
-        for request in possible_requests[::-1]:
-            try:
-                if 'expr' not in request:
-                    continue
-                get_logger().debug('Detected possible expression:')
-                get_logger().debug('\t%s' % request)
-                request_dict = json.loads(request.strip())
-                if 'expr' in request_dict:
-                    expr = request_dict['expr']
-                    message_to_assistant = None
-                    expr_hit_count += 1
-                    try:
-                        result = eval(expr, {}, local_varaibles)
-                        message_to_assistant = json.dumps({"result": str(result)})
-                    except:
-                        invalid_expr_hit_count += 1
-                        message_to_assistant = json.dumps({"error": traceback.format_exc()})
-                    if len(message_to_assistant) > MAX_EXPRESION_RESPONSE_SIZE:
-                        message_to_assistant = json.dumps({"error": "Response too long"})
-                    messages.append({
-                                "role": "assistant",
-                                "content": agent_response
-                            })
-                    messages.append({
-                                    "role": "user",
-                                    "content": message_to_assistant
-                                })
-                    get_logger().debug('Assistant requested:\n%s' % agent_response)
-                    get_logger().debug('Got in response:\n%s' % message_to_assistant)
-                    used_tool = True
-                    break
-            except:
-                pass
-        if not used_tool:
+        if not handle_tool_request(agent_response, messages, local_varaibles, config):
+            break
+        record_tool_turn()
+    return agent_response
+
+async def genereate_text_async(message,
+                               config: ExperimentConfig,
+                               max_tokens=1500,
+                               temperature=0.7,
+                               top_p=0.7,
+                               top_k=50,
+                               local_varaibles={},
+                               cache: Optional[LLMResponseCache] = None,
+                               conversation: Sequence[dict] = (),
+                               attempt: int = 0):
+    messages = build_messages(message, config.use_tooling, conversation)
+    while True:
+        request = build_request(config.model, messages, max_tokens, temperature, top_p, top_k)
+        if cache is None:
+            agent_response = await request_completion_async(request)
+        else:
+            agent_response = await cache.get_or_call_async(request, config.use_tooling, request_completion_async,
+                                                            attempt)
+        if not config.use_tooling:
+            return agent_response
+        # Evaluating can take up to the expression's time limit, which shouldn't block the other experiments
+        if not await asyncio.to_thread(handle_tool_request, agent_response, messages, local_varaibles, config):
             break
+        record_tool_turn()
     return agent_response
 
-def generate_specialized_text(max_tokens=None, 
+def generate_specialized_text(config: ExperimentConfig,
+                              max_tokens=None, 
                               temperature=0.7, 
                               top_p=0.7,
-                              top_k=50):
-    def generate_text_spec(message, local_varaibles={}):
+                              top_k=50,
+                              cache: Optional[LLMResponseCache] = None):
+    def generate_text_spec(message, local_varaibles={}, conversation=(), attempt=0):
         return genereate_text(message,
+                              config,
                               max_tokens=max_tokens,
                               temperature=temperature,
                               top_p=top_p,
                               top_k=top_k,
-                              local_varaibles=local_varaibles)
-    return generate_text_spec
\ No newline at end of file
+                              local_varaibles=local_varaibles,
+                              cache=cache,
+                              conversation=conversation,
+                              attempt=attempt)
+    return generate_text_spec
+
+def generate_specialized_text_async(config: ExperimentConfig,
+                                    max_tokens=None,
+                                    temperature=0.7,
+                                    top_p=0.7,
+                                    top_k=50,
+                                    cache: Optional[LLMResponseCache] = None):
+    async def generate_text_spec(message, local_varaibles={}, conversation=(), attempt=0):
+        return await genereate_text_async(message,
+                                          config,
+                                          max_tokens=max_tokens,
+                                          temperature=temperature,
+                                          top_p=top_p,
+                                          top_k=top_k,
+                                          local_varaibles=local_varaibles,
+                                          cache=cache,
+                                          conversation=conversation,
+                                          attempt=attempt)
+    return generate_text_spec
@@ -0,0 +1,66 @@
+import asyncio
+from contextlib import contextmanager, nullcontext
+import json
+import os
+from pathlib import Path
+import threading
+import time
+from typing import ContextManager, Dict, Iterator, List, Optional
+
+class ChromeTracer:
+    # Collects complete ('X') events in the Chrome trace format, which Perfetto and chrome://tracing load.
+    # Every asyncio task gets its own track so spans of concurrent experiments nest properly.
+    def __init__(self):
+        self.events: List[dict] = []
+        self._start_ns = time.perf_counter_ns()
+        self._track_ids: Dict[int, int] = {}
+        self._lock = threading.Lock()
+
+    def _track_id(self) -> int:
+        try:
+            task = asyncio.current_task()
+        except RuntimeError:
+            task = None
+        key = id(task) if task is not None else threading.get_ident()
+        with self._lock:
+            return self._track_ids.setdefault(key, len(self._track_ids) + 1)
+
+    @contextmanager
+    def span(self, name: str, args: Optional[dict] = None) -> Iterator[None]:
+        track_id = self._track_id()
+        start_ns = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            end_ns = time.perf_counter_ns()
+            event = {'name': name,
+                     'ph': 'X',
+                     'ts': (start_ns - self._start_ns) / 1000,
+                     'dur': (end_ns - start_ns) / 1000,
+                     'pid': os.getpid(),
+                     'tid': track_id}
+            if args is not None:
+                event['args'] = args
+            with self._lock:
+                self.events.append(event)
+
+    def save(self, path: Path):
+        with self._lock:
+            events = list(self.events)
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+_tracer: Optional[ChromeTracer] = None
+_NO_SPAN = nullcontext()
+
+def set_tracer(tracer: Optional[ChromeTracer]):
+    global _tracer
+    _tracer = tracer
+
+def get_tracer() -> Optional[ChromeTracer]:
+    return _tracer
+
+def span(name: str, args: Optional[dict] = None) -> ContextManager[None]:
+    if _tracer is None:
+        return _NO_SPAN
+    return _tracer.span(name, args)